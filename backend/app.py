@@ -1,101 +1,508 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, send_file
 import os
-from google import genai
-from google.genai import types
-import base64
 from PIL import Image
+import contextvars
+import hashlib
+import hmac
 import io
+import json
+import logging
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from batch import BatchError, expand_items, stream_batch
+from binary_mask import decode_binary_mask, fit_mask, mask_digest, yellow_overlay
+from debug_capture import DebugCapture
+import deadlines
+from fair_queue import Flow, current_flow, reset_flow, set_flow, with_flow
+from gemini_client import GeminiClient, UpstreamUnavailable
+from image_store import ImageStore
+from intake import DEFAULT_FORMATS, ImageIntake, IntakeError
+from jobs import JobManager, JobQueueFull
+from mask_analysis import analyze_mask, summarize_mask
+from mask_crop import composite_patch, make_overview, plan_crop, scale_box
+from metrics import SIZE_BUCKETS, Registry, StageTimer
+from payloads import IMAGE_FIELD_HEADER, METADATA_HEADER, has_image, image_bytes, image_response, json_payload, output_options, parse_request_data, requested_image_format, sniff_image_type
+from pipeline import PipelineError, expand_steps, stream_pipeline
+from preprocess import flatten_to_rgb, normalize_image, restore_size, upright
+from rate_limit import TokenBucketLimiter
+from response_cache import ResponseCache, make_cache_key
+from single_flight import FileBackend, InMemoryBackend, SingleFlight, request_fingerprint
+from tiling import blend_tiles, plan_tiles
+import tracing
+
 load_dotenv()
 
-app = Flask(__name__)
-
-# Configure CORS for production
-if os.getenv('ENVIRONMENT') == 'production':
-    # In production, allow your frontend domain and common development origins
-    allowed_origins = [
-        "https://nano-banana-frontend.onrender.com",
-        "https://nano-banana-ai-editor-frontend.onrender.com", 
-        "https://nano-banana.onrender.com",
-        os.getenv('FRONTEND_URL', 'https://nano-banana-ai-editor.onrender.com')
-    ]
-    # Remove None values and duplicates
-    allowed_origins = list(set([origin for origin in allowed_origins if origin and 'your-frontend-app' not in origin]))
-    CORS(app, origins=allowed_origins)
-    print(f"CORS configured for production with origins: {allowed_origins}")
-else:
-    # In development, allow all origins
-    CORS(app)
-    print("CORS configured for development (all origins allowed)")
+# Level-gated logging: DEBUG adds per-stage details and full prompts, INFO is one line per step
+tracing.configure_logging(
+    os.getenv('LOG_LEVEL', 'INFO' if os.getenv('ENVIRONMENT') == 'production' else 'DEBUG'),
+    json_format=os.getenv('LOG_FORMAT', 'text').lower() == 'json',
+)
+log = logging.getLogger(__name__)
+
+# Routes and hooks are registered on this blueprint; create_app() builds the Flask app
+api = Blueprint('api', __name__)
+# Bodies over this are rejected with a 413 before they are read into memory
+MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(32 * 1024 * 1024)))
+
+# Response headers the frontend may read across origins
+EXPOSE_HEADERS = [METADATA_HEADER, IMAGE_FIELD_HEADER, 'Server-Timing', 'X-Request-ID', 'X-Profile']
+
+# Prometheus metrics, served by GET /metrics (values are per worker process)
+metrics = Registry()
+REQUEST_LATENCY = metrics.histogram('nano_banana_request_duration_seconds', 'HTTP request latency by route', ['route', 'method', 'status'])
+REQUESTS_IN_FLIGHT = metrics.gauge('nano_banana_requests_in_flight', 'HTTP requests currently being handled', ['route'])
+REQUEST_BYTES = metrics.histogram('nano_banana_request_bytes', 'HTTP request body size', ['route'], buckets=SIZE_BUCKETS)
+RESPONSE_BYTES = metrics.histogram('nano_banana_response_bytes', 'HTTP response body size', ['route'], buckets=SIZE_BUCKETS)
+STAGE_LATENCY = metrics.histogram('nano_banana_stage_duration_seconds', 'Latency of each image pipeline stage', ['operation', 'stage'])
+MODEL_INPUT_BYTES = metrics.histogram('nano_banana_model_input_image_bytes', 'Size of each image sent to the model', ['operation'], buckets=SIZE_BUCKETS)
+MODEL_OUTPUT_BYTES = metrics.histogram('nano_banana_model_output_image_bytes', 'Size of each image returned by the model', ['operation'], buckets=SIZE_BUCKETS)
+UPSTREAM_ERRORS = metrics.counter('nano_banana_upstream_errors_total', 'Failed or rejected model calls by error type', ['type'])
+RATE_LIMITED = metrics.counter('nano_banana_rate_limited_total', 'Requests rejected by the per-client rate limit', ['operation'])
+LOAD_SHED = metrics.counter('nano_banana_load_shed_total', 'Requests rejected because the server is overloaded', ['operation', 'reason'])
+DEADLINE_DROPPED = metrics.counter('nano_banana_deadline_dropped_total', 'Queued work dropped because its request deadline had passed', ['operation'])
 
 # Initialize Gemini client
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 if not GOOGLE_API_KEY or GOOGLE_API_KEY == "your_api_key_here":
-    print("ERROR: Valid GOOGLE_API_KEY not found in environment variables!")
-    print("Please set GOOGLE_API_KEY environment variable in Render dashboard")
-    print("Get an API key from: https://aistudio.google.com/app/apikey")
+    log.error("Valid GOOGLE_API_KEY not found in environment variables!")
+    log.error("Please set GOOGLE_API_KEY environment variable in Render dashboard")
+    log.error("Get an API key from: https://aistudio.google.com/app/apikey")
     # In production, don't exit but log the error
     if os.getenv('ENVIRONMENT') != 'production':
         exit(1)
 
-client = genai.Client(api_key=GOOGLE_API_KEY) if GOOGLE_API_KEY else None
+GEMINI_TIMEOUT_SECONDS = float(os.getenv('GEMINI_TIMEOUT_SECONDS', '120'))
 MODEL_ID = "gemini-2.5-flash-image-preview"
+# Open the upstream connection pool when a worker starts instead of on its first request
+UPSTREAM_WARM_UP = os.getenv('UPSTREAM_WARM_UP', 'false').lower() == 'true'
+
+def genai_types():
+    # google.genai takes most of a second to import, so it is loaded on first use (or by warm-up)
+    from google.genai import types
+    return types
+
+def with_upstream_timeout(kwargs, seconds):
+    # Per-call HTTP timeout; the SDK applies config.http_options over the client's own
+    config = kwargs.get('config')
+    if config is None:
+        return kwargs
+    options = genai_types().HttpOptions(timeout=max(1, int(seconds * 1000)))
+    return {**kwargs, 'config': config.model_copy(update={'http_options': options})}
+
+def make_genai_client():
+    from google import genai
+    return genai.Client(
+        api_key=GOOGLE_API_KEY,
+        http_options=genai_types().HttpOptions(timeout=int(GEMINI_TIMEOUT_SECONDS * 1000))
+    )
+
+# Every route goes through one wrapper: shared connection pool, per-process
+# concurrency limit, retries with backoff and a circuit breaker. The SDK
+# client is built on first use, so it is never shared across a --preload fork.
+gemini = GeminiClient(
+    client_factory=make_genai_client if GOOGLE_API_KEY else None,
+    max_concurrency=int(os.getenv('GEMINI_MAX_CONCURRENCY', '8')),
+    queue_timeout=float(os.getenv('GEMINI_QUEUE_TIMEOUT', '30')),
+    max_retries=int(os.getenv('GEMINI_MAX_RETRIES', '3')),
+    base_delay=float(os.getenv('GEMINI_RETRY_BASE_DELAY', '0.5')),
+    max_delay=float(os.getenv('GEMINI_RETRY_MAX_DELAY', '8')),
+    max_async_concurrency=int(os.getenv('GEMINI_MAX_ASYNC_CONCURRENCY', '256')),
+    breaker_threshold=int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5')),
+    breaker_cooldown=float(os.getenv('GEMINI_BREAKER_COOLDOWN', '30')),
+    on_error=lambda kind: UPSTREAM_ERRORS.inc(type=kind),
+    call_timeout=GEMINI_TIMEOUT_SECONDS,
+    with_timeout=with_upstream_timeout,
+    # Hedging is opt-in: e.g. 95 re-issues calls slower than 95% of recent ones,
+    # for at most GEMINI_HEDGE_BUDGET extra calls per call
+    hedge_percentile=float(os.getenv('GEMINI_HEDGE_PERCENTILE', '0')) or None,
+    hedge_budget=float(os.getenv('GEMINI_HEDGE_BUDGET', '0.05')),
+)
+
+# Masked edits: send only the doodled region (plus a small overview) instead of the whole canvas
+EDIT_CROP_TO_MASK = os.getenv('EDIT_CROP_TO_MASK', 'false').lower() == 'true'
+EDIT_CROP_MARGIN = float(os.getenv('EDIT_CROP_MARGIN', '0.25'))
+EDIT_CROP_FEATHER = int(os.getenv('EDIT_CROP_FEATHER', '24'))
+EDIT_OVERVIEW_MAX_SIDE = int(os.getenv('EDIT_OVERVIEW_MAX_SIDE', '512'))
+
+# Tiled whole-image edits: photos over EDIT_TILE_MIN_SIDE are edited tile by tile at full
+# resolution ("tiled": true, or on by default with EDIT_TILED), next to an edited
+# low-resolution reference; EDIT_TILE_CONCURRENCY tiles of a request run at once
+EDIT_TILED = os.getenv('EDIT_TILED', 'false').lower() == 'true'
+EDIT_TILE_MIN_SIDE = int(os.getenv('EDIT_TILE_MIN_SIDE', '2048'))
+EDIT_TILE_SIDE = int(os.getenv('EDIT_TILE_SIDE', '1024'))
+EDIT_TILE_OVERLAP = int(os.getenv('EDIT_TILE_OVERLAP', '128'))
+EDIT_TILE_MAX_TILES = int(os.getenv('EDIT_TILE_MAX_TILES', '24'))
+EDIT_TILE_REFERENCE_SIDE = int(os.getenv('EDIT_TILE_REFERENCE_SIDE', '1024'))
+EDIT_TILE_CONCURRENCY = int(os.getenv('EDIT_TILE_CONCURRENCY', '4'))
+
+# Input normalization applied to every image before it is sent to the model
+INPUT_MAX_SIDE = int(os.getenv('INPUT_MAX_SIDE', '1536'))
+INPUT_ENCODING = os.getenv('INPUT_ENCODING', 'jpeg').lower()
+INPUT_QUALITY = int(os.getenv('INPUT_QUALITY', '90'))
+RESTORE_OUTPUT_SIZE = os.getenv('RESTORE_OUTPUT_SIZE', 'false').lower() == 'true'
+
+# Uploads are validated from their header (format, dimensions) before any decode
+intake = ImageIntake(
+    max_pixels=int(os.getenv('INPUT_MAX_PIXELS', '40000000')),
+    max_side=int(os.getenv('INPUT_MAX_DIMENSION', '12000')),
+    formats=os.getenv('INPUT_FORMATS', ','.join(DEFAULT_FORMATS)).split(','),
+)
+
+# Debug captures of masked edit inputs/outputs, written off the request path
+debug_capture = DebugCapture(
+    os.getenv('DEBUG_CAPTURE_DIR', os.path.join(os.path.dirname(__file__), 'debug')),
+    enabled=os.getenv('DEBUG_CAPTURE', 'false' if os.getenv('ENVIRONMENT') == 'production' else 'true').lower() == 'true',
+    sample_rate=float(os.getenv('DEBUG_CAPTURE_SAMPLE_RATE', '1.0')),
+    max_files=int(os.getenv('DEBUG_CAPTURE_MAX_FILES', '200')),
+    max_bytes=int(os.getenv('DEBUG_CAPTURE_MAX_BYTES', str(200 * 1024 * 1024))),
+)
+
+# Response cache: identical retries are served without another API call
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+response_cache = ResponseCache(
+    max_memory_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    disk_dir=os.getenv('RESPONSE_CACHE_DIR') or None,
+    disk_ttl=int(os.getenv('RESPONSE_CACHE_TTL', str(24 * 3600))),
+    max_disk_bytes=int(os.getenv('RESPONSE_CACHE_DISK_MAX_BYTES', str(1024 * 1024 * 1024))),
+)
+# Settings that change what the model is sent or how its answer is put back together
+# are part of every key, so the disk tier stops serving results made under old ones
+CACHE_KEY_SETTINGS = {
+    'input': [INPUT_MAX_SIDE, INPUT_ENCODING, INPUT_QUALITY],
+    'crop': [EDIT_CROP_MARGIN, EDIT_CROP_FEATHER, EDIT_OVERVIEW_MAX_SIDE],
+    'tiles': [EDIT_TILE_MIN_SIDE, EDIT_TILE_SIDE, EDIT_TILE_OVERLAP, EDIT_TILE_MAX_TILES, EDIT_TILE_REFERENCE_SIDE],
+}
+
+# Content-addressed image store: clients reference images already sent or
+# generated by id ("image_id", "mask_id", ...) instead of re-uploading them.
+# Memory only unless IMAGE_STORE_DIR names a directory for the disk tier
+image_store = ImageStore(
+    max_memory_bytes=int(os.getenv('IMAGE_STORE_MAX_BYTES', str(128 * 1024 * 1024))),
+    disk_dir=os.getenv('IMAGE_STORE_DIR') or None,
+    ttl=int(os.getenv('IMAGE_STORE_TTL', str(24 * 3600))),
+    max_disk_bytes=int(os.getenv('IMAGE_STORE_DISK_MAX_BYTES', str(2 * 1024 * 1024 * 1024))),
+)
+IMAGE_INPUT_FIELDS = ('image', 'mask', 'baseImage', 'blendImage')
+
+# Per-client token buckets, in cost units: a two-image blend costs more than a generate.
+# Interactive requests over the rate get a 429; batch items are slowed down instead.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+ROUTE_COSTS = {
+    name: float(cost) for name, cost in (
+        entry.split('=') for entry in os.getenv('RATE_LIMIT_COSTS', 'generate=1,edit-whole=2,edit-image=2,blend-images=3').split(',')
+    )
+}
+rate_limiter = TokenBucketLimiter(
+    rate=float(os.getenv('RATE_LIMIT_RATE', '0.5')),
+    burst=float(os.getenv('RATE_LIMIT_BURST', '12')),
+)
+# Behind a proxy (Render) the client address is the last X-Forwarded-For entry, the one the
+# proxy appended; earlier entries come from the client and can be anything
+RATE_LIMIT_TRUST_PROXY = os.getenv('RATE_LIMIT_TRUST_PROXY', 'true' if os.getenv('ENVIRONMENT') == 'production' else 'false').lower() == 'true'
+# Clients sending one of these X-API-Key values are limited per key instead of per address
+RATE_LIMIT_API_KEYS = {
+    hashlib.sha256(key.strip().encode()).hexdigest()
+    for key in os.getenv('RATE_LIMIT_API_KEYS', '').split(',') if key.strip()
+}
+# Share of upstream slots a client's batch traffic gets relative to its interactive requests
+BULK_WEIGHT = float(os.getenv('FAIR_QUEUE_BULK_WEIGHT', '0.25'))
+
+# Request deadlines: the client's X-Request-Timeout (seconds) or the route's default,
+# passed down as the upstream timeout; REQUEST_TIMEOUT_DEFAULT=0 sets none by default.
+# Proxies and browsers commonly give up on a request after about 100 s.
+REQUEST_TIMEOUT_DEFAULT = float(os.getenv('REQUEST_TIMEOUT_DEFAULT', '100'))
+REQUEST_TIMEOUTS = {
+    name: float(seconds) for name, seconds in (
+        entry.split('=') for entry in os.getenv('REQUEST_TIMEOUTS', '').split(',') if entry
+    )
+}
+REQUEST_TIMEOUT_MAX = float(os.getenv('REQUEST_TIMEOUT_MAX', '300'))
+# Load shedding: 503 once this many requests are queued for a job worker or an
+# upstream slot (0 disables), or when the expected wait would outlast the deadline
+SHED_QUEUE_DEPTH = int(os.getenv('SHED_QUEUE_DEPTH', '16'))
 
 # LangChain-like prompt enhancement
 def enhance_prompt_with_context(user_prompt, context):
     return f"{context}; apply the following edit: {user_prompt}"
 
-@app.route('/generate', methods=['POST'])
-def generate_image():
-    if not client:
-        return jsonify({'error': 'API key not configured. Please contact administrator.'}), 500
+def request_flag(data, key, default):
+    # Accept JSON booleans as well as "true"/"false" strings from form posts
+    value = data.get(key, default)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+# Gemini accepts temperatures from 0 to 2
+TEMPERATURE_RANGE = (0.0, 2.0)
+
+def request_temperature(value):
+    # Numbers or numeric strings from form posts, clamped to what the model accepts;
+    # raises ValueError (or TypeError) for anything else
+    temperature = float(value)
+    if math.isnan(temperature):
+        raise ValueError(f'temperature is not a number: {value!r}')
+    return min(max(temperature, TEMPERATURE_RANGE[0]), TEMPERATURE_RANGE[1])
+
+def client_identity(req):
+    # A configured API key if the client sends one (hashed, it ends up in metrics and logs),
+    # else its address; unknown keys are ignored, or every made-up key would get a fresh bucket
+    api_key = req.headers.get('X-API-Key')
+    if api_key:
+        digest = hashlib.sha256(api_key.encode()).hexdigest()
+        if digest in RATE_LIMIT_API_KEYS:
+            return 'key:' + digest[:16]
+    address = req.remote_addr
+    if RATE_LIMIT_TRUST_PROXY and req.headers.get('X-Forwarded-For'):
+        address = req.headers['X-Forwarded-For'].split(',')[-1].strip()
+    return f'ip:{address or "unknown"}'
+
+def request_flow(req, operation, bulk=False):
+    # Fair-queue flow of a request: its client, with batch traffic as a lighter separate flow
+    client = client_identity(req)
+    cost = ROUTE_COSTS.get(operation, 1.0)
+    return Flow(f'{client}/bulk', BULK_WEIGHT, cost, client) if bulk else Flow(client, 1.0, cost, client)
+
+def rate_limited(req, operation, count=1):
+    """Return a 429 (payload, status) if the client is over its rate, else None.
+
+    A request costing more than the burst could never pass and gets a 400.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return None
+    return charge_calls(client_identity(req), operation, count)
+
+def charge_extra_calls(operation, count):
+    """rate_limited() for model calls a request makes beyond the one it was admitted for.
+
+    Called where those calls are made (a job, batch or event-loop thread), so
+    the client is taken from the current fair-queue flow.
+    """
+    client = current_flow().client
+    if not RATE_LIMIT_ENABLED or client is None:
+        return None
+    return charge_calls(client, operation, count)
+
+def refund_rate(req, operation, count=1):
+    """Give back what rate_limited() took, for a request then turned away with a 503."""
+    if RATE_LIMIT_ENABLED:
+        rate_limiter.refund(client_identity(req), ROUTE_COSTS.get(operation, 1.0) * count)
+
+def charge_calls(client, operation, count):
+    cost = ROUTE_COSTS.get(operation, 1.0) * count
+    retry_after = rate_limiter.acquire(client, cost)
+    if not retry_after:
+        return None
+    if math.isinf(retry_after):
+        # No wait would help, so no Retry-After
+        return {'error': f'Request costs {cost:g} units, more than the per-client burst of {rate_limiter.burst:g}'}, 400
+    RATE_LIMITED.inc(operation=operation)
+    log.info("Rate limited %s for %s, retry in %.1fs", operation, client, retry_after)
+    return {'error': 'Too many requests, please slow down', 'retry_after': math.ceil(retry_after)}, 429
+
+def request_deadline(req, operation, use_default=True):
+    # Jobs and batches only get a deadline when the client asks for one
+    try:
+        seconds = float(req.headers.get('X-Request-Timeout', 0))
+    except ValueError:
+        seconds = 0
+    if seconds <= 0 and use_default:
+        seconds = REQUEST_TIMEOUTS.get(operation, REQUEST_TIMEOUT_DEFAULT)
+    return deadlines.after(min(seconds, REQUEST_TIMEOUT_MAX)) if seconds > 0 else None
+
+def expected_queue_wait(asynchronous=False):
+    """Rough seconds before a new request's model call would start.
+
+    Synchronous requests first queue for a job worker (each busy for about
+    one model call), then for an upstream slot.
+    """
+    wait = gemini.expected_wait(asynchronous)
+    mean_call = gemini.mean_call_seconds
+    if not asynchronous and mean_call:
+        running, queued = job_manager.depth()
+        if running >= job_manager.max_workers:
+            wait += (queued + 1) / job_manager.max_workers * mean_call
+    return wait
+
+def overloaded(operation, deadline=None, asynchronous=False):
+    """Return a 503 (payload, status) if the request should be shed, else None."""
+    depth = gemini.queue_depth(asynchronous) + (0 if asynchronous else job_manager.depth()[1])
+    wait = expected_queue_wait(asynchronous)
+    left = deadlines.remaining(deadline) if deadline else None
+    if SHED_QUEUE_DEPTH and depth >= SHED_QUEUE_DEPTH:
+        reason = 'queue_depth'
+    elif left is not None and wait >= left:
+        reason = 'deadline'
+    else:
+        return None
+    LOAD_SHED.inc(operation=operation, reason=reason)
+    log.warning("Shedding %s (%s): %d queued, expected wait %.1fs", operation, reason, depth, wait)
+    return {'error': 'Server is overloaded, please retry shortly', 'retry_after': min(60, max(1, math.ceil(wait)))}, 503
+
+def prepare_image(image, source_bytes=None, source_size=None):
+    """Normalize an input image (size cap, RGB, no metadata, compact encoding)."""
+    normalized = normalize_image(image, INPUT_MAX_SIDE, INPUT_ENCODING, INPUT_QUALITY, source_bytes, source_size)
+    log.debug("Normalized %s %dx%d input to %dx%d %s (%d bytes)", normalized.original_mode,
+              *normalized.original_size, *normalized.size, normalized.mime_type, len(normalized.data))
+    return normalized
+
+def stage_timer(operation):
+    # Stages go to the latency histogram and to the request's Server-Timing header
+    return StageTimer(STAGE_LATENCY, operation, on_mark=tracing.record_stage)
+
+def image_part(normalized, operation):
+    MODEL_INPUT_BYTES.observe(len(normalized.data), operation=operation)
+    return genai_types().Part.from_bytes(data=normalized.data, mime_type=normalized.mime_type)
+
+def upstream_unavailable(err):
+    # The model was not called (breaker open, no free slot) or was cut off at the request's
+    # deadline (504), so the client can safely retry
+    log.warning("Upstream unavailable: %s", err)
+    return {'error': str(err), 'retry_after': err.retry_after}, err.status_code
+
+def response_cache_key(data, endpoint, prompt, images, temperature, extra=None):
+    # Clients can send "cache": false to force a fresh generation
+    if not RESPONSE_CACHE_ENABLED or not request_flag(data, 'cache', True):
+        return None
+    return make_cache_key(endpoint, prompt, images, temperature, MODEL_ID, {**(extra or {}), 'settings': CACHE_KEY_SETTINGS})
+
+def model_output(response, operation):
+    """Return (image bytes or None, text parts) of a model response.
+
+    Parts are walked once, up to the first image. The image is the SDK's own
+    bytes object: it is not copied, decoded or re-encoded here, only once
+    when the response is sent (see payloads.py).
+    """
+    texts = []
+    for part in response.parts or ():
+        blob = part.inline_data
+        if blob is not None and blob.data:
+            MODEL_OUTPUT_BYTES.observe(len(blob.data), operation=operation)
+            log.debug("Model returned a %s image of %d bytes", blob.mime_type, len(blob.data))
+            return blob.data, texts
+        if part.text:
+            texts.append(part.text)
+            log.info("API returned text: %s", part.text)
+    return None, texts
+
+def cached_response(cache_key, image_field):
+    """Return the JSON response for a cache hit, or None on a miss."""
+    if not cache_key:
+        return None
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        return None
+    cached_bytes, meta = cached
+    log.info("Serving %s from response cache (%d bytes)", image_field, len(cached_bytes))
+    return {image_field: cached_bytes, **meta, 'cached': True}
+
+def store_response(cache_key, result_bytes, meta=None):
+    if cache_key:
+        response_cache.put(cache_key, result_bytes, meta)
+
+def composite_masked_edit(result_bytes, crop_box, masked_image, original_data):
+    """Paste a cropped edit result back into the full-resolution original."""
+    base = masked_image
+    if original_data:
+        try:
+            # Upright, like the canvas the crop box was planned on
+            base = upright(intake.open(image_bytes(original_data))[0])
+        except Exception as original_err:
+            # The crop covers every yellow pixel, so the masked canvas is a usable fallback
+            log.warning("Could not decode original image, compositing onto masked image: %s", original_err)
+
+    box = scale_box(crop_box, masked_image.size, base.size)
+    patch = Image.open(io.BytesIO(result_bytes))
+    result = composite_patch(base, patch, box, feather=EDIT_CROP_FEATHER)
+    log.debug("Composited %dx%d patch into %dx%d original at %s", patch.width, patch.height, base.width, base.height, box)
+
+    buffer = io.BytesIO()
+    result.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def model_call(**kwargs):
+    # Operations are generators that yield their model call with these arguments
+    # and get the response back, so a thread (run_steps) or the event loop
+    # (asgi.py) can make the call. A list of calls is made concurrently and
+    # answered with the list of responses
+    return kwargs
+
+def call_models(calls):
+    # At most EDIT_TILE_CONCURRENCY at once; the upstream slots bound them across requests
+    with ThreadPoolExecutor(max_workers=max(1, min(EDIT_TILE_CONCURRENCY, len(calls))), thread_name_prefix='fan-out') as pool:
+        futures = [pool.submit(contextvars.copy_context().run, gemini.generate_content, **call) for call in calls]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            pool.shutdown(cancel_futures=True)
+            raise
+
+def run_steps(steps):
+    """Run an operation's steps to completion, calling the model on this thread."""
+    try:
+        call = next(steps)
+        while True:
+            try:
+                response = call_models(call) if isinstance(call, list) else gemini.generate_content(**call)
+            except Exception as err:
+                call = steps.throw(err)
+            else:
+                call = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+def generate_steps(data):
+    if not gemini.configured:
+        return {'error': 'API key not configured. Please contact administrator.'}, 500
         
     try:
-        data = request.get_json()
+        stages = stage_timer('generate')
         prompt = data['prompt']
-        print(f"Generating image with prompt: {prompt}")
+        log.info("Generating image with prompt: %s", prompt)
 
-        response = client.models.generate_content(
+        # Slightly higher temperature for creative generation; variants each set their own
+        try:
+            temperature = request_temperature(data.get('temperature', 0.7))
+        except (TypeError, ValueError):
+            return {'error': '"temperature" must be a number'}, 400
+        cache_key = response_cache_key(data, 'generate', prompt, [], temperature)
+        cached = cached_response(cache_key, 'generated_image')
+        stages.mark('cache_lookup')
+        if cached:
+            return cached, 200
+
+        response = yield model_call(
             model=MODEL_ID,
             contents=prompt,
-            config=types.GenerateContentConfig(
+            config=genai_types().GenerateContentConfig(
                 response_modalities=['Image'],  # Request only image response
-                temperature=0.7,  # Slightly higher temperature for creative generation
+                temperature=temperature,
                 max_output_tokens=1024
             )
         )
-        print(f"API Response: {response}")
-
-        for part in response.parts:
-            if hasattr(part, 'inline_data') and part.inline_data:
-                # Direct access to blob data
-                blob = part.inline_data
-                if hasattr(blob, 'data'):
-                    img_str = base64.b64encode(blob.data).decode()
-                    return jsonify({'generated_image': f'data:image/png;base64,{img_str}'})
+        stages.mark('model_call')
 
-        return jsonify({'error': 'No image generated', 'response_parts': str(response.parts)}), 500
+        result, texts = model_output(response, 'generate')
+        stages.mark('extract')
+        if result is None:
+            return {'error': 'No image generated', 'text_responses': texts}, 500
+        store_response(cache_key, result)
+        stages.mark('postprocess')
+        return {'generated_image': result}, 200
 
+    except UpstreamUnavailable as unavailable_err:
+        return upstream_unavailable(unavailable_err)
     except Exception as e:
-        print(f"Error in generate_image: {e}")
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/edit-whole', methods=['POST'])
-def edit_whole_image():
-    if not client:
-        return jsonify({'error': 'API key not configured. Please contact administrator.'}), 500
-        
-    try:
-        data = request.get_json()
-        image_data = data['image']
-        prompt = data['prompt']
-
-        image = Image.open(io.BytesIO(base64.b64decode(image_data.split(',')[1])))
+        log.error("Error in generate_image: %s", e)
+        return {'error': str(e)}, 500
 
-        # Enhanced prompt for whole image editing
-        whole_image_prompt = f"""
+def whole_image_prompt(prompt):
+    # Enhanced prompt for whole image editing
+    return f"""
         Image Editing Task: Analyze and modify this entire image according to the following instruction: {prompt}
         
         Requirements:
@@ -105,61 +512,170 @@ def edit_whole_image():
         - Return only the edited image without text explanation
         """
 
-        response = client.models.generate_content(
-            model=MODEL_ID,
-            contents=[
-                whole_image_prompt,
-                image
-            ],
-            config=types.GenerateContentConfig(
-                response_modalities=['Image'],  # Request only image response
-                temperature=0.4,  # Balanced temperature for whole image edits
-                max_output_tokens=1024
-            )
+def tile_prompt(prompt):
+    return f"""
+        Image Editing Task: The first image is one tile of a larger photo. The second image shows the same
+        region of the whole photo after the edit, at low resolution. Apply the following instruction to the tile: {prompt}
+
+        Requirements:
+        - Match the colors, lighting and style of the second image exactly
+        - Keep the tile's framing, composition and fine detail, and add no borders
+        - Return only the edited tile without text explanation
+        """
+
+def edit_tiles_steps(image_binary, prompt, config, cache_key, stages):
+    """Edit a large photo tile by tile at full resolution (see tiling.py).
+
+    The whole frame is edited once at low resolution first; every tile then
+    goes to the model next to its region of that reference, all tiles at once.
+    """
+    # Only this frame holds the full-resolution pixels, and only until the tiles are cut
+    image, _ = intake.open(image_binary)
+    full = flatten_to_rgb(upright(image))
+    del image
+    stages.mark('image_open')
+    # Each tile is a model call of its own; the request was only charged for the reference
+    boxes = plan_tiles(full.size, EDIT_TILE_SIDE, EDIT_TILE_OVERLAP, EDIT_TILE_MAX_TILES)
+    rejected = charge_extra_calls('edit-whole', len(boxes))
+    if rejected:
+        return rejected
+    reference = normalize_image(full, EDIT_TILE_REFERENCE_SIDE, INPUT_ENCODING, INPUT_QUALITY)
+    stages.mark('preprocess')
+    response = yield model_call(model=MODEL_ID, contents=[whole_image_prompt(prompt), image_part(reference, 'edit-whole')], config=config)
+    reference_bytes, texts = model_output(response, 'edit-whole')
+    if reference_bytes is None:
+        return {'error': 'No image generated', 'text_responses': texts}, 500
+    edited_reference = Image.open(io.BytesIO(reference_bytes)).convert('RGB')
+    stages.mark('reference')
+
+    calls = []
+    for box in boxes:
+        tile = normalize_image(full.crop(box), INPUT_MAX_SIDE, INPUT_ENCODING, INPUT_QUALITY)
+        guide = normalize_image(edited_reference.crop(scale_box(box, full.size, edited_reference.size)),
+                                INPUT_MAX_SIDE, INPUT_ENCODING, INPUT_QUALITY)
+        calls.append(model_call(model=MODEL_ID, contents=[tile_prompt(prompt), image_part(tile, 'edit-whole'),
+                                                          image_part(guide, 'edit-whole')], config=config))
+    log.info("Editing %dx%d image in %d tiles", *full.size, len(boxes))
+    size = full.size
+    del full
+    stages.mark('prompt')
+
+    responses = yield calls
+    stages.mark('model_call')
+    outputs = []
+    for box, response in zip(boxes, responses):
+        tile_bytes, texts = model_output(response, 'edit-whole')
+        if tile_bytes is None:
+            return {'error': f'No image generated for tile {box}', 'text_responses': texts}, 500
+        outputs.append(tile_bytes)
+    # Tiles are decoded one at a time while they are blended in
+    result = blend_tiles(size, ((box, Image.open(io.BytesIO(data))) for box, data in zip(boxes, outputs)))
+    stages.mark('blend')
+    buffer = io.BytesIO()
+    result.save(buffer, format='PNG')
+    result = buffer.getvalue()
+    store_response(cache_key, result)
+    stages.mark('postprocess')
+    return {'edited_image': result, 'tiles': len(boxes)}, 200
+
+def edit_whole_steps(data):
+    if not gemini.configured:
+        return {'error': 'API key not configured. Please contact administrator.'}, 500
+        
+    try:
+        stages = stage_timer('edit-whole')
+        image_data = data['image']
+        prompt = data['prompt']
+
+        image_binary = image_bytes(image_data)
+        restore = request_flag(data, 'restore_size', RESTORE_OUTPUT_SIZE)
+        stages.mark('decode')
+
+        temperature = 0.4  # Balanced temperature for whole image edits
+        tiled = request_flag(data, 'tiled', EDIT_TILED)
+        cache_key = response_cache_key(data, 'edit-whole', prompt, [image_binary], temperature,
+                                       {'restore_size': restore, **({'tiled': True} if tiled else {})})
+        cached = cached_response(cache_key, 'edited_image')
+        stages.mark('cache_lookup')
+        if cached:
+            return cached, 200
+
+        # JPEGs larger than needed are scaled down while decoding, unless they are to be tiled
+        image, header = intake.open(image_binary, draft_side=None if tiled else INPUT_MAX_SIDE)
+        config = genai_types().GenerateContentConfig(
+            response_modalities=['Image'],  # Request only image response
+            temperature=temperature,
+            max_output_tokens=1024
         )
+        if tiled and max(header.size) > EDIT_TILE_MIN_SIDE:
+            return (yield from edit_tiles_steps(image_binary, prompt, config, cache_key, stages))
+        stages.mark('image_open')
+        image = prepare_image(image, image_binary, header.size)
+        stages.mark('preprocess')
+
+        contents = [whole_image_prompt(prompt), image_part(image, 'edit-whole')]
+        stages.mark('prompt')
 
-        for part in response.parts:
-            if hasattr(part, 'inline_data') and part.inline_data:
-                blob = part.inline_data
-                if hasattr(blob, 'data'):
-                    img_str = base64.b64encode(blob.data).decode()
-                    return jsonify({'edited_image': f'data:image/png;base64,{img_str}'})
+        response = yield model_call(model=MODEL_ID, contents=contents, config=config)
+        stages.mark('model_call')
 
-        return jsonify({'error': 'No image generated'}), 500
+        result, texts = model_output(response, 'edit-whole')
+        stages.mark('extract')
+        if result is None:
+            return {'error': 'No image generated', 'text_responses': texts}, 500
+        if restore:
+            result = restore_size(result, image.original_size)
+        store_response(cache_key, result)
+        stages.mark('postprocess')
+        return {'edited_image': result}, 200
 
+    except UpstreamUnavailable as unavailable_err:
+        return upstream_unavailable(unavailable_err)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
-@app.route('/blend-images', methods=['POST'])
-def blend_images():
-    if not client:
-        return jsonify({'error': 'API key not configured. Please contact administrator.'}), 500
+def blend_images_steps(data):
+    if not gemini.configured:
+        return {'error': 'API key not configured. Please contact administrator.'}, 500
         
     try:
-        data = request.get_json()
+        stages = stage_timer('blend-images')
         base_image_data = data['baseImage']  # Main canvas image
         blend_image_data = data['blendImage']  # Additional image to blend
         prompt = data['prompt']
         
-        print(f"Received blend request with prompt: {prompt}")
+        log.info("Received blend request with prompt: %s", prompt)
         
         # Decode both images
         try:
             # Decode base image
-            base_b64 = base_image_data.split(',')[1] if ',' in base_image_data else base_image_data
-            base_binary = base64.b64decode(base_b64)
-            base_image = Image.open(io.BytesIO(base_binary))
-            print(f"Base image decoded: {base_image.width}x{base_image.height}")
-            
-            # Decode blend image
-            blend_b64 = blend_image_data.split(',')[1] if ',' in blend_image_data else blend_image_data
-            blend_binary = base64.b64decode(blend_b64)
-            blend_image = Image.open(io.BytesIO(blend_binary))
-            print(f"Blend image decoded: {blend_image.width}x{blend_image.height}")
+            base_binary = image_bytes(base_image_data)
+            blend_binary = image_bytes(blend_image_data)
+            stages.mark('decode')
+
+            base_image, base_header = intake.open(base_binary, draft_side=INPUT_MAX_SIDE)
+            log.debug("Base image opened: %dx%d", *base_header.size)
+            blend_image, blend_header = intake.open(blend_binary, draft_side=INPUT_MAX_SIDE)
+            log.debug("Blend image opened: %dx%d", *blend_header.size)
+            stages.mark('image_open')
             
+        except IntakeError as intake_err:
+            return {'error': str(intake_err)}, intake_err.status_code
         except Exception as decode_err:
-            print(f"Error decoding images: {decode_err}")
-            return jsonify({'error': f'Image decode error: {str(decode_err)}'}), 400
+            log.warning("Error decoding images: %s", decode_err)
+            return {'error': f'Image decode error: {str(decode_err)}'}, 400
+
+        restore = request_flag(data, 'restore_size', RESTORE_OUTPUT_SIZE)
+        temperature = 0.5  # Balanced creativity for blending
+        cache_key = response_cache_key(data, 'blend-images', prompt, [base_binary, blend_binary], temperature, {'restore_size': restore})
+        cached = cached_response(cache_key, 'blended_image')
+        stages.mark('cache_lookup')
+        if cached:
+            return cached, 200
+
+        base_image = prepare_image(base_image, base_binary, base_header.size)
+        blend_image = prepare_image(blend_image, blend_binary, blend_header.size)
+        stages.mark('preprocess')
         
         # Create enhanced prompt for blending with shape recognition
         blend_prompt = f"""
@@ -180,153 +696,165 @@ def blend_images():
         - Maintain consistent lighting, shadows, and color grading
         - Return only the blended image without text explanation
         """
+        contents = [blend_prompt, image_part(base_image, 'blend-images'), image_part(blend_image, 'blend-images')]
+        stages.mark('prompt')
         
-        print(f"Sending enhanced blend prompt to Gemini API: {blend_prompt}")
+        log.debug("Sending enhanced blend prompt to Gemini API: %s", blend_prompt)
         
         # Send both images to Gemini
         try:
-            response = client.models.generate_content(
+            response = yield model_call(
                 model=MODEL_ID,
-                contents=[
-                    blend_prompt,
-                    base_image,
-                    blend_image
-                ],
-                config=types.GenerateContentConfig(
+                contents=contents,
+                config=genai_types().GenerateContentConfig(
                     response_modalities=['Image'],  # Request only image response
-                    temperature=0.5,  # Balanced creativity for blending
+                    temperature=temperature,
                     max_output_tokens=1024
                 )
             )
-            print("Gemini API blend call completed successfully")
+            stages.mark('model_call')
+            log.debug("Gemini API blend call completed successfully")
+        except UpstreamUnavailable as unavailable_err:
+            return upstream_unavailable(unavailable_err)
         except Exception as api_err:
-            print(f"Gemini API blend call failed: {api_err}")
-            return jsonify({'error': f'API call failed: {str(api_err)}'}), 500
+            log.error("Gemini API blend call failed: %s", api_err)
+            return {'error': f'API call failed: {str(api_err)}'}, 500
         
-        # Extract the blended image from response
-        text_parts = []
-        
-        for i, part in enumerate(response.parts):
-            if hasattr(part, 'text') and part.text:
-                text_parts.append(part.text)
-                print(f"API returned text (part {i}): {part.text}")
-            
-            if hasattr(part, 'inline_data') and part.inline_data:
-                blob = part.inline_data
-                if hasattr(blob, 'data'):
-                    img_str = base64.b64encode(blob.data).decode()
-                    print("Successfully extracted and encoded blended image")
-                    
-                    return jsonify({
-                        'blended_image': f'data:image/png;base64,{img_str}',
-                        'prompt_used': blend_prompt,
-                        'text_responses': text_parts
-                    })
-        
-        return jsonify({'error': 'No blended image generated'}), 500
+        result, text_parts = model_output(response, 'blend-images')
+        stages.mark('extract')
+        if result is None:
+            return {'error': 'No blended image generated', 'text_responses': text_parts}, 500
+        if restore:
+            result = restore_size(result, base_image.original_size)
+        store_response(cache_key, result, {
+            'prompt_used': blend_prompt,
+            'text_responses': text_parts
+        })
+        stages.mark('postprocess')
+
+        return {
+            'blended_image': result,
+            'prompt_used': blend_prompt,
+            'text_responses': text_parts
+        }, 200
         
+    except UpstreamUnavailable as unavailable_err:
+        return upstream_unavailable(unavailable_err)
     except Exception as e:
-        print(f"Error in blend_images: {e}")
-        return jsonify({'error': str(e)}), 500
+        log.error("Error in blend_images: %s", e)
+        return {'error': str(e)}, 500
 
-@app.route('/edit-image', methods=['POST'])
-def edit_image():
-    if not client:
-        return jsonify({'error': 'API key not configured. Please contact administrator.'}), 500
+def edit_image_steps(data):
+    if not gemini.configured:
+        return {'error': 'API key not configured. Please contact administrator.'}, 500
         
     try:
         # Get data from request
-        data = request.get_json()
-        image_data = data['image']  # Base64 encoded original image (unused now)
-        mask_data = data['mask']    # Base64 encoded combined image with yellow mask
+        # Base64 encoded original image: what a binary mask applies to, else only the composite
+        # base for crop-to-mask (optional, so a raw image/* upload of the painted mask works alone)
+        image_data = data.get('image')
+        mask_data = data.get('mask')  # Base64 encoded combined image with yellow mask
+        binary_mask = data.get('binary_mask')  # Or: separate 1-bit mask (bilevel PNG or RLE) over the original
         prompt = data['prompt']
+        if mask_data is None and binary_mask is None:
+            return {'error': 'Provide a yellow-painted "mask" image or a "binary_mask"'}, 400
+        if binary_mask is not None and image_data is None:
+            return {'error': 'A "binary_mask" needs the "image" it applies to'}, 400
+        
+        stages = stage_timer('edit-image')
+        crop_to_mask = request_flag(data, 'crop_to_mask', EDIT_CROP_TO_MASK)
+        include_overview = request_flag(data, 'include_overview', EDIT_OVERVIEW_MAX_SIDE > 0)
+        restore = request_flag(data, 'restore_size', RESTORE_OUTPUT_SIZE)
         
-        print(f"Received edit request with prompt: {prompt}")
+        log.info("Received edit request with prompt: %s", prompt)
         
         # Decode the masked image (which now contains both original image and yellow mask)
         try:
-            import time
-            print(f"Mask data received. Starting length: {len(mask_data)}")
-            print(f"Mask data prefix: {mask_data[:50]}...")
-            
-            # Split at comma if it's a data URL
-            mask_b64 = mask_data.split(',')[1] if ',' in mask_data else mask_data
-            print(f"Base64 data extracted. Length: {len(mask_b64)}")
-            
-            # Decode the base64 data
-            mask_binary = base64.b64decode(mask_b64)
-            print(f"Decoded binary data. Size: {len(mask_binary)} bytes")
-            
-            # Open as image
-            masked_image = Image.open(io.BytesIO(mask_binary))
-            print(f"Masked image decoded successfully. Dimensions: {masked_image.width}x{masked_image.height}, Mode: {masked_image.mode}")
+            region = None
+            if binary_mask is not None:
+                # Exact edit region: no yellow detection needed, the overlay is drawn below
+                region = decode_binary_mask(binary_mask, intake)
+                mask_binary = image_bytes(image_data)
+                log.debug("Decoded %dx%d binary mask over a %d byte image", region.shape[1], region.shape[0], len(mask_binary))
+            else:
+                log.debug("Mask data received. Starting length: %d", len(mask_data))
+                # Data URL, bare base64 or raw bytes from a multipart/binary upload
+                mask_binary = image_bytes(mask_data)
+                log.debug("Decoded binary data. Size: %d bytes", len(mask_binary))
+            stages.mark('decode')
+
+            # Serve byte-identical retries before doing any image work
+            temperature = 0.3  # Lower temperature for more consistent results
+            if region is not None:
+                cache_images = [mask_binary, mask_digest(region)]
+            else:
+                cache_images = [mask_binary, image_data] if crop_to_mask and image_data is not None else [mask_binary]
+            cache_key = response_cache_key(data, 'edit-image', prompt, cache_images, temperature, {
+                'crop_to_mask': crop_to_mask,
+                'include_overview': include_overview,
+                'restore_size': restore,
+                'binary_mask': region is not None
+            })
+            cached = cached_response(cache_key, 'edited_image')
+            stages.mark('cache_lookup')
+            if cached:
+                return cached, 200
             
-            # Save multiple versions for debugging
-            try:
-                timestamp = int(time.time())
-                debug_dir = os.path.join(os.path.dirname(__file__), "debug")
-                os.makedirs(debug_dir, exist_ok=True)
-
-                # Use a simpler filename to avoid Windows path issues
-                debug_path = os.path.join(debug_dir, f"masked_image_{timestamp}.png")
-                masked_image.save(debug_path)
-                print(f"Saved debug image to {debug_path}")
-
-                # Also save a JPEG version to see if format matters
-                jpeg_path = os.path.join(debug_dir, f"masked_image_{timestamp}.jpg")
-                masked_image.convert("RGB").save(jpeg_path, "JPEG")
-                print(f"Saved JPEG version to {jpeg_path}")
-            except Exception as save_err:
-                print(f"Error saving debug images: {save_err}")
-                # Continue without debug saves if they fail
+            # Open as image (with a binary mask this is the original, overlaid after analysis);
+            # mask analysis needs every pixel, so no reduced decode here
+            masked_image, _ = intake.open(mask_binary)
+            log.debug("Masked image decoded successfully. Dimensions: %dx%d, Mode: %s", masked_image.width, masked_image.height, masked_image.mode)
+            stages.mark('image_open')
+
+            # Sampled debug capture of the upload as received (already encoded, so no work here)
+            capture_id = debug_capture.sample('edit_image')
+            debug_path = debug_capture.save(capture_id, 'masked', mask_binary)
             
+        except IntakeError as intake_err:
+            return {'error': str(intake_err)}, intake_err.status_code
         except Exception as mask_err:
-            print(f"Error processing mask: {mask_err}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'error': f'Masked image decode error: {str(mask_err)}'}), 400
+            log.exception("Error processing mask: %s", mask_err)
+            return {'error': f'Masked image decode error: {str(mask_err)}'}, 400
 
-        # Analyze the mask to detect yellow doodle pixels with better sensitivity
+        # Analyze the whole mask in one vectorized pass to detect yellow doodle pixels
         has_yellow = False
+        mask_info = None
         try:
+            if region is not None:
+                # The mask was drawn over the upright picture the browser showed, and
+                # the overlay must not be rotated again when the image is normalized
+                masked_image = upright(masked_image)
             # Convert to RGB if not already
             if masked_image.mode != 'RGB':
                 masked_image = masked_image.convert('RGB')
-            
-            # Sample pixels to detect yellow doodle markings with improved detection
-            pixels = list(masked_image.getdata())
-            yellow_count = 0
-            total_checked = 0
-            
-            for i, pixel in enumerate(pixels):
-                # Check more pixels for better detection, but limit for performance
-                if i > 25000:  # Increased from 10,000 for better coverage
-                    break
-                    
-                r, g, b = pixel
-                total_checked += 1
-                
-                # More sensitive yellow detection for doodle markings
-                # Method 1: Traditional high R+G, low B
-                is_yellow_traditional = (r > 180 and g > 180 and b < 120)
-                
-                # Method 2: Yellow-ish colors (including semi-transparent overlays)
-                is_yellow_ish = (r > 200 and g > 200 and b < 160 and (r + g) > (b * 2.5))
-                
-                # Method 3: Detect bright/highlighted pixels that could be yellow markings
-                is_bright_warm = (r > 220 and g > 200 and r > b and g > b)
-                
-                if is_yellow_traditional or is_yellow_ish or is_bright_warm:
-                    yellow_count += 1
-                    
-            yellow_percentage = (yellow_count / total_checked) * 100 if total_checked > 0 else 0
-            print(f"Detected {yellow_count} yellow/bright pixels out of {total_checked} checked ({yellow_percentage:.2f}%)")
-            
+
+            if region is not None:
+                # The mask may be drawn at canvas size; bring it to the image's resolution
+                region = fit_mask(region, masked_image.size)
+                mask_info = summarize_mask(region)
+                masked_image = yellow_overlay(masked_image, region)
+                debug_capture.save(capture_id, 'binary_mask', Image.fromarray(region))
+            else:
+                mask_info = analyze_mask(masked_image)
+            log.debug("Detected %d yellow/bright pixels out of %d checked (%.2f%%)",
+                      mask_info.yellow_count, mask_info.total_pixels, mask_info.yellow_percentage)
+            log.debug("Yellow bounding box: %s, regions: %d", mask_info.bbox, len(mask_info.regions))
+
             # Consider mask valid if it has enough yellow pixels (lowered threshold for sensitivity)
-            has_yellow = yellow_count > 25 or yellow_percentage > 0.1
-            
+            has_yellow = mask_info.has_yellow
+
         except Exception as color_err:
-            print(f"Error analyzing mask colors: {color_err}")
+            log.warning("Error analyzing mask colors: %s", color_err)
+        stages.mark('mask_analysis')
+
+        # Crop-to-mask mode: only the doodled region plus a context margin goes to the model
+        crop_box = None
+        if has_yellow and crop_to_mask:
+            crop_box = plan_crop(mask_info.bbox, masked_image.size, margin_ratio=EDIT_CROP_MARGIN)
+            if crop_box:
+                log.info("Cropping to mask region %s of %s", crop_box, masked_image.size)
+            else:
+                log.info("Mask region covers most of the image, sending the whole canvas")
         
         # Create enhanced master prompt with organic doodle recognition and contextual fitting
         master_prompt = "Image Editing Task: Analyze this image to understand the scene, objects, and people. Look for yellow doodle markings that indicate where to make changes. REPLACE ONLY the yellow-marked areas with"
@@ -374,197 +902,742 @@ def edit_image():
         
         # Add diagnostic information if yellow pixels are missing
         if not has_yellow:
-            print("WARNING: No significant yellow pixels detected in mask!")
+            log.warning("No significant yellow pixels detected in mask!")
             enhanced_prompt = f"{master_prompt} {prompt}.\n\n{shape_recognition}\n{precision_instructions}\n\n{contextual_examples}\n\n{example}\n\nIMPORTANT: Look carefully for ANY yellow doodle markings in this image, even rough or faint ones. Interpret these organic doodles as real objects that should fit naturally in this scene. Return only the edited image."
         else:
             enhanced_prompt = f"{master_prompt} {prompt}.\n\n{shape_recognition}\n{precision_instructions}\n\n{contextual_examples}\n\n{example}\n\nAnalyze the yellow doodle areas and create realistic objects that fit perfectly with the scene's context, style, and lighting. Return only the edited image."
         
-        print(f"Sending prompt to Gemini API: {enhanced_prompt}")
-        
-        # For debugging - save the masked image to see what we're sending
-        try:
-            debug_path = os.path.join(os.path.dirname(__file__), "debug_masked_image.png")
-            masked_image.save(debug_path)
-            print(f"Saved debug image to {debug_path}")
-        except Exception as save_err:
-            print(f"Error saving debug masked image: {save_err}")
-            debug_path = None
+        stages.mark('prompt')
+        if crop_box:
+            model_contents = [
+                enhanced_prompt + "\n\nThe first image is a close-up crop of the area to edit. Keep its exact framing and size, and return only the edited close-up.",
+                image_part(prepare_image(masked_image.crop(crop_box)), 'edit-image')
+            ]
+            if include_overview:
+                model_contents[0] += " The second image is a small view of the full picture, for context only."
+                model_contents.append(image_part(prepare_image(make_overview(masked_image, EDIT_OVERVIEW_MAX_SIDE or 512)), 'edit-image'))
+            enhanced_prompt = model_contents[0]
+        else:
+            model_contents = [enhanced_prompt, image_part(prepare_image(masked_image), 'edit-image')]
+        stages.mark('preprocess')
+
+        log.debug("Sending prompt to Gemini API: %s", enhanced_prompt)
         
         # Pass the combined image (with yellow mask) to the API
-        print(f"About to call Gemini API with model: {MODEL_ID}")
-        print(f"Enhanced prompt length: {len(enhanced_prompt)}")
-        print(f"Masked image size: {masked_image.size}")
+        log.debug("About to call Gemini API with model %s, prompt length %d, masked image size %s",
+                  MODEL_ID, len(enhanced_prompt), masked_image.size)
 
         try:
-            response = client.models.generate_content(
+            response = yield model_call(
                 model=MODEL_ID,
-                contents=[
-                    enhanced_prompt,
-                    masked_image
-                ],
-                config=types.GenerateContentConfig(
+                contents=model_contents,
+                config=genai_types().GenerateContentConfig(
                     response_modalities=['Image'],  # Request only image response
-                    temperature=0.3,  # Lower temperature for more consistent results
+                    temperature=temperature,
                     max_output_tokens=1024
                 )
             )
-            print("Gemini API call completed successfully")
+            stages.mark('model_call')
+            log.debug("Gemini API call completed successfully")
+        except UpstreamUnavailable as unavailable_err:
+            return upstream_unavailable(unavailable_err)
         except Exception as api_err:
-            print(f"Gemini API call failed: {api_err}")
-            return jsonify({'error': f'API call failed: {str(api_err)}'}), 500
+            log.error("Gemini API call failed: %s", api_err)
+            return {'error': f'API call failed: {str(api_err)}'}, 500
 
-        # Extract the edited image from response
-        print(f"Response received from Gemini API")
-        print(f"Response type: {type(response)}")
-        print(f"Response dir: {dir(response)}")
-        print(f"Response parts count: {len(response.parts) if hasattr(response, 'parts') else 'No parts attribute'}")
+        img_bytes, text_parts = model_output(response, 'edit-image')
+        stages.mark('extract')
+        if img_bytes is not None:
+            if crop_box:
+                img_bytes = composite_masked_edit(img_bytes, crop_box, masked_image, image_data)
+            elif restore:
+                img_bytes = restore_size(img_bytes, masked_image.size)
+            store_response(cache_key, img_bytes, {
+                'prompt_used': enhanced_prompt,
+                'text_responses': text_parts,
+                'crop_box': list(crop_box) if crop_box else None
+            })
 
-        # First check if we have any error information
-        error_message = None
-        text_parts = []
+            # Debug capture of the response bytes as returned, no decode/re-encode
+            debug_response_path = debug_capture.save(capture_id, 'response', img_bytes)
+            stages.mark('postprocess')
 
-        # Try to examine all parts of the response
-        try:
-            for i, part in enumerate(response.parts):
-                print(f"Examining part {i} of type {type(part)}")
-                print(f"Part {i} dir: {dir(part)}")
-                print(f"Part {i} attributes: {vars(part) if hasattr(part, '__dict__') else 'No __dict__'}")
-
-                # Check for text
-                if hasattr(part, 'text') and part.text:
-                    text = part.text
-                    text_parts.append(text)
-                    print(f"API returned text (part {i}): {text}")
-                    if 'error' in text.lower():
-                        error_message = text
-
-                # Check for image data - try multiple ways
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    print(f"Found inline_data in part {i}")
-                    blob = part.inline_data
-                    print(f"Blob type: {type(blob)}, dir: {dir(blob)}")
-                    print(f"Blob attributes: {vars(blob) if hasattr(blob, '__dict__') else 'No __dict__'}")
-
-                    if hasattr(blob, 'mime_type'):
-                        print(f"Mime type: {blob.mime_type}")
-
-                    if hasattr(blob, 'data'):
-                        print(f"Found data in blob, type: {type(blob.data)}")
-                        img_str = base64.b64encode(blob.data).decode()
-                        print("Successfully extracted and encoded image from response")
-
-                        # Debug - save the response image with timestamp
-                        try:
-                            timestamp = int(time.time())
-                            debug_dir = os.path.join(os.path.dirname(__file__), "debug")
-                            os.makedirs(debug_dir, exist_ok=True)
-
-                            img_data = base64.b64decode(img_str)
-                            img = Image.open(io.BytesIO(img_data))
-                            debug_response_path = os.path.join(debug_dir, f"response_image_{timestamp}.png")
-                            img.save(debug_response_path)
-                            print(f"Saved response image to {debug_response_path}")
-                        except Exception as save_err:
-                            print(f"Error saving response debug image: {save_err}")
-                            debug_response_path = None
-
-                        # Return successful response immediately
-                        return jsonify({
-                            'edited_image': f'data:image/png;base64,{img_str}',
-                            'prompt_used': enhanced_prompt,
-                            'text_responses': text_parts,
-                            'debug_info': {
-                                'masked_image_path': debug_path if 'debug_path' in locals() else None,
-                                'response_image_path': debug_response_path
-                            }
-                        })
-
-                # Try alternative ways to access image data
-                elif hasattr(part, 'blob') and part.blob:
-                    print(f"Found blob in part {i}")
-                    blob = part.blob
-                    if hasattr(blob, 'data'):
-                        print(f"Found data in blob, type: {type(blob.data)}")
-                        img_str = base64.b64encode(blob.data).decode()
-                        print("Successfully extracted and encoded image from blob")
-
-                        # Return successful response immediately
-                        return jsonify({
-                            'edited_image': f'data:image/png;base64,{img_str}',
-                            'prompt_used': enhanced_prompt,
-                            'text_responses': text_parts
-                        })
-
-                # Check for other possible image attributes
-                elif hasattr(part, 'image') and part.image:
-                    print(f"Found image in part {i}")
-                    image_obj = part.image
-                    print(f"Image object type: {type(image_obj)}")
-                    if hasattr(image_obj, 'data'):
-                        img_str = base64.b64encode(image_obj.data).decode()
-                        print("Successfully extracted and encoded image from image object")
-
-                        # Return successful response immediately
-                        return jsonify({
-                            'edited_image': f'data:image/png;base64,{img_str}',
-                            'prompt_used': enhanced_prompt,
-                            'text_responses': text_parts
-                        })
-                        
-                        # Return successful response immediately
-                        return jsonify({
-                            'edited_image': f'data:image/png;base64,{img_str}',
-                            'prompt_used': enhanced_prompt,
-                            'text_responses': text_parts,
-                            'debug_info': {
-                                'masked_image_path': debug_path if 'debug_path' in locals() else None,
-                                'response_image_path': debug_response_path
-                            }
-                        })
-        except Exception as part_err:
-            print(f"Error examining response parts: {part_err}")
-            import traceback
-            traceback.print_exc()
-        
+            return {
+                'edited_image': img_bytes,
+                'prompt_used': enhanced_prompt,
+                'text_responses': text_parts,
+                'crop_box': list(crop_box) if crop_box else None,
+                'debug_info': {
+                    'masked_image_path': debug_path,
+                    'response_image_path': debug_response_path
+                }
+            }, 200
+
+        error_message = next((text for text in text_parts if 'error' in text.lower()), None)
         if error_message:
-            return jsonify({'error': f'API error: {error_message}'}), 500
+            return {'error': f'API error: {error_message}'}, 500
 
         # If we get here, we didn't find an image in the response
-        print("No image found in API response")
-        print(f"All text responses: {text_parts}")
-        print(f"Response parts details:")
-        for i, part in enumerate(response.parts):
-            print(f"  Part {i}: {type(part)} - {getattr(part, 'text', 'No text')}")
+        log.warning("No image found in API response, text responses: %s", text_parts)
 
         # Try a fallback: if we have text responses, return them
         if text_parts:
-            return jsonify({
+            return {
                 'error': 'No image generated, but API returned text responses',
                 'text_responses': text_parts,
                 'prompt_used': enhanced_prompt
-            }), 500
+            }, 500
 
-        return jsonify({'error': 'No image generated in the response'}), 500
+        return {'error': 'No image generated in the response'}, 500
 
+    except UpstreamUnavailable as unavailable_err:
+        return upstream_unavailable(unavailable_err)
     except Exception as e:
-        print(f"Error in edit_image: {e}")
-        return jsonify({'error': str(e)}), 500
+        log.error("Error in edit_image: %s", e)
+        return {'error': str(e)}, 500
+
+# Operations shared by the synchronous routes and the job API
+OPERATION_STEPS = {
+    'generate': generate_steps,
+    'edit-whole': edit_whole_steps,
+    'blend-images': blend_images_steps,
+    'edit-image': edit_image_steps,
+}
+OPERATIONS = {name: lambda data, steps=steps: run_steps(steps(data)) for name, steps in OPERATION_STEPS.items()}
+
+# Identical concurrent requests share one upstream call. "file" coordinates
+# gunicorn workers through SINGLE_FLIGHT_DIR; "memory" is an in-process stand-in.
+SINGLE_FLIGHT_BACKEND = os.getenv('SINGLE_FLIGHT_BACKEND', 'process').lower()
+if SINGLE_FLIGHT_BACKEND == 'file':
+    single_flight_backend = FileBackend(os.getenv('SINGLE_FLIGHT_DIR', os.path.join(os.path.dirname(__file__), 'inflight')))
+elif SINGLE_FLIGHT_BACKEND == 'memory':
+    single_flight_backend = InMemoryBackend()
+else:
+    single_flight_backend = None
+single_flight = SingleFlight(single_flight_backend, wait_timeout=float(os.getenv('SINGLE_FLIGHT_WAIT_TIMEOUT', '300')))
+
+# A rate-limit rejection, overload or deadline answer concerns the caller that got
+# it (its client's bucket, its own deadline), so it is not handed to the requests
+# that coalesced with it; they make their own attempt
+CALLER_SPECIFIC_STATUSES = {429, 503, 504}
+
+def shareable_result(result):
+    return result[1] not in CALLER_SPECIFIC_STATUSES
+
+def coalesced(operation):
+    run_operation = OPERATIONS[operation]
+
+    def run(data):
+        # "coalesce": false opts a request out, e.g. when a fresh variant is wanted;
+        # profiled requests always make their own call so the profile shows the real work
+        if not request_flag(data, 'coalesce', True) or tracing.profiling():
+            return run_operation(data)
+        key = request_fingerprint(operation, data, MODEL_ID)
+        return single_flight.do(key, lambda: run_operation(data), shareable_result)
+
+    return run
+
+def resolve_images(data):
+    """Decode, check and store inline images, and load "<field>_id" ones.
+
+    Returns (data, input_ids, error), where error is an (error payload,
+    status code) response for a bad or unknown image, else None.
+    """
+    data = dict(data)
+    input_ids = {}
+    for field in IMAGE_INPUT_FIELDS:
+        if data.get(field):
+            if not isinstance(data[field], (str, bytes, bytearray, memoryview)):
+                return data, input_ids, ({'error': f'{field} must be a base64 string or {field}_id', 'field': field}, 400)
+            try:
+                data[field] = image_bytes(data[field])
+                intake.probe(data[field])
+            except IntakeError as intake_err:
+                return data, input_ids, ({'error': f'{intake_err} (in {field})', 'field': field}, intake_err.status_code)
+            except ValueError as decode_err:
+                return data, input_ids, ({'error': f'Image decode error in {field}: {decode_err}'}, 400)
+            input_ids[field] = image_store.put(data[field])
+        elif data.get(f'{field}_id'):
+            image_id = data[f'{field}_id']
+            stored = image_store.get(image_id)
+            if stored is None:
+                # The client still has the image and can resend it inline
+                return data, input_ids, ({'error': f'Unknown or expired {field}_id, send the image again',
+                                          'missing_image_id': image_id, 'field': field}, 404)
+            data[field] = stored
+            input_ids[field] = image_id
+    return data, input_ids, None
+
+def store_result_images(data, input_ids, payload, status_code):
+    if status_code >= 400:
+        return payload, status_code
+    return_image = request_flag(data, 'return_image', True)
+    result = {}
+    for key, value in payload.items():
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            result[f'{key}_id'] = image_store.put(value)
+            if not return_image:
+                continue
+        result[key] = value
+    if input_ids:
+        result['input_ids'] = input_ids
+    return result, status_code
+
+def stored_images(run_operation):
+    """Resolve "<field>_id" inputs from the image store and add ids to the result.
+
+    Inline images are decoded once here, checked by their header (format,
+    dimensions) and stored, so later requests can refer to them; the result
+    gets "<field>_id" for each image it returns and "input_ids" for the
+    images it was given. "return_image": false leaves the image bytes out of
+    the result, for clients that only chain by id.
+    """
+    def run(data):
+        data, input_ids, error = resolve_images(data)
+        if error:
+            return error
+        return store_result_images(data, input_ids, *run_operation(data))
+
+    return run
+
+def unexpired(run_operation, operation):
+    # Work that waited in a queue past its request's deadline has no one left to receive it
+    def run(data):
+        if deadlines.expired():
+            DEADLINE_DROPPED.inc(operation=operation)
+            log.info("Dropping %s, its request deadline passed while it was queued", operation)
+            return {'error': 'Request deadline passed before it could start'}, 504
+        return run_operation(data)
+
+    return run
+
+def runner(operation):
+    # Shared by the job pool and batches: deadline check, stored images, then coalescing
+    return unexpired(stored_images(coalesced(operation)), operation)
+
+# Admin-only cProfile capture of single requests (X-Admin-Token plus X-Profile: 1)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(__file__), 'profiles'))
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING', 'true').lower() == 'true'
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Model calls run on a bounded background pool instead of the request thread
+job_manager = JobManager(
+    {name: tracing.profiled(runner(name), PROFILE_DIR) for name in OPERATIONS},
+    max_workers=int(os.getenv('JOB_WORKERS', '4')),
+    max_pending=int(os.getenv('JOB_MAX_PENDING', '32')),
+    result_ttl=int(os.getenv('JOB_RESULT_TTL', '600')),
+)
+JOB_RETRY_AFTER = os.getenv('JOB_RETRY_AFTER', '5')
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', '5'))
+
+def server_busy(err):
+    log.warning("Rejecting request, job queue full: %s", err)
+    response = jsonify({'error': 'Server is busy, please retry shortly'})
+    response.headers['Retry-After'] = JOB_RETRY_AFTER
+    return response, 503
+
+# Result encoding: transcodes ("format"/"quality") and "preview" variants run in parallel here
+PREVIEW_MAX_SIDE = int(os.getenv('PREVIEW_MAX_SIDE', '384'))
+encode_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ENCODE_WORKERS', '4')), thread_name_prefix='encode')
+
+def requested_output(data):
+    return output_options(request, data, PREVIEW_MAX_SIDE)
+
+# Field that receives the body when a route is called with a raw image/* upload
+RAW_IMAGE_FIELDS = {
+    'generate': None,
+    'edit-whole': 'image',
+    'blend-images': 'baseImage',
+    'edit-image': 'mask',
+}
+
+def operation_response(payload, status_code, image_format=None, output=None):
+    # Encode image bytes only here, as a raw body or as data URLs in JSON
+    if image_format and status_code < 400 and has_image(payload):
+        return image_response(payload, image_format, status_code, output)
+    response = jsonify(json_payload(payload, output, encode_executor))
+    if 'retry_after' in payload:
+        response.headers['Retry-After'] = str(payload['retry_after'])
+    return response, status_code
+
+def release_encoded_images(data):
+    # Swap base64 strings for their (25% smaller) bytes now, so the request
+    # does not hold both for its whole lifetime
+    for field in IMAGE_INPUT_FIELDS:
+        if isinstance(data.get(field), str):
+            try:
+                data[field] = image_bytes(data[field])
+            except ValueError:
+                pass  # Reported with the field name by stored_images()
+    return data
+
+# Set by asgi.py on requests whose operation already ran on its event loop
+ASYNC_RESULT_KEY = 'nano_banana.async_result'
+ASYNC_TRACE_KEY = 'nano_banana.trace'
+ASYNC_STARTED_KEY = 'nano_banana.started'
+
+def run_sync(operation):
+    # Synchronous routes submit a job and wait for it, so they share the pool's limits.
+    # Under asgi.py the operation has already run and only the response is built here
+    prepared = request.environ.get(ASYNC_RESULT_KEY)
+    deadline = None
+    if prepared:
+        data, outcome = prepared
+    else:
+        deadline = request_deadline(request, operation)
+        rejected = overloaded(operation, deadline) or rate_limited(request, operation)
+        if rejected:
+            return operation_response(*rejected)
+        data = release_encoded_images(parse_request_data(request, RAW_IMAGE_FIELDS[operation]))
+        outcome = lambda: job_manager.run(operation, data, deadlines.remaining(deadline) if deadline else None)
+    image_format = requested_image_format(request, data)
+    output = requested_output(data)
+    # The job copies this context, so its upstream call is queued under the client's
+    # flow and bounded by the request's deadline
+    flow_token = set_flow(request_flow(request, operation))
+    deadline_token = deadlines.set_deadline(deadline)
+    try:
+        payload, status_code = outcome()
+    except JobQueueFull as err:
+        refund_rate(request, operation)
+        return server_busy(err)
+    finally:
+        deadlines.reset_deadline(deadline_token)
+        reset_flow(flow_token)
+    stages = stage_timer(operation)
+    response = operation_response(payload, status_code, image_format, output)
+    stages.mark('encode')
+    return response
+
+@api.route('/generate', methods=['POST'])
+def generate_image():
+    return run_sync('generate')
+
+@api.route('/edit-whole', methods=['POST'])
+def edit_whole_image():
+    return run_sync('edit-whole')
+
+@api.route('/blend-images', methods=['POST'])
+def blend_images():
+    return run_sync('blend-images')
+
+@api.route('/edit-image', methods=['POST'])
+def edit_image():
+    return run_sync('edit-image')
+
+# Asynchronous job API: submit returns immediately, then poll or subscribe
+@api.route('/jobs/<operation>', methods=['POST'])
+def submit_job(operation):
+    if operation not in OPERATIONS:
+        return jsonify({'error': f'Unknown operation: {operation}', 'operations': list(OPERATIONS)}), 404
+    deadline = request_deadline(request, operation, use_default=False)
+    rejected = overloaded(operation, deadline) or rate_limited(request, operation)
+    if rejected:
+        return operation_response(*rejected)
+    flow_token = set_flow(request_flow(request, operation))
+    deadline_token = deadlines.set_deadline(deadline)
+    try:
+        job = job_manager.submit(operation, release_encoded_images(parse_request_data(request, RAW_IMAGE_FIELDS.get(operation))))
+    except JobQueueFull as err:
+        refund_rate(request, operation)
+        return server_busy(err)
+    finally:
+        deadlines.reset_deadline(deadline_token)
+        reset_flow(flow_token)
+
+    log.info("Queued job %s for %s", job.id, operation)
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/jobs/{job.id}',
+        'events_url': f'/jobs/{job.id}/events'
+    }), 202
+
+def job_info(job, include_result=True, output=None):
+    info = job.to_dict(include_result)
+    if info.get('result'):
+        info['result'] = json_payload(info['result'], output, encode_executor)
+    return info
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    # Finished jobs can hand back their image as a raw body (?response=image),
+    # or in another format or with a preview (?format=webp&preview=true)
+    image_format = requested_image_format(request, {})
+    output = requested_output({})
+    if job.done and image_format:
+        return operation_response(job.result, job.status_code, image_format, output)
+    return jsonify(job_info(job, output=output))
+
+@api.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+
+    def stream():
+        status = job.status
+        yield f"event: status\ndata: {json.dumps(job_info(job, include_result=False))}\n\n"
+        while not job.wait(SSE_KEEPALIVE_SECONDS):
+            if job.status != status:
+                status = job.status
+                yield f"event: status\ndata: {json.dumps(job_info(job, include_result=False))}\n\n"
+            else:
+                yield ": keepalive\n\n"
+        yield f"event: complete\ndata: {json.dumps(job_info(job))}\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api.route('/jobs', methods=['GET'])
+def jobs_stats():
+    return jsonify(job_manager.stats())
+
+# Batch generation: N items fanned out over a bounded pool, streamed back as NDJSON
+BATCH_OPERATIONS = ('generate', 'edit-whole')
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '100'))
+BATCH_MAX_IN_FLIGHT = int(os.getenv('BATCH_MAX_IN_FLIGHT', '4'))
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BATCH_WORKERS', '8')), thread_name_prefix='batch')
+
+@api.route('/batch/<operation>', methods=['POST'])
+def run_batch(operation):
+    if operation not in BATCH_OPERATIONS:
+        return jsonify({'error': f'Batch is not supported for {operation}', 'operations': list(BATCH_OPERATIONS)}), 404
+    deadline = request_deadline(request, operation, use_default=False)
+    shed = overloaded(operation, deadline)
+    if shed:
+        return operation_response(*shed)
+    body = request.get_json(silent=True) or {}
+    try:
+        items = expand_items(body, BATCH_MAX_ITEMS)
+    except BatchError as err:
+        return jsonify({'error': str(err)}), 400
+
+    log.info("Starting batch %s with %d items", operation, len(items))
+    # Items already run in parallel, so each line is encoded on its own thread
+    output = requested_output(body)
+    # Batch items are bulk traffic: each waits for its cost in the client's bucket
+    # before it starts, and its upstream call is queued under a lighter flow
+    client = client_identity(request)
+    cost = ROUTE_COSTS.get(operation, 1.0)
+    throttle = (lambda item: rate_limiter.reserve(client, cost)) if RATE_LIMIT_ENABLED else None
+    run_item = deadlines.with_deadline(with_flow(runner(operation), request_flow(request, operation, bulk=True)), deadline)
+    lines = stream_batch(batch_executor, run_item, items, lambda payload: json_payload(payload, output),
+                         BATCH_MAX_IN_FLIGHT, throttle)
+    return Response(lines, mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Variants: one prompt at several temperatures at once, each candidate streamed
+# back as an NDJSON line as it arrives. Every variant is a full model call, so
+# their number is capped and each counts against the client's rate limit
+VARIANTS_MAX = int(os.getenv('VARIANTS_MAX', '4'))
+VARIANT_TEMPERATURES = [float(t) for t in os.getenv('VARIANT_TEMPERATURES', '0.7,1.0,0.4,1.3').split(',')]
+
+@api.route('/generate/variants', methods=['POST'])
+def generate_variants():
+    data = parse_request_data(request, RAW_IMAGE_FIELDS['generate'])
+    temperatures = data.get('temperatures') or VARIANT_TEMPERATURES
+    try:
+        count = int(data.get('n_variants', len(temperatures)))
+        temperatures = [request_temperature(t) for t in temperatures]
+    except (TypeError, ValueError):
+        return jsonify({'error': '"n_variants" must be a number and "temperatures" a list of numbers'}), 400
+    if not 1 <= count <= min(VARIANTS_MAX, len(temperatures)):
+        return jsonify({'error': f'"n_variants" must be between 1 and {min(VARIANTS_MAX, len(temperatures))}'}), 400
+    if not data.get('prompt'):
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    deadline = request_deadline(request, 'generate')
+    rejected = overloaded('generate', deadline) or rate_limited(request, 'generate', count)
+    if rejected:
+        return operation_response(*rejected)
+    items = [{**data, 'temperature': temperature} for temperature in temperatures[:count]]
+    run_generate = deadlines.with_deadline(with_flow(runner('generate'), request_flow(request, 'generate')), deadline)
+
+    def run_variant(item):
+        payload, status_code = run_generate(item)
+        return {**payload, 'temperature': item['temperature']}, status_code
+
+    output = requested_output(data)
+    lines = stream_batch(batch_executor, run_variant, items, lambda payload: json_payload(payload, output), count)
+    return Response(lines, mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Pipelines: steps run one after another on the previous step's stored result,
+# each streamed back as an NDJSON line when it finishes
+PIPELINE_MAX_STEPS = int(os.getenv('PIPELINE_MAX_STEPS', '8'))
+
+@api.route('/pipeline', methods=['POST'])
+def run_pipeline():
+    body = request.get_json(silent=True) or {}
+    try:
+        steps = expand_steps(body, PIPELINE_MAX_STEPS)
+    except PipelineError as err:
+        return jsonify({'error': str(err)}), 400
+    # Like a batch, the whole chain only has a deadline when the client asks for one
+    deadline = request_deadline(request, 'pipeline', use_default=False)
+    first = steps[0][0]
+    rejected = overloaded(first, deadline) or rate_limited(request, first)
+    if rejected:
+        return operation_response(*rejected)
+
+    log.info("Starting pipeline: %s", ' -> '.join(operation for operation, _ in steps))
+    output = requested_output(body)
+    # Later steps are part of a request already admitted, so they wait for
+    # their cost in the client's bucket instead of failing halfway
+    client = client_identity(request)
+    throttle = (lambda operation: rate_limiter.reserve(client, ROUTE_COSTS.get(operation, 1.0))) if RATE_LIMIT_ENABLED else None
+    flows = {operation: request_flow(request, operation) for operation, _ in steps}
+
+    def run_step(operation, data):
+        # Steps go through the job pool like the synchronous routes; the stream
+        # runs after the handler returned, so flow and deadline are set here
+        flow_token = set_flow(flows[operation])
+        deadline_token = deadlines.set_deadline(deadline)
+        try:
+            return job_manager.run(operation, release_encoded_images(data), deadlines.remaining(deadline) if deadline else None)
+        except JobQueueFull as err:
+            log.warning("Pipeline step %s rejected, job queue full: %s", operation, err)
+            if RATE_LIMIT_ENABLED:
+                rate_limiter.refund(client, ROUTE_COSTS.get(operation, 1.0))
+            return {'error': 'Server is busy, please retry shortly', 'retry_after': int(JOB_RETRY_AFTER)}, 503
+        finally:
+            deadlines.reset_deadline(deadline_token)
+            reset_flow(flow_token)
+
+    lines = stream_pipeline(steps, run_step, lambda payload: json_payload(payload, output, encode_executor), throttle)
+    return Response(lines, mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Request tracing: id for log lines, stage timings for Server-Timing, optional profile
+def is_admin():
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@api.before_app_request
+def start_trace():
+    trace = request.environ.get(ASYNC_TRACE_KEY)
+    if trace:
+        g.trace = trace  # started and finished by asgi.py
+        return
+    request_id = request.headers.get('X-Request-ID', '')
+    profile = request_flag(request.headers, 'X-Profile', False) or request_flag(request.args, 'profile', False)
+    if profile and not is_admin():
+        log.warning("Ignoring profile request without a valid admin token")
+        profile = False
+    g.trace, g.trace_token = tracing.start(request_id if REQUEST_ID_PATTERN.match(request_id) else None, profile)
+
+@api.after_app_request
+def add_trace_headers(response):
+    trace = g.get('trace')
+    if trace:
+        response.headers['X-Request-ID'] = trace.request_id
+        if SERVER_TIMING_ENABLED:
+            response.headers['Server-Timing'] = trace.server_timing()
+        if trace.profile_path:
+            response.headers['X-Profile'] = f'/debug/profiles/{trace.request_id}'
+    return response
+
+@api.teardown_app_request
+def finish_trace(error=None):
+    if 'trace_token' in g:
+        tracing.finish(g.pop('trace_token'))
+
+# Per-route request metrics; streamed responses are timed up to the first byte
+def metrics_route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@api.before_app_request
+def start_request_metrics():
+    g.metrics_started = request.environ.get(ASYNC_STARTED_KEY) or time.perf_counter()
+    g.metrics_route = metrics_route()
+    REQUESTS_IN_FLIGHT.inc(route=g.metrics_route)
+    if request.content_length:
+        REQUEST_BYTES.observe(request.content_length, route=g.metrics_route)
+
+@api.after_app_request
+def record_request_metrics(response):
+    route = g.get('metrics_route', metrics_route())
+    if 'metrics_started' in g:
+        REQUEST_LATENCY.observe(time.perf_counter() - g.metrics_started,
+                                route=route, method=request.method, status=response.status_code)
+    if not response.is_streamed:
+        RESPONSE_BYTES.observe(response.calculate_content_length() or 0, route=route)
+    return response
+
+@api.teardown_app_request
+def finish_request_metrics(error=None):
+    if 'metrics_route' in g:
+        REQUESTS_IN_FLIGHT.dec(route=g.pop('metrics_route'))
+
+COMPONENT_STATS = metrics.gauge('nano_banana_component_stat', 'Numeric stats reported by internal components', ['component', 'stat'])
+
+def collect_component_metrics():
+    # Copy the numeric fields of each component's stats() at scrape time
+    components = {
+        'response_cache': response_cache.stats(),
+        'image_store': image_store.stats(),
+        'upstream': gemini.stats(),
+        'rate_limit': rate_limiter.stats(),
+        'jobs': job_manager.stats(),
+        'single_flight': single_flight.stats(),
+        'debug_capture': debug_capture.stats(),
+    }
+    for component, stats in components.items():
+        for name, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                COMPONENT_STATS.set(value, component=component, stat=name)
+
+metrics.add_collector(collect_component_metrics)
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@api.app_errorhandler(413)
+def request_too_large(err):
+    return jsonify({
+        'error': 'Request body is too large',
+        'max_content_length': current_app.config['MAX_CONTENT_LENGTH']
+    }), 413
 
 # Health check endpoint for Render
-@app.route('/health', methods=['GET'])
+@api.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'message': 'Nano-Banana API is running'})
 
+# Upstream client, coalescing and rate-limit counters
+@api.route('/upstream/stats', methods=['GET'])
+def upstream_stats():
+    return jsonify({**gemini.stats(), 'single_flight': single_flight.stats(), 'rate_limit': rate_limiter.stats()})
+
+# Image store: upload once, then reference by id; results can be fetched by id too
+@api.route('/images', methods=['POST'])
+def upload_image():
+    data = parse_request_data(request, 'image')
+    if not data.get('image'):
+        return jsonify({'error': 'No image provided'}), 400
+    try:
+        image = image_bytes(data.pop('image'))
+        intake.probe(image)
+        image_id = image_store.put(image)
+    except IntakeError as intake_err:
+        return jsonify({'error': str(intake_err)}), intake_err.status_code
+    except ValueError as decode_err:
+        return jsonify({'error': f'Image decode error: {decode_err}'}), 400
+    return jsonify({'image_id': image_id}), 201
+
+@api.route('/images/<image_id>', methods=['GET'])
+def get_image(image_id):
+    data = image_store.get(image_id)
+    if data is None:
+        return jsonify({'error': 'Image not found or expired'}), 404
+    response = Response(data, mimetype=sniff_image_type(data))
+    # Ids are content hashes, so the bytes behind an id never change
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@api.route('/images/stats', methods=['GET'])
+def image_store_stats():
+    return jsonify(image_store.stats())
+
+@api.route('/debug/profiles/<request_id>', methods=['GET'])
+def download_profile(request_id):
+    if not is_admin():
+        return jsonify({'error': 'Admin token required'}), 403
+    path = os.path.join(PROFILE_DIR, f'{request_id}.prof')
+    if not REQUEST_ID_PATTERN.match(request_id) or not os.path.exists(path):
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True)
+
+@api.route('/debug/stats', methods=['GET'])
+def debug_stats():
+    return jsonify(debug_capture.stats())
+
+# Response cache hit/miss counters
+@api.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'enabled': RESPONSE_CACHE_ENABLED, **response_cache.stats()})
+
 # Root endpoint
-@app.route('/', methods=['GET'])
+@api.route('/', methods=['GET'])
 def root():
     return jsonify({
         'message': 'Nano-Banana AI Image Editor API',
         'version': '1.0',
-        'endpoints': ['/generate', '/edit-image', '/edit-whole', '/blend-images', '/health']
+        'endpoints': ['/generate', '/generate/variants', '/edit-image', '/edit-whole', '/blend-images', '/jobs/<operation>', '/jobs/<job_id>', '/jobs/<job_id>/events', '/batch/generate', '/batch/edit-whole', '/pipeline', '/health', '/cache/stats', '/debug/stats', '/upstream/stats', '/metrics', '/images', '/images/<image_id>', '/images/stats', '/debug/profiles/<request_id>']
     })
 
+def configure_cors(flask_app):
+    from flask_cors import CORS
+
+    if os.getenv('ENVIRONMENT') == 'production':
+        # In production, allow your frontend domain and common development origins
+        allowed_origins = [
+            "https://nano-banana-frontend.onrender.com",
+            "https://nano-banana-ai-editor-frontend.onrender.com", 
+            "https://nano-banana.onrender.com",
+            os.getenv('FRONTEND_URL', 'https://nano-banana-ai-editor.onrender.com')
+        ]
+        # Remove None values and duplicates
+        allowed_origins = list(set([origin for origin in allowed_origins if origin and 'your-frontend-app' not in origin]))
+        CORS(flask_app, origins=allowed_origins, expose_headers=EXPOSE_HEADERS)
+        log.info("CORS configured for production with origins: %s", allowed_origins)
+    else:
+        # In development, allow all origins
+        CORS(flask_app, expose_headers=EXPOSE_HEADERS)
+        log.info("CORS configured for development (all origins allowed)")
+
+def create_app(config=None):
+    """Build the Flask app; `config` overrides Flask settings.
+
+    Components (model client, caches, pools) are module-level and shared by
+    every app built here. None of them starts a thread or opens a connection
+    until it is used, so the module can be imported by a gunicorn --preload
+    master and forked into workers.
+    """
+    flask_app = Flask(__name__)
+    flask_app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    flask_app.config.update(config or {})
+    configure_cors(flask_app)
+    flask_app.register_blueprint(api)
+    return flask_app
+
+def warm_up():
+    """Import the SDK, build the client and open its connection pool."""
+    started = time.perf_counter()
+    genai_types()
+    gemini.warm_up(MODEL_ID)
+    return time.perf_counter() - started
+
+def start_warm_up():
+    """Run warm_up() on a background thread if UPSTREAM_WARM_UP is set.
+
+    Called once per worker process after it starts (gunicorn.conf.py), never
+    before a fork. Requests arriving meanwhile just wait for the client.
+    """
+    if not UPSTREAM_WARM_UP or not gemini.configured:
+        return None
+    thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug_mode = os.getenv('ENVIRONMENT') != 'production'
+    start_warm_up()
     app.run(host='0.0.0.0', port=port, debug=debug_mode)
\ No newline at end of file
@@ -0,0 +1,311 @@
+"""ASGI entry point: model calls are awaited on an event loop, not held by threads.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
+
+POST /generate, /edit-whole, /blend-images and /edit-image run their steps
+(see app.run_steps) with the CPU-bound parts - parsing, decoding, Pillow and
+NumPy work - on a thread pool, and await the model call through the SDK's
+async client. While a call is in flight the request holds no thread, so
+one process can keep hundreds open (GEMINI_MAX_ASYNC_CONCURRENCY) for the
+memory of a few coroutines each.
+
+The response itself is still built by the Flask app, so headers, CORS,
+metrics, error handling and the JSON/raw encodings are the same as under
+`gunicorn app:app`, and every other route is the Flask app served on a
+thread pool. Identical concurrent requests are coalesced within the
+process only, and admin profiling does not apply to the async operations.
+"""
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wrappers import Request
+
+import app as backend
+import tracing
+from deadlines import remaining, reset_deadline, set_deadline
+from fair_queue import reset_flow, set_flow
+from jobs import JobQueueFull
+from payloads import parse_request_data
+from single_flight import request_fingerprint
+
+log = logging.getLogger(__name__)
+
+ASYNC_ROUTES = {f'/{operation}': operation for operation in backend.OPERATION_STEPS}
+MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', '512'))
+
+# CPU stages of the async operations; the Flask fallback has its own pool since
+# its handlers may block (SSE streams wait on jobs)
+cpu_pool = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_CPU_WORKERS', str(min(32, (os.cpu_count() or 1) + 4)))),
+                              thread_name_prefix='asgi-cpu')
+wsgi_pool = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_WSGI_THREADS', '32')), thread_name_prefix='asgi-wsgi')
+
+_in_flight = 0
+_coalesced = {}  # request fingerprint -> task of the call everyone is waiting on
+
+
+async def in_thread(executor, fn, *args):
+    # Copy the context so stage timings still land in the request's trace
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, fn, *args)
+
+
+def _advance(steps, method, value):
+    # StopIteration cannot be raised into a Future, so completion is returned as a flag
+    try:
+        return False, getattr(steps, method)(value)
+    except StopIteration as done:
+        return True, done.value
+
+
+async def call_models_async(calls):
+    """Async twin of app.call_models: the calls awaited together, EDIT_TILE_CONCURRENCY at a time."""
+    limit = asyncio.Semaphore(max(1, backend.EDIT_TILE_CONCURRENCY))
+
+    async def call(kwargs):
+        async with limit:
+            return await backend.gemini.generate_content_async(**kwargs)
+
+    tasks = [asyncio.ensure_future(call(kwargs)) for kwargs in calls]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run_steps_async(steps):
+    """Async twin of app.run_steps: CPU steps on the pool, model calls awaited."""
+    finished, value = await in_thread(cpu_pool, _advance, steps, 'send', None)
+    while not finished:
+        try:
+            if isinstance(value, list):
+                response = await call_models_async(value)
+            else:
+                response = await backend.gemini.generate_content_async(**value)
+        except Exception as err:
+            finished, value = await in_thread(cpu_pool, _advance, steps, 'throw', err)
+        else:
+            finished, value = await in_thread(cpu_pool, _advance, steps, 'send', response)
+    return value
+
+
+async def coalesced(operation, data):
+    steps = backend.OPERATION_STEPS[operation]
+    if not backend.request_flag(data, 'coalesce', True):
+        return await run_steps_async(steps(data))
+    key = await in_thread(cpu_pool, request_fingerprint, operation, data, backend.MODEL_ID)
+    while True:
+        task = _coalesced.get(key)
+        leader = task is None or task.done()
+        if leader:
+            task = asyncio.ensure_future(run_steps_async(steps(data)))
+            _coalesced[key] = task
+            task.add_done_callback(lambda done: _coalesced.pop(key, None) if _coalesced.get(key) is done else None)
+        # Shielded so one waiter going away does not cancel the call for the others
+        result = await asyncio.shield(task)
+        # The leader's rate-limit, overload or deadline answer is not the followers' to get
+        if leader or backend.shareable_result(result):
+            return result
+
+
+async def run_operation(operation, data):
+    """Same pipeline as app.runner(): image store, coalescing, then the steps."""
+    data, input_ids, error = await in_thread(cpu_pool, backend.resolve_images, data)
+    if error:
+        return error
+    try:
+        # Stop waiting at the request's deadline; a coalesced call others wait on goes on
+        payload, status_code = await asyncio.wait_for(coalesced(operation, data), remaining())
+    except asyncio.TimeoutError:
+        return {'error': f'{operation} did not finish before the request deadline'}, 504
+    return await in_thread(cpu_pool, backend.store_result_images, data, input_ids, payload, status_code)
+
+
+def parse_operation_request(request, operation):
+    data = parse_request_data(request, backend.RAW_IMAGE_FIELDS[operation])
+    return backend.release_encoded_images(data)
+
+
+async def serve_operation(environ, operation, send):
+    global _in_flight
+    request_id = environ.get('HTTP_X_REQUEST_ID', '')
+    trace, token = tracing.start(request_id if backend.REQUEST_ID_PATTERN.match(request_id) else None)
+    environ[backend.ASYNC_TRACE_KEY] = trace
+    environ[backend.ASYNC_STARTED_KEY] = time.perf_counter()
+    route = environ['PATH_INFO']
+    request = Request(environ)
+    # Upstream calls made for this request are queued under the client's flow
+    # and bounded by its deadline
+    deadline = backend.request_deadline(request, operation)
+    flow_token = set_flow(backend.request_flow(request, operation))
+    deadline_token = set_deadline(deadline)
+    # Flask's hooks count the request again while it builds the response
+    backend.REQUESTS_IN_FLIGHT.inc(route=route)
+    try:
+        try:
+            rejected = (backend.overloaded(operation, deadline, asynchronous=True)
+                        or backend.rate_limited(request, operation))
+            data = {} if rejected else await in_thread(cpu_pool, parse_operation_request, request, operation)
+            # The body is parsed, drop it before the long wait
+            environ['wsgi.input'] = io.BytesIO()
+            del request
+
+            if rejected:
+                outcome = lambda: rejected
+            elif _in_flight >= MAX_IN_FLIGHT:
+                def outcome():
+                    raise JobQueueFull(f"{_in_flight} async requests already in flight")
+            else:
+                _in_flight += 1
+                try:
+                    result = await run_operation(operation, data)
+                except Exception as e:
+                    log.exception("Async %s raised: %s", operation, e)
+                    result = {'error': str(e)}, 500
+                finally:
+                    _in_flight -= 1
+                outcome = lambda: result
+        finally:
+            backend.REQUESTS_IN_FLIGHT.dec(route=route)
+
+        environ[backend.ASYNC_RESULT_KEY] = (data, outcome)
+        await serve_wsgi(environ, send, cpu_pool)
+    finally:
+        reset_deadline(deadline_token)
+        reset_flow(flow_token)
+        tracing.finish(token)
+
+
+async def serve_wsgi(environ, send, executor):
+    """Run the Flask app for `environ`, pulling each body chunk on `executor`."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def call_app():
+        body = backend.app(environ, start_response)
+        return body, iter(body)
+
+    body, chunks = await in_thread(executor, call_app)
+    done = object()
+    try:
+        # start_response may be deferred until the first chunk of a streamed body
+        chunk = await in_thread(executor, next, chunks, done)
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while chunk is not done:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await in_thread(executor, next, chunks, done)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(body, 'close'):
+            await in_thread(executor, body.close)
+
+
+async def read_body(receive, limit):
+    """Return (body, size); past `limit` the rest is read and discarded."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None, size
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size <= limit:
+            chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks), size
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in environ:
+                value = f"{environ[key]},{value}"
+        environ[key] = value
+    return environ
+
+
+async def warm_up():
+    # The sync warm-up imports the SDK and builds the client; the async client's
+    # connection pool belongs to this event loop, so it is opened here
+    await in_thread(cpu_pool, backend.warm_up)
+    await backend.gemini.warm_up_async(backend.MODEL_ID)
+
+
+async def lifespan(receive, send):
+    warm_up_task = None  # referenced here for as long as the server runs
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if backend.UPSTREAM_WARM_UP and backend.gemini.configured:
+                # In the background: the server accepts requests meanwhile
+                warm_up_task = asyncio.ensure_future(warm_up())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if warm_up_task and not warm_up_task.done():
+                warm_up_task.cancel()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    limit = backend.app.config['MAX_CONTENT_LENGTH']
+    declared = int(dict(scope['headers']).get(b'content-length', b'0') or 0)
+    if declared > limit:
+        # Flask answers with its usual 413 without reading the body
+        body, size = b'', declared
+    else:
+        body, size = await read_body(receive, limit)
+        if body is None:
+            return  # client went away
+    environ = wsgi_environ(scope, body)
+    environ['CONTENT_LENGTH'] = str(size)
+    del body
+
+    operation = ASYNC_ROUTES.get(scope['path']) if scope['method'] == 'POST' else None
+    if operation and size <= limit:
+        await serve_operation(environ, operation, send)
+    else:
+        await serve_wsgi(environ, send, wsgi_pool)
@@ -0,0 +1,104 @@
+"""Batch execution with NDJSON streaming.
+
+A batch request carries N items (prompts, or prompt+image pairs) for one
+operation. Items run concurrently on a shared, bounded pool - upstream
+calls are additionally capped by the Gemini client's global concurrency
+limit - and each result is streamed as one JSON line as soon as it
+completes, tagged with its index in the request.
+"""
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Request fields that fan out into one item per element
+FAN_OUT_FIELDS = {'prompts': 'prompt', 'images': 'image'}
+
+
+class BatchError(ValueError):
+    pass
+
+
+def expand_items(data, max_items):
+    """Turn a batch request into a list of per-item data dicts.
+
+    Accepts an explicit "items" list, or "prompts" and/or "images" lists
+    (zipped if both are given). Every other top-level field is shared by
+    all items unless an item overrides it.
+    """
+    shared = {key: value for key, value in data.items()
+              if key != 'items' and key not in FAN_OUT_FIELDS}
+
+    if 'items' in data:
+        items = data['items']
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise BatchError('"items" must be a list of objects')
+    else:
+        columns = {FAN_OUT_FIELDS[key]: value for key, value in data.items() if key in FAN_OUT_FIELDS}
+        if not columns:
+            raise BatchError('Provide "items", "prompts" or "images"')
+        if (not all(isinstance(values, list) for values in columns.values())
+                or len({len(values) for values in columns.values()}) != 1):
+            raise BatchError('"prompts" and "images" must be lists of the same length')
+        count = len(next(iter(columns.values())))
+        items = [{field: values[i] for field, values in columns.items()} for i in range(count)]
+
+    if not items:
+        raise BatchError('Batch is empty')
+    if len(items) > max_items:
+        raise BatchError(f'Batch has {len(items)} items, the limit is {max_items}')
+    return [{**shared, **item} for item in items]
+
+
+def stream_batch(executor, run_item, items, encode_payload, max_in_flight, throttle=None):
+    """Yield one NDJSON line per finished item, then a summary line.
+
+    At most `max_in_flight` items of this batch are submitted at a time so
+    one large batch cannot monopolise the shared pool. `throttle(item)`, if
+    given, returns 0 when the item may be submitted, else seconds to hold it
+    back before asking again (the wait happens here, not on a pool thread).
+    Unstarted items are cancelled if the client goes away.
+    """
+    started = time.time()
+    pending = {}
+    next_index = 0
+    not_before = None
+    failed = 0
+    try:
+        while next_index < len(items) or pending:
+            while next_index < len(items) and len(pending) < max_in_flight:
+                if not_before is not None and time.monotonic() < not_before:
+                    break
+                delay = throttle(items[next_index]) if throttle else 0
+                if delay:
+                    not_before = time.monotonic() + delay
+                    break
+                future = executor.submit(run_item, items[next_index])
+                pending[future] = next_index
+                next_index += 1
+                not_before = None
+
+            timeout = max(0.0, not_before - time.monotonic()) if not_before is not None else None
+            if not pending:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    payload, status_code = future.result()
+                except Exception as e:
+                    payload, status_code = {'error': str(e)}, 500
+                if status_code >= 400:
+                    failed += 1
+                line = {'index': index, 'status_code': status_code, **encode_payload(payload)}
+                yield json.dumps(line) + '\n'
+
+        yield json.dumps({
+            'done': True,
+            'count': len(items),
+            'failed': failed,
+            'elapsed': round(time.time() - started, 3),
+        }) + '\n'
+    finally:
+        for future in pending:
+            future.cancel()
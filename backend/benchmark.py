@@ -0,0 +1,415 @@
+"""Throughput and latency benchmark for the backend routes.
+
+Drives the Flask app in-process with a fake Gemini client (fake_gemini.py),
+so decode, mask analysis, preprocessing and encoding costs are measured
+without network access. For every route and payload size it reports
+p50/p95/p99 latency, throughput, CPU time, peak RSS and the peak memory
+allocated by a single request. Cold start is measured in fresh processes:
+the time to import the app, and the latency of the first and second
+requests (the first pays for anything loaded lazily).
+
+    python benchmark.py --requests 50 --concurrency 8 --sizes 512,1536 --latency 0.5
+    python benchmark.py --routes edit-image,edit-whole --latency 0 --output bench.json
+    python benchmark.py --baseline bench.json      # exit code 1 on regressions
+    python benchmark.py --record recordings/       # real API (GOOGLE_API_KEY), saves responses
+    python benchmark.py --replay recordings/       # replays them with injected latency/errors
+    python benchmark.py --routes health --startup-samples 10   # mostly cold start
+
+Each request uses a distinct prompt, so the response cache and request
+coalescing stay out of the way unless --cache is given; per-client rate
+limiting is off unless RATE_LIMIT_ENABLED is set. Pool sizes come
+from the usual environment variables (JOB_WORKERS, GEMINI_MAX_CONCURRENCY...).
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+ROUTES = ['generate', 'edit-whole', 'blend-images', 'edit-image',
+          'jobs-generate', 'batch-generate', 'batch-edit-whole', 'generate-variants', 'pipeline',
+          'images-upload', 'images-fetch', 'health', 'metrics']
+BATCH_SIZE = 4
+
+# Run in a fresh interpreter for each startup sample; prints its timings as JSON
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+from fake_gemini import FakeGeminiClient
+app.gemini.client = FakeGeminiClient()
+warm_up = app.warm_up() if app.UPSTREAM_WARM_UP else 0.0
+client = app.app.test_client()
+timings = []
+for index in range(2):
+    request_started = time.perf_counter()
+    client.post('/generate', json={'prompt': f'startup probe {index}'})
+    timings.append(time.perf_counter() - request_started)
+json.dump({'import_ms': (imported - started) * 1000, 'warm_up_ms': warm_up * 1000,
+           'first_request_ms': timings[0] * 1000, 'second_request_ms': timings[1] * 1000,
+           'modules': len(sys.modules)}, sys.stdout)
+"""
+STARTUP_METRICS = ('process_ms', 'import_ms', 'first_request_ms')
+
+
+def make_image(side, seed):
+    """Deterministic photo-like test image: gradients plus noise, 4:3."""
+    rng = np.random.default_rng(seed)
+    width, height = side, side * 3 // 4
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    pixels = (base + rng.integers(0, 24, size=(height, width, 3))).clip(0, 255).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+
+def add_doodle(image):
+    """Copy of `image` with a yellow doodle, like the mask the frontend sends."""
+    masked = image.copy()
+    width, height = masked.size
+    box = [width * 0.35, height * 0.3, width * 0.6, height * 0.55]
+    ImageDraw.Draw(masked).ellipse(box, outline=(255, 255, 0), width=max(4, width // 100))
+    return masked
+
+
+def data_url(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def make_payloads(side):
+    image = make_image(side, seed=side)
+    encoded = data_url(image)
+    return {
+        'image': encoded,
+        # Images are stored under the SHA-256 of their bytes (see image_store.py)
+        'image_id': hashlib.sha256(base64.b64decode(encoded.split(',', 1)[1])).hexdigest(),
+        'other': data_url(make_image(side, seed=side + 1)),
+        'mask': data_url(add_doodle(image)),
+    }
+
+
+def run_request(client, route, payloads, index):
+    """Send one request for `route` and return its HTTP status code."""
+    prompt = f"benchmark request {index}: add a small red balloon"
+    if route == 'generate':
+        return client.post('/generate', json={'prompt': prompt}).status_code
+    if route == 'edit-whole':
+        return client.post('/edit-whole', json={'prompt': prompt, 'image': payloads['image']}).status_code
+    if route == 'blend-images':
+        body = {'prompt': prompt, 'baseImage': payloads['image'], 'blendImage': payloads['other']}
+        return client.post('/blend-images', json=body).status_code
+    if route == 'edit-image':
+        body = {'prompt': prompt, 'image': payloads['image'], 'mask': payloads['mask']}
+        return client.post('/edit-image', json=body).status_code
+    if route == 'jobs-generate':
+        submitted = client.post('/jobs/generate', json={'prompt': prompt})
+        if submitted.status_code != 202:
+            return submitted.status_code
+        status_url = submitted.get_json()['status_url']
+        while True:
+            job = client.get(status_url).get_json()
+            if job['status'] in ('succeeded', 'failed'):
+                return job['status_code']
+            time.sleep(0.005)
+    if route.startswith('batch-') or route in ('generate-variants', 'pipeline'):
+        if route == 'generate-variants':
+            response = client.post('/generate/variants', json={'prompt': prompt, 'n_variants': BATCH_SIZE})
+        elif route == 'pipeline':
+            steps = [{'operation': 'edit-whole', 'prompt': f"{prompt} (step {i})"} for i in range(2)]
+            response = client.post('/pipeline', json={'image': payloads['image'], 'steps': steps})
+        else:
+            body = {'prompts': [f"{prompt} ({i})" for i in range(BATCH_SIZE)]}
+            if route == 'batch-edit-whole':
+                body['image'] = payloads['image']
+            response = client.post('/' + route.replace('-', '/', 1), json=body)
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        # Report the worst item so failed items show up as errors
+        return max([response.status_code] + [line['status_code'] for line in lines if 'status_code' in line])
+    if route == 'images-upload':
+        return client.post('/images', json={'image': payloads['image']}).status_code
+    if route == 'images-fetch':
+        response = client.get(f"/images/{payloads['image_id']}")
+        if response.status_code == 404:
+            # Evicted by the results of an earlier route; put it back and fetch again
+            client.post('/images', json={'image': payloads['image']})
+            response = client.get(f"/images/{payloads['image_id']}")
+        return response.status_code
+    if route in ('health', 'metrics'):
+        return client.get('/' + route).status_code
+    raise ValueError(f"Unknown route {route}")
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RssSampler:
+    """Samples resident memory in the background and keeps the peak."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+
+def request_peak_bytes(flask_app, route, payloads, samples):
+    """Largest peak of memory allocated while serving one request, alone.
+
+    tracemalloc sees Python objects, including request bodies, base64
+    strings, image bytes and NumPy arrays; Pillow's pixel buffers are
+    allocated outside it, and show up in the RSS figures instead.
+    """
+    client = flask_app.test_client()
+    peak = 0
+    for index in range(samples):
+        tracemalloc.start()
+        try:
+            run_request(client, route, payloads, f"memory {index}")
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return peak
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def bench_route(flask_app, route, payloads, requests, concurrency, warmup, memory_samples):
+    local = threading.local()
+
+    def one(index):
+        if not hasattr(local, 'client'):
+            local.client = flask_app.test_client()
+        started = time.perf_counter()
+        try:
+            status = run_request(local.client, route, payloads, index)
+        except Exception as e:
+            print(f"{route} request {index} raised: {e}", file=sys.stderr)
+            status = 599
+        return time.perf_counter() - started, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(-warmup, 0)))
+
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+        with RssSampler() as rss:
+            results = list(executor.map(one, range(requests)))
+        wall = time.perf_counter() - wall_started
+        cpu = time.process_time() - cpu_started
+
+    # Measured separately and sequentially: tracemalloc slows every allocation down
+    request_peak = request_peak_bytes(flask_app, route, payloads, memory_samples) if memory_samples else 0
+
+    latencies = sorted(latency for latency, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput_rps': requests / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_seconds': cpu,
+        'cpu_ms_per_request': cpu / requests * 1000,
+        'peak_rss_mb': rss.peak / 1024 ** 2,
+        'request_peak_mb': request_peak / 1024 ** 2,
+    }
+
+
+def measure_startup(samples):
+    """Median cold-start timings over `samples` fresh processes.
+
+    `process_ms` is the wall time of the whole probe, interpreter start-up
+    included. The environment is the benchmark's own (fake key, no cache).
+    """
+    runs = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        probe = subprocess.run([sys.executable, '-c', STARTUP_PROBE], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = time.perf_counter() - started
+        if probe.returncode != 0:
+            raise RuntimeError(f"Startup probe failed: {probe.stderr.strip()}")
+        runs.append({**json.loads(probe.stdout), 'process_ms': elapsed * 1000})
+    return {'samples': samples, **{key: statistics.median(run[key] for run in runs) for key in runs[0]}}
+
+
+def print_table(results):
+    header = (f"{'route':<18}{'size':>6}{'reqs':>6}{'err':>5}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              f"{'cpu ms/req':>11}{'rss MB':>8}{'req MB':>8}")
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['route']:<18}{result['size']:>6}{result['requests']:>6}{result['errors']:>5}"
+              f"{result['throughput_rps']:>8.1f}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+              f"{result['cpu_ms_per_request']:>11.1f}{result['peak_rss_mb']:>8.0f}{result['request_peak_mb']:>8.1f}")
+
+
+def find_regressions(results, baseline, tolerance):
+    previous = {(entry['route'], entry['size']): entry for entry in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['route'], result['size']))
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'cpu_ms_per_request', 'peak_rss_mb', 'request_peak_mb'):
+            # Baselines from older versions may not have every metric
+            if before.get(metric, 0) > 0 and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{result['route']} @ {result['size']}px: {metric} "
+                                   f"{before[metric]:.1f} -> {result[metric]:.1f}")
+    return regressions
+
+
+def find_startup_regressions(startup, baseline, tolerance):
+    before = baseline.get('startup') or {}
+    return [f"startup: {metric} {before[metric]:.1f} -> {startup[metric]:.1f}"
+            for metric in STARTUP_METRICS
+            if before.get(metric, 0) > 0 and startup[metric] > before[metric] * (1 + tolerance)]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma-separated routes to run')
+    parser.add_argument('--requests', type=int, default=20, help='measured requests per route and size')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured requests before each run')
+    parser.add_argument('--memory-samples', type=int, default=3,
+                        help='sequential requests traced for per-request peak memory (0 to skip)')
+    parser.add_argument('--startup-samples', type=int, default=3,
+                        help='fresh processes started to time cold start (0 to skip)')
+    parser.add_argument('--sizes', default='512,1024', help='comma-separated long-side sizes of input images')
+    parser.add_argument('--latency', type=float, default=0.2, help='fake upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='+/- seconds added to the latency')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of upstream calls in the slow tail')
+    parser.add_argument('--slow-factor', type=float, default=4.0, help='how many times slower tail calls are')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream calls that fail')
+    parser.add_argument('--error-codes', default='429,503', help='status codes of injected errors')
+    parser.add_argument('--replay', metavar='DIR', help='replay recorded responses from DIR')
+    parser.add_argument('--record', metavar='DIR', help='call the real API and record responses to DIR')
+    parser.add_argument('--cache', action='store_true', help='leave the response cache enabled')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with an earlier --output file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown vs the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    routes = [route for route in args.routes.split(',') if route]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        sys.exit(f"Unknown routes: {', '.join(sorted(unknown))} (choose from {', '.join(ROUTES)})")
+
+    # Configure the app before importing it
+    if not args.record:
+        os.environ['GOOGLE_API_KEY'] = 'benchmark'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('DEBUG_CAPTURE', 'false')
+    os.environ['RESPONSE_CACHE_ENABLED'] = 'true' if args.cache else 'false'
+    # Every request comes from one client, which would soon be over its rate
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    # Stored images go to a scratch directory, removed on exit, not into the app's tree
+    image_dir = tempfile.TemporaryDirectory(prefix='nano-banana-bench-')
+    os.environ.setdefault('IMAGE_STORE_DIR', image_dir.name)
+
+    import app as backend
+    from fake_gemini import FakeGeminiClient, RecordingClient
+
+    if args.record:
+        backend.gemini.client = RecordingClient(backend.gemini.client, args.record)
+    else:
+        backend.gemini.client = FakeGeminiClient(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+            slow_rate=args.slow_rate, slow_factor=args.slow_factor,
+            error_codes=[int(code) for code in args.error_codes.split(',')],
+            replay_dir=args.replay, seed=args.seed)
+
+    # Before anything runs here, so the probes compete with nothing
+    startup = measure_startup(args.startup_samples) if args.startup_samples else None
+    if startup:
+        print(f"startup: import {startup['import_ms']:.0f} ms, first request {startup['first_request_ms']:.0f} ms, "
+              f"second {startup['second_request_ms']:.0f} ms, process {startup['process_ms']:.0f} ms", file=sys.stderr)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        payloads = make_payloads(size)
+        for route in routes:
+            result = bench_route(backend.app, route, payloads, args.requests, args.concurrency, args.warmup,
+                                 args.memory_samples)
+            results.append({'route': route, 'size': size, **result})
+            print(f"{route} @ {size}px: p50 {result['p50_ms']:.1f} ms, {result['throughput_rps']:.1f} req/s",
+                  file=sys.stderr)
+
+    print_table(results)
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'results': results,
+        'startup': startup,
+    }
+    if hasattr(backend.gemini.client, 'stats'):
+        report['fake_upstream'] = backend.gemini.client.stats()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if startup:
+            regressions += find_startup_regressions(startup, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Request deadlines, carried to the work done on the request's behalf.
+
+A browser that gave up on a request does not tell the server, which would
+otherwise go on to queue for an upstream slot and pay for a model call
+whose result no one receives. Each request gets a deadline when it arrives
+(the client's X-Request-Timeout, else a per-route default), and everything
+downstream works against the time that is left: queued work past it is
+dropped before it starts, slot waits are cut short, and the upstream HTTP
+timeout of each model call is the remaining time.
+
+Like the fair-queue flow, the deadline of the current request is held in a
+context variable, so job and batch threads (which copy the request's
+context) see it. Deadlines are time.monotonic() values; None means none.
+"""
+import contextvars
+import time
+
+_current = contextvars.ContextVar('deadline', default=None)
+
+
+def after(seconds):
+    """The deadline `seconds` from now."""
+    return time.monotonic() + seconds
+
+
+def set_deadline(deadline):
+    """Make `deadline` current; returns a token for reset_deadline()."""
+    return _current.set(deadline)
+
+
+def reset_deadline(token):
+    _current.reset(token)
+
+
+def current_deadline():
+    return _current.get()
+
+
+def remaining(deadline=None):
+    """Seconds left until `deadline` (default: the current one), or None without one."""
+    deadline = deadline if deadline is not None else _current.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired(deadline=None):
+    left = remaining(deadline)
+    return left is not None and left <= 0
+
+
+def with_deadline(fn, deadline):
+    """Wrap `fn` so it runs with `deadline` current, e.g. on a pool thread."""
+
+    def run(*args, **kwargs):
+        token = _current.set(deadline)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
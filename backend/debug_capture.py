@@ -0,0 +1,140 @@
+"""Sampled, asynchronous capture of request images for debugging.
+
+Routes hand images to DebugCapture instead of saving them inline. A
+request is sampled once (so its input and output are captured together),
+writes go through a bounded queue to a single background thread and are
+dropped rather than blocking when the queue is full, and the capture
+directory is pruned to a maximum file count and total size.
+"""
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    b'\x89PNG': 'png',
+    b'\xff\xd8\xff': 'jpg',
+    b'RIFF': 'webp',
+}
+
+
+class DebugCapture:
+    def __init__(self, directory, enabled=False, sample_rate=1.0,
+                 max_files=200, max_bytes=200 * 1024 * 1024, queue_size=32):
+        self.directory = directory
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._counters = {'sampled': 0, 'written': 0, 'dropped': 0, 'errors': 0, 'pruned': 0}
+
+    def sample(self, label):
+        """Return a capture id for this request, or None if it is not sampled."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        with self._lock:
+            self._counters['sampled'] += 1
+        return f"{label}_{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+    def save(self, capture_id, name, image):
+        """Queue `image` (PIL image or encoded bytes) for writing.
+
+        Returns the path it will be written to, or None if the request is
+        not sampled or the writer is backed up. PIL images must not be
+        modified after being handed over.
+        """
+        if not capture_id:
+            return None
+        if isinstance(image, Image.Image):
+            extension = 'png'
+        else:
+            image = bytes(image)
+            extension = next((ext for magic, ext in EXTENSIONS.items() if image.startswith(magic)), 'bin')
+        path = os.path.join(self.directory, f"{capture_id}_{name}.{extension}")
+
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((path, image))
+        except queue.Full:
+            with self._lock:
+                self._counters['dropped'] += 1
+            return None
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'enabled': self.enabled,
+                'sample_rate': self.sample_rate,
+                'queued': self._queue.qsize(),
+            }
+
+    def flush(self, timeout=None):
+        """Wait until every queued capture has been written (used by tests/benchmarks)."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._writer, name='debug-capture', daemon=True)
+                self._thread.start()
+
+    def _writer(self):
+        while True:
+            path, image = self._queue.get()
+            try:
+                if isinstance(image, Image.Image):
+                    image.save(path, format='PNG', compress_level=1)
+                else:
+                    with open(path, 'wb') as f:
+                        f.write(image)
+                with self._lock:
+                    self._counters['written'] += 1
+                self._prune()
+            except Exception as write_err:
+                log.warning("Error writing debug capture %s: %s", path, write_err)
+                with self._lock:
+                    self._counters['errors'] += 1
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        """Delete the oldest captures beyond the file count and byte budgets."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _, size, path in entries:
+            if count <= self.max_files and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            count -= 1
+            total -= size
+            with self._lock:
+                self._counters['pruned'] += 1
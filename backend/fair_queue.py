@@ -0,0 +1,183 @@
+"""Weighted fair queueing of upstream model calls.
+
+When every upstream slot is busy, waiting calls are not served first come,
+first served: a client with fifty queued batch items would otherwise make
+an interactive user wait behind all of them. Each call belongs to a flow
+(the client, split into interactive and bulk traffic) with a weight, and
+carries a cost (a two-image blend costs more than a text-only generate).
+Freed slots go to the waiting call with the lowest virtual start tag
+(start-time fair queueing): flows get slots in proportion to their
+weights, whatever their queue length, and an idle flow is served at once.
+
+The flow of the current request is held in a context variable, so calls
+made on job and batch worker threads (which copy the request's context)
+are attributed to it, and work that only learns how many model calls it
+makes once it runs can charge them to the flow's `client`. Calls outside
+any request share a default flow.
+"""
+import asyncio
+import contextvars
+import itertools
+import threading
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Flow:
+    key: str
+    weight: float = 1.0
+    cost: float = 1.0
+    client: str = None  # rate-limit identity of the request, if any
+
+
+DEFAULT_FLOW = Flow('default')
+
+_current = contextvars.ContextVar('flow', default=DEFAULT_FLOW)
+
+
+def set_flow(flow):
+    """Make `flow` current; returns a token for reset_flow()."""
+    return _current.set(flow)
+
+
+def reset_flow(token):
+    _current.reset(token)
+
+
+def current_flow():
+    return _current.get()
+
+
+def with_flow(fn, flow):
+    """Wrap `fn` so it runs with `flow` current, e.g. on a pool thread."""
+
+    def run(*args, **kwargs):
+        token = _current.set(flow)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
+
+
+class _Waiter:
+    def __init__(self, flow, start_tag, seq, wake):
+        self.flow = flow
+        self.start_tag = start_tag
+        self.seq = seq
+        self.wake = wake
+        self.granted = False
+
+
+class FairQueue:
+    """`slots` concurrent holders; waiters are admitted in start-tag order."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiters = []
+        self._virtual_time = 0.0
+        self._finish_tags = {}  # flow key -> virtual finish tag of its last call
+        self._seq = itertools.count()
+        self._counters = {'admitted': 0, 'queued': 0, 'timeouts': 0}
+
+    def acquire(self, flow=None, timeout=None):
+        """Block until a slot is free for `flow`; returns False on timeout."""
+        event = threading.Event()
+        waiter = self._enqueue(flow or current_flow(), event.set)
+        if waiter is None:
+            return True
+        if event.wait(timeout):
+            return True
+        return self._abandon(waiter)
+
+    async def acquire_async(self, flow=None, timeout=None):
+        """Coroutine version of acquire(), for event-loop callers."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        waiter = self._enqueue(flow or current_flow(), wake)
+        if waiter is None:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self._abandon(waiter)
+        except asyncio.CancelledError:
+            # Hand back a slot granted just before the cancellation
+            if self._abandon(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self._in_use -= 1
+            self._grant_next()
+
+    def depth(self):
+        """(slots in use, calls waiting)."""
+        with self._lock:
+            return self._in_use, len(self._waiters)
+
+    def stats(self):
+        with self._lock:
+            waiting = {}
+            for waiter in self._waiters:
+                waiting[waiter.flow.key] = waiting.get(waiter.flow.key, 0) + 1
+            return {
+                **self._counters,
+                'slots': self.slots,
+                'in_use': self._in_use,
+                'waiting': len(self._waiters),
+                'waiting_flows': len(waiting),
+                'max_waiting_per_flow': max(waiting.values(), default=0),
+            }
+
+    def _enqueue(self, flow, wake):
+        # Returns None when the slot was taken right away, else the queued waiter
+        with self._lock:
+            start_tag = max(self._virtual_time, self._finish_tags.get(flow.key, 0.0))
+            self._finish_tags[flow.key] = start_tag + flow.cost / max(flow.weight, 1e-6)
+            if self._in_use < self.slots and not self._waiters:
+                self._in_use += 1
+                self._virtual_time = start_tag
+                self._counters['admitted'] += 1
+                self._forget_idle_flows()
+                return None
+            waiter = _Waiter(flow, start_tag, next(self._seq), wake)
+            self._waiters.append(waiter)
+            self._counters['queued'] += 1
+            return waiter
+
+    def _abandon(self, waiter):
+        # Timed out; unless a slot was granted meanwhile, leave the queue
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self._counters['timeouts'] += 1
+            return False
+
+    def _grant_next(self):
+        # Caller holds the lock
+        while self._in_use < self.slots and self._waiters:
+            waiter = min(self._waiters, key=lambda w: (w.start_tag, w.seq))
+            self._waiters.remove(waiter)
+            waiter.granted = True
+            self._in_use += 1
+            self._virtual_time = waiter.start_tag
+            self._counters['admitted'] += 1
+            waiter.wake()
+        self._forget_idle_flows()
+
+    def _forget_idle_flows(self):
+        # Flows whose last call is behind the virtual clock start fresh anyway
+        if len(self._finish_tags) > 1024:
+            self._finish_tags = {key: tag for key, tag in self._finish_tags.items()
+                                 if tag > self._virtual_time}
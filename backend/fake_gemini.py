@@ -0,0 +1,243 @@
+"""Local stand-ins for the Gemini client, for benchmarks and offline runs.
+
+FakeGeminiClient answers `models.generate_content` without network access:
+
+- synthetic mode returns a generated PNG the size of the first input image
+  (or `output_size` for text-only prompts);
+- replay mode returns responses captured earlier by RecordingClient, keyed
+  by a hash of the request contents, falling back to synthetic ones for
+  requests that were never recorded (unless `strict`).
+
+Latency (`latency` +/- `jitter` seconds, slept so it behaves like a network
+wait; a `slow_rate` fraction of calls take `slow_factor` times as long, like
+the upstream's long tail) and errors (`error_rate`, raised with one of `error_codes` as `.code`,
+so GeminiClient retries them like real 429/5xx responses) are injected on
+every call. Outputs are generated once per size and reused so the fake's
+own encoding cost stays out of the measurements. `aio.models` mirrors the
+SDK's async client, with the latency awaited instead of slept. A per-call
+timeout (`config.http_options.timeout`, in ms) shorter than the latency
+raises TimeoutError once it has passed, as the SDK's transport would.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+
+from PIL import Image
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code, message=None):
+        super().__init__(message or f"Injected upstream error {code}")
+        self.code = code
+
+
+class FakeBlob:
+    def __init__(self, data, mime_type='image/png'):
+        self.data = data
+        self.mime_type = mime_type
+
+
+class FakePart:
+    def __init__(self, text=None, inline_data=None):
+        self.text = text
+        self.inline_data = inline_data
+
+
+class FakeResponse:
+    def __init__(self, parts):
+        self.parts = parts
+
+
+def content_items(contents):
+    """Flatten request contents into ('text', str) and ('image', bytes) items."""
+    items = []
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            items.append(('text', item))
+        elif getattr(item, 'inline_data', None) is not None:
+            items.append(('image', item.inline_data.data))
+        elif getattr(item, 'text', None):
+            items.append(('text', item.text))
+    return items
+
+
+def call_timeout(config):
+    # Seconds, from a per-call http_options timeout in milliseconds
+    timeout = getattr(getattr(config, 'http_options', None), 'timeout', None)
+    return timeout / 1000 if timeout else None
+
+
+def request_key(model, contents, config=None):
+    digest = hashlib.sha256(f"{model}\0{getattr(config, 'temperature', None)}\0".encode())
+    for kind, value in content_items(contents):
+        digest.update(kind.encode())
+        digest.update(hashlib.sha256(value.encode() if kind == 'text' else value).digest())
+    return digest.hexdigest()
+
+
+def encode_response(response):
+    parts = []
+    for part in response.parts:
+        blob = getattr(part, 'inline_data', None)
+        if blob is not None and getattr(blob, 'data', None):
+            parts.append({'mime_type': blob.mime_type, 'data': base64.b64encode(blob.data).decode()})
+        elif getattr(part, 'text', None):
+            parts.append({'text': part.text})
+    return json.dumps({'parts': parts})
+
+
+def decode_response(raw):
+    parts = []
+    for part in json.loads(raw)['parts']:
+        if 'data' in part:
+            parts.append(FakePart(inline_data=FakeBlob(base64.b64decode(part['data']), part['mime_type'])))
+        else:
+            parts.append(FakePart(text=part['text']))
+    return FakeResponse(parts)
+
+
+class _Models:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, model, contents, config=None):
+        return self._owner.generate_content(model, contents, config)
+
+
+class _AsyncModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def generate_content(self, model, contents, config=None):
+        return await self._owner.generate_content_async(model, contents, config)
+
+
+class _Aio:
+    def __init__(self, owner):
+        self.models = _AsyncModels(owner)
+
+
+class FakeGeminiClient:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_codes=(429, 503),
+                 output_size=(1024, 1024), replay_dir=None, strict=False, seed=None,
+                 slow_rate=0.0, slow_factor=4.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.output_size = output_size
+        self.replay_dir = replay_dir
+        self.strict = strict
+        self.models = _Models(self)
+        self.aio = _Aio(self)
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._outputs = {}
+        self._counters = {'calls': 0, 'errors': 0, 'timeouts': 0, 'replayed': 0, 'synthetic': 0}
+
+    def generate_content(self, model, contents, config=None):
+        delay, code = self._plan_call()
+        timeout = call_timeout(config)
+        if delay:
+            time.sleep(min(delay, timeout or delay))
+        self._check_timeout(delay, timeout)
+        return self._respond(model, contents, config, code)
+
+    async def generate_content_async(self, model, contents, config=None):
+        delay, code = self._plan_call()
+        timeout = call_timeout(config)
+        if delay:
+            await asyncio.sleep(min(delay, timeout or delay))
+        self._check_timeout(delay, timeout)
+        return self._respond(model, contents, config, code)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _plan_call(self):
+        # Returns (delay, error code or None) for one call
+        with self._lock:
+            self._counters['calls'] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            if self._random.random() < self.slow_rate:
+                delay *= self.slow_factor
+            fail = self._random.random() < self.error_rate
+            return delay, self._random.choice(self.error_codes) if fail else None
+
+    def _check_timeout(self, delay, timeout):
+        if timeout is not None and delay > timeout:
+            self._count('timeouts')
+            raise TimeoutError(f"Fake upstream call timed out after {timeout:.1f}s")
+
+    def _respond(self, model, contents, config, code):
+        if code is not None:
+            self._count('errors')
+            raise FakeAPIError(code)
+
+        if self.replay_dir:
+            path = os.path.join(self.replay_dir, f"{request_key(model, contents, config)}.json")
+            if os.path.exists(path):
+                self._count('replayed')
+                with open(path) as f:
+                    return decode_response(f.read())
+            if self.strict:
+                raise KeyError(f"No recording for request {os.path.basename(path)}")
+
+        self._count('synthetic')
+        return FakeResponse([FakePart(inline_data=FakeBlob(self._output_for(contents)))])
+
+    def _output_for(self, contents):
+        size = self.output_size
+        for kind, value in content_items(contents):
+            if kind == 'image':
+                size = Image.open(io.BytesIO(value)).size
+                break
+        with self._lock:
+            output = self._outputs.get(size)
+        if output is None:
+            image = Image.linear_gradient('L').resize(size).convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            output = buffer.getvalue()
+            with self._lock:
+                self._outputs[size] = output
+        return output
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+class RecordingClient:
+    """Wraps a real client and saves every response for later replay."""
+
+    def __init__(self, client, directory):
+        self.client = client
+        self.directory = directory
+        self.models = _Models(self)
+        self.aio = _Aio(self)
+        os.makedirs(directory, exist_ok=True)
+
+    def generate_content(self, model, contents, config=None):
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        return self._save(model, contents, config, response)
+
+    async def generate_content_async(self, model, contents, config=None):
+        response = await self.client.aio.models.generate_content(model=model, contents=contents, config=config)
+        return self._save(model, contents, config, response)
+
+    def _save(self, model, contents, config, response):
+        path = os.path.join(self.directory, f"{request_key(model, contents, config)}.json")
+        with open(path, 'w') as f:
+            f.write(encode_response(response))
+        return response
@@ -0,0 +1,570 @@
+"""Resilient wrapper around the Gemini client shared by all routes.
+
+One SDK client (and so one HTTP connection pool) is shared by every thread
+in the process. Calls through GeminiClient are additionally:
+
+- limited to `max_concurrency` in flight per process, waiting at most
+  `queue_timeout` seconds for a slot; freed slots go to waiting calls in
+  weighted fair order across clients (see fair_queue.py), not FIFO;
+- retried on 429/5xx and transport errors with jittered exponential backoff;
+- short-circuited by a circuit breaker that fails fast for `breaker_cooldown`
+  seconds after `breaker_threshold` consecutive failed calls, then lets a
+  single trial call through before closing again;
+- bounded by the current request's deadline (see deadlines.py): a call is
+  dropped with DeadlineExceeded rather than started or retried once it
+  has passed, waits for a slot no longer than the time left, and, through
+  `with_timeout(kwargs, seconds)`, gets that time as its HTTP timeout when
+  it is shorter than the client's own `call_timeout`.
+
+- optionally hedged (`hedge_percentile`): an attempt still running after
+  that percentile of recent call times gets a second, identical attempt,
+  and whichever finishes first is used; the other is cancelled if it has
+  not started, else its result is dropped. A hedge rides on its primary's
+  slot, so hedges are capped by `hedge_budget`: each call earns that
+  fraction of a hedge, saved up to `hedge_burst`.
+
+expected_wait() estimates how long a new call would queue for a slot, from
+the queue depth and the recent mean call time, so callers can shed load
+before accepting work that could not finish in time.
+
+generate_content_async() does the same for asyncio callers through the
+SDK's async client (`client.aio`). It has its own `max_async_concurrency`
+slots, since waiting coroutines cost far less than waiting threads, but
+shares the breaker and the counters with the synchronous path.
+
+The wrapped client only needs a `models.generate_content` method (and
+`aio.models.generate_content` for async calls), so a local stub can stand
+in for the real service. `on_error(kind)` is called
+for every failed attempt and rejected call, e.g. to count errors by type.
+
+Instead of a client, a `client_factory` can be given: the SDK is then only
+imported and the client built on first use, or by warm_up(), which also
+opens a pooled connection so the first real call skips the TLS handshake.
+Built lazily, the client is never created in a gunicorn `--preload` master,
+so forked workers do not share its connection pool.
+"""
+import asyncio
+import contextvars
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import deadlines
+from fair_queue import FairQueue
+
+log = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class UpstreamUnavailable(Exception):
+    """The model call was not attempted; retry after `retry_after` seconds."""
+
+    status_code = 503
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class UpstreamBusy(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """The request's deadline passed before the call could be made or finished."""
+
+    status_code = 504
+
+
+def error_status(err):
+    """HTTP status carried by an SDK error, if any."""
+    for attr in ('code', 'status_code'):
+        value = getattr(err, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def error_kind(err):
+    """Short label for an upstream error: its HTTP status, or the exception class."""
+    status = error_status(err)
+    return str(status) if status else type(err).__name__
+
+
+def transport_errors():
+    # httpx comes in with the SDK; until it is loaded no httpx error can have been raised
+    httpx = sys.modules.get('httpx')
+    if httpx is None:
+        return (TimeoutError, ConnectionError)
+    return (httpx.TransportError, TimeoutError, ConnectionError)
+
+
+def is_timeout(err):
+    httpx = sys.modules.get('httpx')
+    return isinstance(err, TimeoutError) or (httpx is not None and isinstance(err, httpx.TimeoutException))
+
+
+def is_retryable(err):
+    if isinstance(err, transport_errors()):
+        return True
+    return error_status(err) in RETRYABLE_STATUS_CODES
+
+
+class GeminiClient:
+    def __init__(self, client=None, max_concurrency=8, queue_timeout=30.0, max_retries=3,
+                 base_delay=0.5, max_delay=8.0, breaker_threshold=5, breaker_cooldown=30.0,
+                 on_error=None, max_async_concurrency=256, client_factory=None,
+                 call_timeout=None, with_timeout=None, hedge_percentile=None, hedge_budget=0.05,
+                 hedge_burst=2.0, hedge_min_samples=20):
+        self._client = client
+        self.client_factory = client_factory
+        self.call_timeout = call_timeout
+        self.with_timeout = with_timeout
+        self.max_concurrency = max_concurrency
+        self.max_async_concurrency = max_async_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.on_error = on_error
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_burst = hedge_burst
+        self.hedge_min_samples = hedge_min_samples
+
+        self._slots = FairQueue(max_concurrency)
+        self._async_slots = FairQueue(max_async_concurrency)
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._in_flight = 0
+        self._counters = {'calls': 0, 'successes': 0, 'failures': 0, 'retries': 0, 'rejected': 0, 'expired': 0,
+                          'hedges': 0, 'hedge_wins': 0}
+        self._warm_up = None
+        self._mean_call_seconds = None  # moving average of successful attempts
+        self._recent_calls = deque(maxlen=200)  # durations of recent successful attempts
+        self._hedge_tokens = 0.0
+        self._hedge_pool = None
+
+    @property
+    def client(self):
+        if self._client is None and self.client_factory is not None:
+            # Its own lock: building takes a while and must not hold up stats() or the breaker
+            with self._build_lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self.client_factory()
+                    log.info("Gemini client built in %.0f ms", (time.perf_counter() - started) * 1000)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def configured(self):
+        """True if there is a client, or a factory to build one."""
+        return self._client is not None or self.client_factory is not None
+
+    def warm_up(self, model):
+        """Build the client and open a pooled connection with a metadata request.
+
+        Failures are logged, not raised: the first real call simply pays for
+        the connection instead. Returns the seconds it took.
+        """
+        started = time.perf_counter()
+        try:
+            models = self.client.models
+            if hasattr(models, 'get'):
+                models.get(model=model)
+            outcome = 'ok'
+        except Exception as err:
+            outcome = error_kind(err)
+            log.warning("Gemini warm-up failed (%s): %s", outcome, err)
+        return self._warmed_up('sync', outcome, started)
+
+    async def warm_up_async(self, model):
+        """warm_up() for the async client, whose pool belongs to the running event loop."""
+        started = time.perf_counter()
+        try:
+            models = self.client.aio.models
+            if hasattr(models, 'get'):
+                await models.get(model=model)
+            outcome = 'ok'
+        except Exception as err:
+            outcome = error_kind(err)
+            log.warning("Gemini async warm-up failed (%s): %s", outcome, err)
+        return self._warmed_up('async', outcome, started)
+
+    def _warmed_up(self, kind, outcome, started):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._warm_up = {**(self._warm_up or {}), kind: {'outcome': outcome, 'ms': round(elapsed * 1000, 1)}}
+        log.info("Gemini %s warm-up: %s in %.0f ms", kind, outcome, elapsed * 1000)
+        return elapsed
+
+    def generate_content(self, **kwargs):
+        """Call `client.models.generate_content(**kwargs)` with limits, retries and breaker."""
+        queue_timeout = self._queue_timeout()
+        self._before_call()
+        if not self._slots.acquire(timeout=queue_timeout):
+            self._rejected(queue_timeout)
+
+        with self._lock:
+            self._in_flight += 1
+        try:
+            response = self._call_with_retries(kwargs)
+        except Exception as err:
+            self._record_failure(err)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+        self._record_success()
+        return response
+
+    async def generate_content_async(self, **kwargs):
+        """Async twin of generate_content(), through `client.aio.models`."""
+        queue_timeout = self._queue_timeout()
+        self._before_call()
+        if not await self._async_slots.acquire_async(timeout=queue_timeout):
+            self._rejected(queue_timeout)
+
+        with self._lock:
+            self._in_flight += 1
+        try:
+            response = await self._call_with_retries_async(kwargs)
+        except Exception as err:
+            self._record_failure(err)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._async_slots.release()
+
+        self._record_success()
+        return response
+
+    @property
+    def mean_call_seconds(self):
+        """Moving average duration of successful calls, None before the first."""
+        return self._mean_call_seconds
+
+    def queue_depth(self, asynchronous=False):
+        """Calls waiting for a slot on the sync (or async) path."""
+        return (self._async_slots if asynchronous else self._slots).depth()[1]
+
+    def expected_wait(self, asynchronous=False):
+        """Rough seconds a new call would wait for a slot; 0 when one is free or nothing is known yet."""
+        slots = self._async_slots if asynchronous else self._slots
+        in_use, waiting = slots.depth()
+        mean = self.mean_call_seconds
+        if mean is None or (in_use < slots.slots and not waiting):
+            return 0.0
+        # Everyone queued ahead, plus this call, served `slots` at a time
+        return (waiting + 1) / slots.slots * mean
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'mean_call_seconds': self._mean_call_seconds,
+                'hedge_after_seconds': self._hedge_threshold(),
+                'hedge_tokens': round(self._hedge_tokens, 2),
+                'state': self._current_state(),
+                'in_flight': self._in_flight,
+                'max_concurrency': self.max_concurrency,
+                'max_async_concurrency': self.max_async_concurrency,
+                'consecutive_failures': self._consecutive_failures,
+                'client_ready': self._client is not None,
+                'warm_up': self._warm_up,
+                'fair_queue': self._slots.stats(),
+                'async_fair_queue': self._async_slots.stats(),
+            }
+
+    def _call_with_retries(self, kwargs):
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout()
+            self._count('calls')
+            started = time.perf_counter()
+            try:
+                response = self._attempt(self._bounded(kwargs, timeout))
+            except Exception as err:
+                self._report(error_kind(err))
+                self._raise_if_deadline(err, timeout)
+                if attempt >= self.max_retries or not is_retryable(err):
+                    raise
+                delay = self._backoff(attempt)
+                if not self._time_left_for(delay):
+                    raise
+                attempt += 1
+                self._count('retries')
+                log.warning("Gemini call failed (%s), retry %d/%d in %.2fs",
+                            error_kind(err), attempt, self.max_retries, delay)
+                time.sleep(delay)
+            else:
+                self._observe_call(time.perf_counter() - started)
+                return response
+
+    async def _call_with_retries_async(self, kwargs):
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout()
+            self._count('calls')
+            started = time.perf_counter()
+            try:
+                response = await self._attempt_async(self._bounded(kwargs, timeout))
+            except Exception as err:
+                self._report(error_kind(err))
+                self._raise_if_deadline(err, timeout)
+                if attempt >= self.max_retries or not is_retryable(err):
+                    raise
+                delay = self._backoff(attempt)
+                if not self._time_left_for(delay):
+                    raise
+                attempt += 1
+                self._count('retries')
+                log.warning("Gemini call failed (%s), retry %d/%d in %.2fs",
+                            error_kind(err), attempt, self.max_retries, delay)
+                await asyncio.sleep(delay)
+            else:
+                self._observe_call(time.perf_counter() - started)
+                return response
+
+    # Hedging
+
+    def _attempt(self, kwargs):
+        hedge_after = self._hedge_delay()
+        if hedge_after is None:
+            return self.client.models.generate_content(**kwargs)
+        pool = self._hedge_executor()
+        call = lambda: self.client.models.generate_content(**kwargs)
+        primary = pool.submit(contextvars.copy_context().run, call)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done or not self._take_hedge():
+            return primary.result()
+        log.info("Gemini call still running after %.2fs, hedging", hedge_after)
+        hedge = pool.submit(contextvars.copy_context().run, call)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()  # only stops it if it has not started; its result is dropped
+                    if future is hedge:
+                        self._count('hedge_wins')
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    async def _attempt_async(self, kwargs):
+        hedge_after = self._hedge_delay()
+        if hedge_after is None:
+            return await self.client.aio.models.generate_content(**kwargs)
+        primary = asyncio.ensure_future(self.client.aio.models.generate_content(**kwargs))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if done or not self._take_hedge():
+                return await primary
+            log.info("Gemini call still running after %.2fs, hedging", hedge_after)
+            hedge = asyncio.ensure_future(self.client.aio.models.generate_content(**kwargs))
+            pending.add(hedge)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count('hedge_wins')
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _hedge_threshold(self):
+        # Caller holds the lock; None until enough calls were seen
+        if not self.hedge_percentile or len(self._recent_calls) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self._recent_calls)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def _hedge_delay(self):
+        # Every call earns its share of the budget; None means do not hedge this one
+        with self._lock:
+            threshold = self._hedge_threshold()
+            if threshold is None:
+                return None
+            self._hedge_tokens = min(self.hedge_burst, self._hedge_tokens + self.hedge_budget)
+        left = deadlines.remaining()
+        if left is not None and left <= threshold:
+            return None  # a hedge could not start before the deadline
+        return threshold
+
+    def _take_hedge(self):
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            self._counters['hedges'] += 1
+            return True
+
+    def _hedge_executor(self):
+        # Attempts run here so the caller can wait on them with a timeout; room for
+        # every slot's primary and hedge, and for dropped attempts still finishing
+        if self._hedge_pool is None:
+            with self._build_lock:
+                if self._hedge_pool is None:
+                    self._hedge_pool = ThreadPoolExecutor(max_workers=self.max_concurrency * 3,
+                                                          thread_name_prefix='gemini-hedge')
+        return self._hedge_pool
+
+    # Deadlines
+
+    def _queue_timeout(self):
+        # Wait for a slot no longer than the request has left
+        left = deadlines.remaining()
+        if left is None:
+            return self.queue_timeout
+        if left <= 0:
+            self._raise_expired("Request deadline passed before the model call was queued")
+        return min(self.queue_timeout, left)
+
+    def _rejected(self, queue_timeout):
+        self._release_trial()
+        if deadlines.expired():
+            self._raise_expired(f"Request deadline passed after {queue_timeout:.1f}s waiting for an upstream slot")
+        self._count('rejected')
+        self._report('busy')
+        raise UpstreamBusy(f"No upstream slot free after {queue_timeout:.0f}s", retry_after=5)
+
+    def _raise_expired(self, message):
+        self._count('expired')
+        self._report('deadline')
+        raise DeadlineExceeded(message, retry_after=max(1, round(self.expected_wait())))
+
+    def _attempt_timeout(self):
+        # None leaves the client's own timeout; otherwise the (shorter) time the request has left
+        left = deadlines.remaining()
+        if left is None:
+            return None
+        if left <= 0:
+            raise DeadlineExceeded("Request deadline passed before the model call was made")
+        if self.call_timeout and left >= self.call_timeout:
+            return None
+        return left
+
+    def _bounded(self, kwargs, timeout):
+        if timeout is None or self.with_timeout is None:
+            return kwargs
+        return self.with_timeout(kwargs, timeout)
+
+    def _raise_if_deadline(self, err, timeout):
+        # A call cut short by the request's deadline says nothing about upstream health
+        if timeout is not None and is_timeout(err):
+            raise DeadlineExceeded(f"Request deadline passed during the model call ({timeout:.1f}s left)") from err
+
+    def _time_left_for(self, delay):
+        # No point retrying if the request is past its deadline by the time the retry starts
+        left = deadlines.remaining()
+        return left is None or delay < left
+
+    def _observe_call(self, seconds):
+        with self._lock:
+            self._recent_calls.append(seconds)
+            mean = self._mean_call_seconds
+            self._mean_call_seconds = seconds if mean is None else 0.8 * mean + 0.2 * seconds
+
+    def _backoff(self, attempt):
+        # "Full jitter": uniform over [0, capped exponential] spreads retries out
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # Circuit breaker
+
+    def _current_state(self):
+        if self._state == OPEN and time.time() - self._opened_at >= self.breaker_cooldown:
+            return HALF_OPEN
+        return self._state
+
+    def _before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial_in_flight:
+                # Let exactly one trial call probe the upstream
+                self._state = HALF_OPEN
+                self._trial_in_flight = True
+                return
+            self._counters['rejected'] += 1
+            remaining = max(1, int(self.breaker_cooldown - (time.time() - self._opened_at)))
+        self._report('circuit_open')
+        raise CircuitOpenError("Upstream model service is unavailable, failing fast", retry_after=remaining)
+
+    def _release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _record_success(self):
+        with self._lock:
+            self._counters['successes'] += 1
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+            if self._state != CLOSED:
+                log.warning("Gemini circuit breaker closed")
+            self._state = CLOSED
+
+    def _record_failure(self, err):
+        with self._lock:
+            self._trial_in_flight = False
+            if isinstance(err, DeadlineExceeded):
+                self._counters['expired'] += 1
+                return
+            self._counters['failures'] += 1
+            # Bad requests say nothing about upstream health
+            if not is_retryable(err):
+                if self._state == HALF_OPEN:
+                    self._state = CLOSED
+                return
+            self._consecutive_failures += 1
+            if self._state == HALF_OPEN or self._consecutive_failures >= self.breaker_threshold:
+                if self._state != OPEN:
+                    log.error("Gemini circuit breaker opened after %d failures: %s", self._consecutive_failures, err)
+                self._state = OPEN
+                self._opened_at = time.time()
+
+    def _report(self, kind):
+        if self.on_error:
+            try:
+                self.on_error(kind)
+            except Exception as report_err:
+                log.warning("Upstream error callback failed: %s", report_err)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
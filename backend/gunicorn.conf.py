@@ -0,0 +1,15 @@
+"""gunicorn settings, read automatically from the working directory.
+
+With `--preload` the master imports app.py once and forks the workers from
+it, so they start without importing Flask, Pillow and NumPy again and share
+those pages copy-on-write. Nothing at module level opens a connection or
+starts a thread, and the upstream warm-up below runs in each worker after
+the fork, so no socket is ever shared between processes.
+"""
+
+
+def post_worker_init(worker):
+    # The app is loaded by now, imported in this worker or inherited from the master
+    import app
+
+    app.start_warm_up()
@@ -0,0 +1,47 @@
+"""Content-addressed store for input and result images.
+
+Images are kept under the SHA-256 of their bytes, so the same image always
+gets the same id and uploading it twice stores it once. Clients send
+`image_id` (or `mask_id`, `baseImage_id`...) instead of the bytes for any
+image the server has already seen, e.g. the result of the previous edit.
+
+Storage reuses the response cache tiers: an LRU memory tier bounded by
+bytes, and a disk tier with a TTL and size budget shared by all workers
+pointed at the same directory. Ids that have expired are reported as
+missing and the client falls back to sending the image inline.
+"""
+import hashlib
+import re
+
+from response_cache import ResponseCache
+
+IMAGE_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def image_id_for(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageStore:
+    def __init__(self, max_memory_bytes=128 * 1024 * 1024, disk_dir=None,
+                 ttl=24 * 3600, max_disk_bytes=2 * 1024 * 1024 * 1024):
+        self._cache = ResponseCache(max_memory_bytes=max_memory_bytes, disk_dir=disk_dir,
+                                    disk_ttl=ttl, max_disk_bytes=max_disk_bytes)
+
+    def put(self, data):
+        """Store `data` (if not already stored) and return its id."""
+        data = bytes(data)
+        image_id = image_id_for(data)
+        if not self._cache.touch(image_id):
+            self._cache.put(image_id, data)
+        return image_id
+
+    def get(self, image_id):
+        """Return the bytes for `image_id`, or None if unknown or expired."""
+        if not isinstance(image_id, str) or not IMAGE_ID_PATTERN.match(image_id):
+            return None
+        entry = self._cache.get(image_id)
+        return entry[0] if entry else None
+
+    def stats(self):
+        return self._cache.stats()
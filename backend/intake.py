@@ -0,0 +1,93 @@
+"""Bounded-memory intake of client images.
+
+Uploads are checked from their header before any pixel data is decoded:
+Image.open() only parses the header, so the format and dimensions of a
+50 MB PNG (or of a 40 KB decompression bomb claiming 100k x 100k pixels)
+are known for the cost of a few hundred bytes. Anything that is not an
+allowed format, or that would decode to more than the pixel and side
+limits, is rejected with a 4xx before it can push a worker out of memory.
+
+When the caller is going to downscale anyway, JPEGs are decoded with
+Image.draft(), which lets libjpeg scale by 1/2, 1/4 or 1/8 while decoding,
+so the full-resolution bitmap never exists. Other formats are decoded at
+full size and reduced by normalize_image().
+"""
+import io
+import logging
+from dataclasses import dataclass
+
+from PIL import Image, UnidentifiedImageError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FORMATS = ('PNG', 'JPEG', 'MPO', 'WEBP', 'GIF')
+DEFAULT_MAX_PIXELS = 40_000_000
+DEFAULT_MAX_SIDE = 12_000
+
+# Formats libjpeg can scale while decoding
+DRAFT_FORMATS = ('JPEG', 'MPO')
+
+
+class IntakeError(ValueError):
+    """A rejected upload; `status_code` is the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass(frozen=True)
+class ImageHeader:
+    format: str
+    size: tuple
+    mode: str
+
+    @property
+    def pixels(self):
+        return self.size[0] * self.size[1]
+
+
+class ImageIntake:
+    def __init__(self, max_pixels=DEFAULT_MAX_PIXELS, max_side=DEFAULT_MAX_SIDE, formats=DEFAULT_FORMATS):
+        self.max_pixels = max_pixels
+        self.max_side = max_side
+        self.formats = tuple(fmt.upper() for fmt in formats)
+
+    def probe(self, data):
+        """Return the ImageHeader of `data`, reading only the header."""
+        header, _ = self._open(data)
+        return header
+
+    def open(self, data, draft_side=None):
+        """Return (image, header) for `data`, lazily opened and size-checked.
+
+        With `draft_side`, JPEGs are set up to decode at the smallest 1/2^n
+        scale whose longest side is still at least `draft_side`; `header.size`
+        keeps the size the client sent.
+        """
+        header, image = self._open(data)
+        if draft_side and header.format in DRAFT_FORMATS and max(header.size) > draft_side * 2:
+            scale = draft_side / max(header.size)
+            target = (max(1, int(header.size[0] * scale)), max(1, int(header.size[1] * scale)))
+            image.draft('RGB', target)
+            log.debug("Drafting %dx%d %s to %dx%d while decoding", *header.size, header.format, *image.size)
+        return image, header
+
+    def _open(self, data):
+        try:
+            image = Image.open(io.BytesIO(data))
+        except Image.DecompressionBombError as bomb_err:
+            raise IntakeError(str(bomb_err), 413)
+        except UnidentifiedImageError:
+            raise IntakeError('Unrecognized image data', 400)
+
+        header = ImageHeader(image.format, image.size, image.mode)
+        if header.format not in self.formats:
+            raise IntakeError(f'Unsupported image format {header.format}, use one of {", ".join(self.formats)}', 415)
+        width, height = header.size
+        if width <= 0 or height <= 0:
+            raise IntakeError(f'Invalid image dimensions {width}x{height}', 400)
+        if max(width, height) > self.max_side or header.pixels > self.max_pixels:
+            raise IntakeError(f'Image is {width}x{height}, the limit is {self.max_pixels} pixels '
+                              f'and {self.max_side} pixels per side', 413)
+        return header, image
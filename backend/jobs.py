@@ -0,0 +1,166 @@
+"""Background execution of generation requests.
+
+Model calls take 10-30 s, so instead of tying up a request handler for the
+whole round-trip, callers submit a job, get its id back immediately and
+either poll it or subscribe to its completion event. Jobs run on a bounded
+thread pool; when both the pool and its pending queue are full, new
+submissions are rejected instead of piling up.
+
+Operations are plain callables taking the request data dict and returning a
+(payload, status_code) tuple, the same contract as the synchronous routes.
+They run in a copy of the submitter's context, so context variables such
+as the request trace are visible to them. Job state lives in this process
+only.
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, operation, data):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.data = data
+        self.status = QUEUED
+        self.result = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def to_dict(self, include_result=True):
+        info = {
+            'id': self.id,
+            'operation': self.operation,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.done and include_result:
+            info['status_code'] = self.status_code
+            info['result'] = self.result
+        return info
+
+
+class JobManager:
+    def __init__(self, operations, max_workers=4, max_pending=32, result_ttl=600):
+        self.operations = operations
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = 0
+        self._running = 0
+
+    def submit(self, operation, data, keep=True):
+        """Queue `operation` and return its Job without waiting for it.
+
+        Raises KeyError for unknown operations and JobQueueFull when the
+        pool and its pending queue are both saturated. Unless `keep` is
+        false, the job can be looked up with get() until its result expires.
+        """
+        if operation not in self.operations:
+            raise KeyError(operation)
+        self._prune()
+
+        job = Job(operation, data)
+        with self._lock:
+            if self._active >= self.max_workers + self.max_pending:
+                raise JobQueueFull(f"{self._active} jobs already queued or running")
+            self._active += 1
+            if keep:
+                self._jobs[job.id] = job
+        self._executor.submit(contextvars.copy_context().run, self._run, job)
+        return job
+
+    def run(self, operation, data, timeout=None):
+        """Submit and wait: the synchronous routes go through here.
+
+        After `timeout` seconds a 504 is returned instead; the job itself
+        is not interrupted. The job is not kept for polling, so its result
+        is freed as soon as the caller is done with it.
+        """
+        job = self.submit(operation, data, keep=False)
+        if not job.wait(timeout if timeout is None else max(0.0, timeout)):
+            log.warning("Gave up waiting for job %s (%s) after %.1fs", job.id, operation, timeout)
+            return {'error': f'{operation} did not finish before the request deadline'}, 504
+        return job.result, job.status_code
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        """(jobs running, jobs queued behind them)."""
+        with self._lock:
+            return self._running, self._active - self._running
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {
+                'active': self._active,
+                'running': self._running,
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'jobs': counts,
+            }
+
+    def _run(self, job):
+        job.status = RUNNING
+        job.started_at = time.time()
+        with self._lock:
+            self._running += 1
+        try:
+            payload, status_code = self.operations[job.operation](job.data)
+        except Exception as e:
+            log.exception("Job %s (%s) raised: %s", job.id, job.operation, e)
+            payload, status_code = {'error': str(e)}, 500
+
+        job.result = payload
+        job.status_code = status_code
+        job.status = SUCCEEDED if status_code < 400 else FAILED
+        job.finished_at = time.time()
+        job.data = None  # drop the request payload (images) as soon as possible
+        with self._lock:
+            self._active -= 1
+            self._running -= 1
+        job._done.set()
+
+    def _prune(self):
+        # Finished jobs keep their (possibly multi-MB) results until they expire
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.done and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
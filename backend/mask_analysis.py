@@ -0,0 +1,214 @@
+"""Yellow doodle detection for masked edit requests.
+
+The frontend paints the user's edit region onto the canvas in yellow and
+sends the flattened composite. This module classifies every pixel of that
+composite in a single NumPy pass using the same three heuristics the
+/edit-image route has always used, and summarises the result as coverage,
+pixel count, bounding box and connected regions. Masks that arrive as a
+separate 1-bit channel (binary_mask.py) skip straight to the summary.
+"""
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# Labelling runs on a coarse occupancy grid so its cost stays bounded no
+# matter how large (or noisy) the canvas is. Pixel counts and boxes are
+# then refined against the full-resolution mask.
+LABEL_GRID_SIZE = 512
+MIN_REGION_PIXELS = 16
+MAX_REGIONS = 32
+
+# Same acceptance rule as the original sampling loop
+MIN_YELLOW_PIXELS = 25
+MIN_YELLOW_PERCENTAGE = 0.1
+
+
+@dataclass
+class MaskRegion:
+    bbox: tuple  # (left, top, right, bottom), right/bottom exclusive
+    pixel_count: int
+
+
+@dataclass
+class MaskAnalysis:
+    width: int
+    height: int
+    yellow_count: int
+    bbox: tuple = None
+    regions: list = field(default_factory=list)
+
+    @property
+    def total_pixels(self):
+        return self.width * self.height
+
+    @property
+    def yellow_percentage(self):
+        if not self.total_pixels:
+            return 0.0
+        return self.yellow_count / self.total_pixels * 100
+
+    @property
+    def has_yellow(self):
+        return (self.yellow_count > MIN_YELLOW_PIXELS
+                or self.yellow_percentage > MIN_YELLOW_PERCENTAGE)
+
+    def to_dict(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'yellow_count': self.yellow_count,
+            'yellow_percentage': round(self.yellow_percentage, 4),
+            'bbox': list(self.bbox) if self.bbox else None,
+            'regions': [
+                {'bbox': list(r.bbox), 'pixel_count': r.pixel_count}
+                for r in self.regions
+            ],
+        }
+
+
+def yellow_mask(image):
+    """Return a boolean HxW array marking yellow doodle pixels in `image`."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    rgb = np.asarray(image)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+    # Method 1: Traditional high R+G, low B
+    mask = (r > 180) & (g > 180) & (b < 120)
+    # Method 2: Yellow-ish colors (including semi-transparent overlays).
+    # (r + g) > b * 2.5 is evaluated as 2 * (r + g) > 5 * b in int16 so it
+    # stays integral and cannot overflow uint8.
+    candidates = (r > 200) & (g > 200) & (b < 160) & ~mask
+    if candidates.any():
+        rg = r[candidates].astype(np.int16) + g[candidates]
+        mask[candidates] = 2 * rg > 5 * b[candidates].astype(np.int16)
+    # Method 3: Bright/highlighted warm pixels that could be yellow markings
+    mask |= (r > 220) & (g > 200) & (r > b) & (g > b)
+    return mask
+
+
+def analyze_mask(image, min_region_pixels=MIN_REGION_PIXELS, max_regions=MAX_REGIONS):
+    """Classify every pixel of `image` and summarise the yellow doodle."""
+    return summarize_mask(yellow_mask(image), min_region_pixels, max_regions)
+
+
+def summarize_mask(mask, min_region_pixels=MIN_REGION_PIXELS, max_regions=MAX_REGIONS):
+    """Summarise a boolean HxW edit mask, e.g. one sent as a separate 1-bit mask."""
+    height, width = mask.shape
+    yellow_count = int(np.count_nonzero(mask))
+
+    analysis = MaskAnalysis(width=width, height=height, yellow_count=yellow_count)
+    if not yellow_count:
+        return analysis
+
+    analysis.bbox = _bounding_box(mask)
+    analysis.regions = find_regions(mask, min_region_pixels, max_regions)
+    return analysis
+
+
+def find_regions(mask, min_region_pixels=MIN_REGION_PIXELS, max_regions=MAX_REGIONS):
+    """Group mask pixels into 8-connected regions, largest first.
+
+    Connectivity is computed on a grid of at most LABEL_GRID_SIZE cells per
+    side, so strokes closer together than one cell are reported as a single
+    region. Each region's pixel count and bounding box are exact.
+    """
+    height, width = mask.shape
+    block = max(1, -(-max(height, width) // LABEL_GRID_SIZE))
+    grid = _occupancy_grid(mask, block)
+    labels, boxes = _label_grid(grid)
+
+    regions = []
+    for label, (gx0, gy0, gx1, gy1) in enumerate(boxes, start=1):
+        y0, y1 = gy0 * block, min(gy1 * block, height)
+        x0, x1 = gx0 * block, min(gx1 * block, width)
+
+        # Only count pixels whose cell belongs to this label, so regions whose
+        # boxes overlap do not steal each other's pixels
+        owned = labels[gy0:gy1, gx0:gx1] == label
+        if block > 1:
+            owned = owned.repeat(block, axis=0).repeat(block, axis=1)
+        region = mask[y0:y1, x0:x1] & owned[:y1 - y0, :x1 - x0]
+
+        pixel_count = int(np.count_nonzero(region))
+        if pixel_count < min_region_pixels:
+            continue
+        left, top, right, bottom = _bounding_box(region)
+        regions.append(MaskRegion(
+            bbox=(x0 + left, y0 + top, x0 + right, y0 + bottom),
+            pixel_count=pixel_count,
+        ))
+
+    regions.sort(key=lambda r: r.pixel_count, reverse=True)
+    return regions[:max_regions]
+
+
+def _bounding_box(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
+def _occupancy_grid(mask, block):
+    if block == 1:
+        return mask
+    height, width = mask.shape
+    grid_h, grid_w = -(-height // block), -(-width // block)
+    padded = np.zeros((grid_h * block, grid_w * block), dtype=bool)
+    padded[:height, :width] = mask
+    return padded.reshape(grid_h, block, grid_w, block).any(axis=(1, 3))
+
+
+def _label_grid(grid):
+    """Label 8-connected components of a small boolean grid.
+
+    Works on horizontal runs rather than cells: runs in adjacent rows that
+    touch (including diagonally) are merged with a union-find.
+    """
+    parent = []
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    runs_by_row = []
+    for row in grid:
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], row, [False])).astype(np.int8)))
+        starts, ends = edges[0::2], edges[1::2]
+        row_runs = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            parent.append(len(parent))
+            row_runs.append((start, end, len(parent) - 1))
+        runs_by_row.append(row_runs)
+
+    for above, below in zip(runs_by_row, runs_by_row[1:]):
+        i = 0
+        for start, end, run_id in below:
+            # Skip runs above that end before this one could touch them
+            while i < len(above) and above[i][1] < start:
+                i += 1
+            j = i
+            while j < len(above) and above[j][0] <= end:
+                root_a, root_b = find(above[j][2]), find(run_id)
+                if root_a != root_b:
+                    parent[root_b] = root_a
+                j += 1
+
+    labels = np.zeros(grid.shape, dtype=np.int32)
+    roots = {}
+    boxes = []  # per label (left, top, right, bottom) in grid cells
+    for y, row_runs in enumerate(runs_by_row):
+        for start, end, run_id in row_runs:
+            root = find(run_id)
+            if root not in roots:
+                roots[root] = len(roots) + 1
+                boxes.append([start, y, end, y + 1])
+            label = roots[root]
+            labels[y, start:end] = label
+            box = boxes[label - 1]
+            box[0] = min(box[0], start)
+            box[2] = max(box[2], end)
+            box[3] = y + 1
+    return labels, boxes
@@ -0,0 +1,122 @@
+"""Crop-to-mask helpers for masked edits.
+
+Instead of uploading the whole canvas for a small doodle, /edit-image can
+send only the region around the yellow marks (plus an optional small
+overview of the full frame) and paste the model's patch back into the
+original image at native resolution with a feathered edge.
+"""
+import numpy as np
+from PIL import Image
+
+DEFAULT_MARGIN_RATIO = 0.25
+DEFAULT_MIN_MARGIN = 32
+DEFAULT_MIN_CROP_SIDE = 256
+DEFAULT_MAX_AREA_RATIO = 0.5
+DEFAULT_OVERVIEW_MAX_SIDE = 512
+DEFAULT_FEATHER = 24
+
+
+def plan_crop(bbox, image_size, margin_ratio=DEFAULT_MARGIN_RATIO,
+              min_margin=DEFAULT_MIN_MARGIN, min_side=DEFAULT_MIN_CROP_SIDE,
+              max_area_ratio=DEFAULT_MAX_AREA_RATIO):
+    """Return the crop box around `bbox`, or None if cropping is not worth it.
+
+    The box is grown by a context margin on every side, widened to at least
+    `min_side` pixels where the image allows, and clipped to the image. If
+    the result still covers more than `max_area_ratio` of the frame the
+    whole image is cheaper to send as-is.
+    """
+    if not bbox:
+        return None
+    width, height = image_size
+    left, top, right, bottom = bbox
+
+    margin_x = max(min_margin, int((right - left) * margin_ratio))
+    margin_y = max(min_margin, int((bottom - top) * margin_ratio))
+    left, right = _grow(left - margin_x, right + margin_x, min_side, width)
+    top, bottom = _grow(top - margin_y, bottom + margin_y, min_side, height)
+
+    if (right - left) * (bottom - top) > max_area_ratio * width * height:
+        return None
+    return (left, top, right, bottom)
+
+
+def _grow(start, end, min_length, limit):
+    # Widen [start, end) symmetrically to min_length, then clip to [0, limit)
+    missing = min_length - (end - start)
+    if missing > 0:
+        start -= missing // 2
+        end += missing - missing // 2
+    if start < 0:
+        end -= start
+        start = 0
+    if end > limit:
+        start -= end - limit
+        end = limit
+    return max(start, 0), end
+
+
+def scale_box(box, from_size, to_size):
+    """Map a box between two resolutions of the same frame."""
+    sx = to_size[0] / from_size[0]
+    sy = to_size[1] / from_size[1]
+    left, top, right, bottom = box
+    return (
+        int(left * sx),
+        int(top * sy),
+        min(to_size[0], int(round(right * sx))),
+        min(to_size[1], int(round(bottom * sy))),
+    )
+
+
+def make_overview(image, max_side=DEFAULT_OVERVIEW_MAX_SIDE):
+    """Downscaled copy of the full frame, sent alongside the crop for context."""
+    overview = image.copy()
+    overview.thumbnail((max_side, max_side), Image.LANCZOS)
+    return overview
+
+
+def feather_alpha(size, box, image_size, feather=DEFAULT_FEATHER):
+    """Alpha ramp for pasting a patch at `box`.
+
+    Edges that lie on the image border stay hard since there is nothing to
+    blend with there; interior edges fade in over `feather` pixels.
+    """
+    width, height = size
+    left, top, right, bottom = box
+    ramp_x = _ramp(width, feather, left > 0, right < image_size[0])
+    ramp_y = _ramp(height, feather, top > 0, bottom < image_size[1])
+    alpha = np.outer(ramp_y, ramp_x)
+    return Image.fromarray((alpha * 255).astype(np.uint8), 'L')
+
+
+def _ramp(length, feather, fade_start, fade_end):
+    ramp = np.ones(length, dtype=np.float32)
+    feather = min(feather, length // 2)
+    if feather <= 0:
+        return ramp
+    # Smoothstep looks less banded than a linear ramp
+    t = (np.arange(feather, dtype=np.float32) + 0.5) / feather
+    edge = t * t * (3 - 2 * t)
+    if fade_start:
+        ramp[:feather] = edge
+    if fade_end:
+        ramp[-feather:] = edge[::-1]
+    return ramp
+
+
+def composite_patch(base, patch, box, feather=DEFAULT_FEATHER):
+    """Paste `patch` into a copy of `base` at `box` with a feathered edge.
+
+    The patch is resized to the box first, since the model is free to
+    return a different resolution than it was given.
+    """
+    left, top, right, bottom = box
+    size = (right - left, bottom - top)
+    result = base.convert('RGB') if base.mode != 'RGB' else base.copy()
+    if patch.mode != 'RGB':
+        patch = patch.convert('RGB')
+    if patch.size != size:
+        patch = patch.resize(size, Image.LANCZOS)
+    result.paste(patch, (left, top), feather_alpha(size, box, result.size, feather))
+    return result
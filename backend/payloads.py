@@ -0,0 +1,231 @@
+"""Request parsing and response encoding at the HTTP boundary.
+
+Routes accept the original JSON body with base64 data URLs, but also
+multipart/form-data uploads and raw image/* bodies, which skip the 33%
+base64 overhead and the extra copies of the payload. Operations always
+work with raw image bytes; results are turned into data URLs only when the
+client asked for JSON, or sent back as a raw image body with the remaining
+fields in a metadata header.
+
+Results keep the encoding the model returned (with its real MIME type)
+unless the client asks for `format` png/webp/jpeg (plus `quality`), and
+`preview` adds a small "<field>_preview" variant for a fast first paint.
+The full image and its preview are encoded in parallel.
+"""
+import base64
+import binascii
+import io
+import json
+from dataclasses import dataclass
+
+from flask import Response
+from PIL import Image
+
+from preprocess import flatten_to_rgb
+
+RAW_IMAGE_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+DEFAULT_QUALITY = 90
+DEFAULT_PREVIEW_SIDE = 384
+PREVIEW_FORMAT = 'webp'
+PREVIEW_QUALITY = 75
+METADATA_HEADER = 'X-Result-Metadata'
+IMAGE_FIELD_HEADER = 'X-Image-Field'
+
+
+def image_bytes(value):
+    """Return raw bytes for a data URL, bare base64 string or bytes value."""
+    if value is None:
+        return b''
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    # One ASCII copy of the string, then decode from a view past the data URL
+    # header instead of slicing out (and copying) the base64 part first
+    encoded = value.encode('ascii')
+    start = encoded.find(b',', 0, 256) + 1
+    return binascii.a2b_base64(memoryview(encoded)[start:])
+
+
+def parse_request_data(request, raw_field=None):
+    """Collect request fields into one dict, whatever the body encoding.
+
+    - application/json: the body as-is (image fields are data URLs)
+    - multipart/form-data: form fields as strings, file parts as bytes
+    - image/*: the body becomes `raw_field`; other fields come from the
+      query string (e.g. ?prompt=...)
+    """
+    content_type = request.mimetype or ''
+    if content_type == 'multipart/form-data':
+        data = request.form.to_dict()
+        for name, upload in request.files.items():
+            data[name] = upload.read()
+        return data
+    if content_type.startswith('image/'):
+        data = request.args.to_dict()
+        if raw_field:
+            data[raw_field] = request.get_data(cache=False)
+        return data
+
+    # Not cached on the request: the raw body can be freed as soon as it is parsed
+    data = request.get_json(silent=True, cache=False) or {}
+    if request.args:
+        # Options such as ?response=image can ride along with a JSON body
+        data = {**request.args.to_dict(), **data}
+    return data
+
+
+@dataclass
+class OutputOptions:
+    format: str = None  # None keeps the bytes as the model returned them
+    quality: int = DEFAULT_QUALITY
+    preview_side: int = 0  # 0: no preview
+
+
+def _option(request, data, key):
+    value = data.get(key)
+    return request.args.get(key) if value is None else value
+
+
+def requested_format(request, data):
+    fmt = str(_option(request, data, 'format') or '').lower()
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    return fmt if fmt in RAW_IMAGE_TYPES else None
+
+
+def output_options(request, data, default_preview_side=DEFAULT_PREVIEW_SIDE):
+    """Read `format`, `quality` and `preview` (true or a max side in pixels)."""
+    try:
+        quality = min(100, max(1, int(_option(request, data, 'quality') or DEFAULT_QUALITY)))
+    except (TypeError, ValueError):
+        quality = DEFAULT_QUALITY
+
+    preview = _option(request, data, 'preview')
+    if isinstance(preview, str) and preview.isdigit():
+        preview = int(preview)
+    if preview is True or (isinstance(preview, str) and preview.lower() in ('1', 'true', 'yes', 'on')):
+        preview_side = default_preview_side
+    elif isinstance(preview, int) and not isinstance(preview, bool):
+        preview_side = max(0, preview)
+    else:
+        preview_side = 0
+    return OutputOptions(requested_format(request, data), quality, preview_side)
+
+
+def requested_image_format(request, data):
+    """Return 'png'/'webp'/'jpeg' if the client wants a raw image body, else None."""
+    fmt = requested_format(request, data)
+    if data.get('response') == 'image' or request.args.get('response') == 'image':
+        return fmt or 'png'
+
+    best = request.accept_mimetypes.best_match(['application/json', *RAW_IMAGE_TYPES.values()])
+    for name, mime_type in RAW_IMAGE_TYPES.items():
+        if best == mime_type:
+            return name
+    return None
+
+
+def sniff_image_type(data):
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def encode_as(image, fmt, quality=DEFAULT_QUALITY):
+    buffer = io.BytesIO()
+    if fmt == 'png':
+        image.save(buffer, format='PNG', compress_level=6)
+    elif fmt == 'jpeg':
+        # JPEG has no alpha channel
+        flatten_to_rgb(image).save(buffer, format='JPEG', quality=quality)
+    else:
+        image.save(buffer, format='WEBP', quality=quality)
+    return buffer.getvalue()
+
+
+def convert_image(data, fmt, quality=DEFAULT_QUALITY):
+    """Return (bytes, mime type) for `data` encoded as `fmt`, transcoding only if needed."""
+    mime_type = RAW_IMAGE_TYPES[fmt]
+    if sniff_image_type(data) == mime_type:
+        return data, mime_type
+    return encode_as(Image.open(io.BytesIO(data)), fmt, quality), mime_type
+
+
+def make_preview(data, max_side, fmt=PREVIEW_FORMAT, quality=PREVIEW_QUALITY):
+    """Return (bytes, mime type) of a copy of `data` no larger than `max_side`."""
+    image = Image.open(io.BytesIO(data))
+    # JPEG results can be scaled down while decoding
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+    return encode_as(image, fmt, quality), RAW_IMAGE_TYPES[fmt]
+
+
+def data_url(data, mime_type=None):
+    return f'data:{mime_type or sniff_image_type(data)};base64,{base64.b64encode(data).decode()}'
+
+
+def json_payload(payload, options=None, executor=None):
+    """Replace raw image bytes in an operation result with data URLs.
+
+    With `options`, images are transcoded and previews added as requested;
+    when there is more than one encode they run in parallel on `executor`.
+    """
+    options = options or OutputOptions()
+    tasks = {}  # output key -> (function, args) returning (bytes, mime type)
+    for key, value in payload.items():
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            continue
+        value = bytes(value)
+        if options.format:
+            tasks[key] = (convert_image, (value, options.format, options.quality))
+        else:
+            tasks[key] = (_as_produced, (value,))
+        if options.preview_side:
+            tasks[f'{key}_preview'] = (make_preview, (value, options.preview_side))
+
+    if executor and len(tasks) > 1:
+        futures = {key: executor.submit(fn, *args) for key, (fn, args) in tasks.items()}
+        results = {key: future.result() for key, future in futures.items()}
+    else:
+        results = {key: fn(*args) for key, (fn, args) in tasks.items()}
+
+    encoded = {}
+    for key, value in payload.items():
+        if key in results:
+            value = data_url(*results[key])
+            if f'{key}_preview' in results:
+                encoded[f'{key}_preview'] = data_url(*results[f'{key}_preview'])
+        encoded[key] = value
+    return encoded
+
+
+def _as_produced(data):
+    return data, sniff_image_type(data)
+
+
+def image_response(payload, fmt, status_code=200, options=None):
+    """Send the result image as the body and everything else as JSON in a header."""
+    options = options or OutputOptions()
+    image_field = next(
+        key for key, value in payload.items()
+        if isinstance(value, (bytes, bytearray, memoryview))
+    )
+    body, mime_type = convert_image(bytes(payload[image_field]), fmt, options.quality)
+    metadata = {key: value for key, value in payload.items() if key != image_field}
+
+    response = Response(body, status=status_code, mimetype=mime_type)
+    response.headers[IMAGE_FIELD_HEADER] = image_field
+    # json.dumps escapes newlines and non-ASCII, so the value is header-safe
+    response.headers[METADATA_HEADER] = json.dumps(metadata, separators=(',', ':'))
+    return response
+
+
+def has_image(payload):
+    return any(isinstance(value, (bytes, bytearray, memoryview)) for value in payload.values())
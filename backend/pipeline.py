@@ -0,0 +1,115 @@
+"""Server-side edit chains with NDJSON streaming.
+
+A pipeline request carries an ordered list of steps, e.g. a whole-image
+restyle, then a masked edit, then a blend. Each step is one of the regular
+operations, run exactly as its route would run it, on the previous step's
+result: the result is already in the image store, so the next step gets
+its id ("image_id", or "baseImage_id" for a blend) instead of the client
+downloading the image and uploading it again. Each step is streamed back
+as one JSON line as soon as it finishes; the chain stops at the first
+failed step.
+"""
+import json
+import time
+
+# Result field of each operation, and the input field the next step's result goes into
+RESULT_FIELDS = {
+    'generate': 'generated_image',
+    'edit-whole': 'edited_image',
+    'edit-image': 'edited_image',
+    'blend-images': 'blended_image',
+}
+CHAIN_INPUTS = {
+    'generate': None,
+    'edit-whole': 'image',
+    'edit-image': 'image',
+    'blend-images': 'baseImage',
+}
+
+
+class PipelineError(ValueError):
+    pass
+
+
+def expand_steps(data, max_steps):
+    """Turn a pipeline request into a list of (operation, step data) pairs.
+
+    Top-level "image" / "image_id" is the input of the first step. Every
+    other top-level field except "steps" is shared by all steps unless a
+    step overrides it. Only the last step returns its image by default;
+    earlier ones return the id of their result (see GET /images/<id>).
+    """
+    steps = data.get('steps')
+    if not isinstance(steps, list) or not all(isinstance(step, dict) for step in steps):
+        raise PipelineError('"steps" must be a list of objects')
+    if not steps:
+        raise PipelineError('Pipeline is empty')
+    if len(steps) > max_steps:
+        raise PipelineError(f'Pipeline has {len(steps)} steps, the limit is {max_steps}')
+
+    shared = {key: value for key, value in data.items() if key not in ('steps', 'image', 'image_id')}
+    expanded = []
+    for index, step in enumerate(steps):
+        operation = step.get('operation')
+        if operation not in CHAIN_INPUTS:
+            raise PipelineError(f'Step {index}: unknown operation {operation!r}, use one of {", ".join(CHAIN_INPUTS)}')
+        input_field = CHAIN_INPUTS[operation]
+        step = {key: value for key, value in step.items() if key != 'operation'}
+        if index == 0:
+            for key in ('image', 'image_id'):
+                if data.get(key) and input_field:
+                    step.setdefault(key.replace('image', input_field), data[key])
+            if input_field and not (step.get(input_field) or step.get(f'{input_field}_id')):
+                raise PipelineError(f'Step 0: {operation} needs "image" or "image_id"')
+        elif input_field is None:
+            raise PipelineError(f'Step {index}: {operation} takes no image, so it can only be the first step')
+        elif step.get(input_field) or step.get(f'{input_field}_id'):
+            raise PipelineError(f'Step {index}: "{input_field}" comes from the previous step')
+        step = {**shared, **step}
+        if index and operation == 'edit-image':
+            # A yellow-painted "mask" carries its own copy of the pixels, which would
+            # replace the previous step's result; only a separate mask applies to it
+            if step.get('mask') or step.get('mask_id') or not step.get('binary_mask'):
+                raise PipelineError(f'Step {index}: a chained edit-image needs a "binary_mask", not a painted "mask"')
+        step.setdefault('return_image', index == len(steps) - 1)
+        expanded.append((operation, step))
+    return expanded
+
+
+def stream_pipeline(steps, run_step, encode_payload, throttle=None):
+    """Yield one NDJSON line per finished step, then a summary line.
+
+    `run_step(operation, data)` returns (payload, status_code) like the
+    routes. `throttle(operation)`, if given, is asked before each step after
+    the first until it returns 0, and otherwise returns seconds to wait
+    before asking again. If the client goes away, the remaining steps are
+    not started.
+    """
+    started = time.time()
+    result_id = None
+    completed = 0
+    for index, (operation, data) in enumerate(steps):
+        if index:
+            data = {**data, f'{CHAIN_INPUTS[operation]}_id': result_id}
+            delay = throttle(operation) if throttle else 0
+            while delay:
+                time.sleep(delay)
+                delay = throttle(operation)
+        try:
+            payload, status_code = run_step(operation, data)
+        except Exception as e:
+            payload, status_code = {'error': str(e)}, 500
+        line = {'step': index, 'operation': operation, 'status_code': status_code, **encode_payload(payload)}
+        yield json.dumps(line) + '\n'
+        if status_code >= 400:
+            break
+        completed += 1
+        result_id = payload.get(f'{RESULT_FIELDS[operation]}_id')
+
+    yield json.dumps({
+        'done': True,
+        'steps': len(steps),
+        'completed': completed,
+        'result_id': result_id,
+        'elapsed': round(time.time() - started, 3),
+    }) + '\n'
@@ -0,0 +1,127 @@
+"""Input normalization before images are sent to the model.
+
+Browser canvases arrive at arbitrary sizes and in RGBA, P or RGB mode, and
+the SDK re-encodes PNG uploads losslessly. Every image that goes to the
+model passes through normalize_image() instead, which applies the EXIF
+orientation, caps the longest side, flattens to RGB, drops metadata and
+encodes once in a compact format. The original geometry is kept so results
+can be scaled back to the size the client sent.
+"""
+import io
+import logging
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+log = logging.getLogger(__name__)
+
+EXIF_ORIENTATION = 0x0112
+
+ENCODINGS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+    'png': ('PNG', 'image/png'),
+}
+
+
+@dataclass
+class NormalizedImage:
+    image: Image.Image
+    data: bytes
+    mime_type: str
+    original_size: tuple
+    original_mode: str
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def resized(self):
+        return self.size != self.original_size
+
+
+def upright(image):
+    """Apply the EXIF orientation, so `image` matches what a browser displays."""
+    # exif_transpose always copies, so only call it when there is a rotation to apply
+    if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        return ImageOps.exif_transpose(image)
+    return image
+
+
+def flatten_to_rgb(image, background=(255, 255, 255)):
+    """Convert any mode to RGB, compositing transparency onto `background`."""
+    if image.mode == 'RGB':
+        return image
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA', 'PA'):
+        rgba = image.convert('RGBA')
+        flat = Image.new('RGB', rgba.size, background)
+        flat.paste(rgba, mask=rgba.getchannel('A'))
+        return flat
+    return image.convert('RGB')
+
+
+def normalize_image(image, max_side=1536, encoding='jpeg', quality=90, source_bytes=None, source_size=None):
+    """Return a NormalizedImage ready to upload.
+
+    `source_bytes` are the bytes `image` was decoded from; when the image
+    needs no changes and is already in the target encoding they are sent
+    as-is instead of being re-encoded. `source_size` is the size the client
+    sent, if `image` was already reduced while decoding (Image.draft).
+    """
+    original_mode = image.mode
+    source_format = (image.format or '').upper()
+    has_metadata = any(key in image.info for key in ('exif', 'icc_profile', 'xmp'))
+
+    # exif_transpose always copies, so only call it when there is a rotation to apply
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    original_size = image.size
+    if source_size:
+        # Orientations 5-8 swap width and height
+        original_size = tuple(source_size)[::-1] if orientation in (5, 6, 7, 8) else tuple(source_size)
+    image = flatten_to_rgb(image)
+    if max_side and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # reducing_gap lets Pillow shrink by whole factors first, which is much faster
+        image = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+
+    pil_format, mime_type = ENCODINGS[encoding]
+    unchanged = image.size == original_size and original_mode == 'RGB' and not has_metadata
+    if source_bytes is not None and unchanged and source_format == pil_format:
+        data = bytes(source_bytes)
+    else:
+        data = encode(image, encoding, quality)
+
+    return NormalizedImage(
+        image=image,
+        data=data,
+        mime_type=mime_type,
+        original_size=original_size,
+        original_mode=original_mode,
+    )
+
+
+def encode(image, encoding='png', quality=90):
+    pil_format, _ = ENCODINGS[encoding]
+    buffer = io.BytesIO()
+    if pil_format == 'PNG':
+        # Level 1 is several times faster than the default for a few % more bytes
+        image.save(buffer, format='PNG', compress_level=1)
+    else:
+        image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+def restore_size(result_bytes, size):
+    """Scale a model result back to `size` (the client's original geometry)."""
+    result = Image.open(io.BytesIO(result_bytes))
+    if result.size == tuple(size):
+        return result_bytes
+    log.debug("Restoring result from %dx%d to %dx%d", result.width, result.height, size[0], size[1])
+    result = flatten_to_rgb(result).resize(tuple(size), Image.LANCZOS)
+    return encode(result, 'png')
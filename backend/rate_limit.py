@@ -0,0 +1,93 @@
+"""Per-client token-bucket rate limiting.
+
+Every client identity (API key, else address) has a bucket that refills at
+`rate` cost units per second up to `burst`. A request takes its route's
+cost from the bucket: interactive requests that do not fit are rejected
+with the time until they would (a 429 with Retry-After), while bulk work
+such as batch items may borrow up to `burst` ahead and otherwise waits, so
+a large batch is slowed to the client's rate rather than refused, and the
+client's interactive requests are never locked out for longer than it
+takes to repay one burst.
+
+Buckets live in this process; idle ones are dropped past `max_clients`
+(an evicted client simply starts again with a full bucket).
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate=0.5, burst=10.0, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+        self._counters = {'allowed': 0, 'limited': 0, 'reserved': 0, 'too_large': 0, 'refunded': 0}
+
+    def acquire(self, key, cost=1.0):
+        """Take `cost` tokens if available; returns 0, or seconds until they would be.
+
+        A cost over `burst` can never be met, and gets math.inf.
+        """
+        with self._lock:
+            if cost > self.burst:
+                self._counters['too_large'] += 1
+                return math.inf
+            tokens = self._refill(key)
+            if tokens >= cost:
+                self._buckets[key][0] = tokens - cost
+                self._counters['allowed'] += 1
+                return 0.0
+            self._counters['limited'] += 1
+            return (cost - tokens) / self.rate
+
+    def reserve(self, key, cost=1.0):
+        """Take `cost` tokens, going up to `burst` into debt; returns 0 once taken.
+
+        When that would take the bucket deeper, nothing is taken and the
+        seconds until it would not are returned: ask again after them.
+        """
+        with self._lock:
+            tokens = self._refill(key)
+            # A full bucket always lends, however small the burst is set
+            if tokens - cost >= -self.burst or tokens >= self.burst:
+                self._buckets[key][0] = tokens - cost
+                self._counters['reserved'] += 1
+                return 0.0
+            return (cost - self.burst - tokens) / self.rate
+
+    def refund(self, key, cost=1.0):
+        """Give back tokens taken for work that was then turned away."""
+        with self._lock:
+            self._buckets[key][0] = min(self.burst, self._refill(key) + cost)
+            self._counters['refunded'] += 1
+
+    def remaining(self, key):
+        with self._lock:
+            return max(0.0, self._refill(key))
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'clients': len(self._buckets),
+                'rate': self.rate,
+                'burst': self.burst,
+            }
+
+    def _refill(self, key):
+        # Caller holds the lock
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket[0]
@@ -0,0 +1,248 @@
+"""Content-addressed cache for model responses.
+
+Entries are keyed on a hash of everything that determines the model output
+(endpoint, prompt, input image bytes, temperature, model id and any extra
+options), so byte-identical retries are answered without another API call.
+
+There are two tiers: an in-memory LRU bounded by total bytes, and an
+optional on-disk tier with a TTL and a size budget that survives restarts
+and is shared by every worker pointed at the same directory.
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from payloads import image_bytes
+
+log = logging.getLogger(__name__)
+
+KEY_VERSION = b'v1'
+
+
+def make_cache_key(endpoint, prompt, images, temperature, model_id, extra=None):
+    """Hash every input that can change the generated image."""
+    digest = hashlib.sha256(KEY_VERSION)
+    header = json.dumps({
+        'endpoint': endpoint,
+        'prompt': prompt,
+        'temperature': temperature,
+        'model': model_id,
+        'extra': extra or {},
+    }, sort_keys=True).encode()
+    digest.update(struct.pack('>I', len(header)))
+    digest.update(header)
+    for image in images:
+        # Length-prefix each image so boundaries between them are unambiguous
+        data = image_bytes(image)
+        digest.update(struct.pack('>Q', len(data)))
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_memory_bytes=64 * 1024 * 1024, disk_dir=None,
+                 disk_ttl=24 * 3600, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (data, meta, size)
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+        }
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = self._scan_disk()
+
+    def get(self, key):
+        """Return (data, meta) for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return entry[0], entry[1]
+
+        entry = self._read_disk(key) if self.disk_dir else None
+        with self._lock:
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['disk_hits'] += 1
+            self._store_memory(key, *entry)
+        return entry
+
+    def put(self, key, data, meta=None):
+        meta = meta or {}
+        data = bytes(data)
+        with self._lock:
+            self._counters['stores'] += 1
+            self._store_memory(key, data, meta)
+        if self.disk_dir:
+            self._write_disk(key, data, meta)
+
+    def touch(self, key):
+        """Mark `key` as recently used and reset its disk TTL.
+
+        Returns False if the entry is missing (from disk, when there is a
+        disk tier), i.e. if it needs to be put again.
+        """
+        with self._lock:
+            present = key in self._memory
+            if present:
+                self._memory.move_to_end(key)
+        if not self.disk_dir:
+            return present
+        try:
+            os.utime(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters['memory_hits'] + self._counters['disk_hits'] + self._counters['misses']
+            hits = lookups - self._counters['misses']
+            return {
+                **self._counters,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'disk_enabled': bool(self.disk_dir),
+                'disk_bytes': self._disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes if self.disk_dir else 0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    # Memory tier (caller holds the lock)
+
+    def _store_memory(self, key, data, meta):
+        size = len(data) + len(json.dumps(meta))
+        if size > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[2]
+        self._memory[key] = (data, meta, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self._counters['memory_evictions'] += 1
+
+    # Disk tier: one file per entry, a length-prefixed JSON header followed by
+    # the raw response bytes. Writes go through a temp file and os.replace so
+    # concurrent workers never see a partial entry.
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.cache")
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.disk_ttl:
+                self._remove_disk(path)
+                return None
+            with open(path, 'rb') as f:
+                (header_len,) = struct.unpack('>I', f.read(4))
+                meta = json.loads(f.read(header_len))
+                data = f.read()
+            return data, meta
+        except FileNotFoundError:
+            return None
+        except Exception as read_err:
+            log.warning("Discarding unreadable cache entry %s: %s", path, read_err)
+            self._remove_disk(path)
+            return None
+
+    def _write_disk(self, key, data, meta):
+        header = json.dumps(meta).encode()
+        path = self._path(key)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('>I', len(header)))
+                f.write(header)
+                f.write(data)
+            # An entry written again replaces the old file, whose size no longer counts;
+            # under the lock so concurrent writers of one key do not both subtract it
+            with self._lock:
+                try:
+                    replaced = os.path.getsize(path)
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmp_path, path)
+                self._disk_bytes += 4 + len(header) + len(data) - replaced
+                over_budget = self._disk_bytes > self.max_disk_bytes
+        except Exception as write_err:
+            log.warning("Error writing cache entry: %s", write_err)
+            return
+        if over_budget:
+            self._evict_disk()
+
+    def _remove_disk(self, path):
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            self._disk_bytes = max(0, self._disk_bytes - size)
+            self._counters['disk_evictions'] += 1
+
+    def _scan_disk(self):
+        total = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.cache'):
+                total += entry.stat().st_size
+        return total
+
+    def _evict_disk(self):
+        """Drop expired entries, then the oldest ones until under budget."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if not entry.name.endswith('.cache'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_disk_bytes and now - mtime <= self.disk_ttl:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._counters['disk_evictions'] += 1
+
+        with self._lock:
+            self._disk_bytes = total
@@ -0,0 +1,278 @@
+"""Coalescing of identical in-flight requests.
+
+When several identical requests arrive together (double submits, several
+tabs, a shared link), only the first one - the leader - runs; the others
+wait for its result instead of making their own upstream call.
+
+Within a process this is a dict of pending calls. Across gunicorn workers
+a backend arbitrates leadership and hands the result over:
+
+- FileBackend: lock and result files in a directory shared by the workers
+- InMemoryBackend: the same protocol within one process, as a stand-in
+  where no shared directory is available (and for exercising the protocol)
+
+Results are (payload, status_code) tuples whose payload may contain bytes.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from payloads import image_bytes
+
+log = logging.getLogger(__name__)
+
+
+def request_fingerprint(operation, data, model_id):
+    """Stable hash of a request, with images hashed by their decoded bytes."""
+    digest = hashlib.sha256(f"{operation}\0{model_id}\0".encode())
+    for key in sorted(data):
+        value = data[key]
+        if isinstance(value, (bytes, bytearray, memoryview)) or (
+                isinstance(value, str) and value.startswith('data:')):
+            value = {'sha256': hashlib.sha256(image_bytes(value)).hexdigest()}
+        digest.update(json.dumps([key, value], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def encode_result(result):
+    payload, status_code = result
+    encoded = {
+        key: {'__bytes__': base64.b64encode(value).decode()}
+        if isinstance(value, (bytes, bytearray, memoryview)) else value
+        for key, value in payload.items()
+    }
+    return json.dumps({'payload': encoded, 'status_code': status_code}).encode()
+
+
+def decode_result(raw):
+    result = json.loads(raw)
+    payload = {
+        key: base64.b64decode(value['__bytes__'])
+        if isinstance(value, dict) and '__bytes__' in value else value
+        for key, value in result['payload'].items()
+    }
+    return payload, result['status_code']
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = True
+
+
+class SingleFlight:
+    def __init__(self, backend=None, wait_timeout=300.0):
+        self.backend = backend
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {'leaders': 0, 'followers': 0, 'remote_followers': 0, 'takeovers': 0, 'retried': 0}
+
+    def do(self, key, fn, shareable=None):
+        """Run `fn()` for `key` unless an identical call is already in flight.
+
+        A result for which `shareable(result)` is false only answers the
+        caller that produced it (e.g. a rejection by its own deadline or
+        rate limit): it is not published, and the followers try again.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters['leaders'] += 1
+            else:
+                self._counters['followers'] += 1
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                return fn()
+            if call.error is not None:
+                raise call.error
+            if not call.shared:
+                with self._lock:
+                    self._counters['retried'] += 1
+                return self.do(key, fn, shareable)
+            return call.result
+
+        try:
+            result = self._lead(key, fn, shareable)
+            call.shared = shareable is None or shareable(result)
+            call.result = result if call.shared else None
+            return result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'in_flight': len(self._calls),
+                    'backend': type(self.backend).__name__ if self.backend else None}
+
+    def _lead(self, key, fn, shareable):
+        if self.backend is None:
+            return fn()
+
+        if self.backend.try_lead(key):
+            try:
+                result = fn()
+                # Unpublished, remote followers see the lock go and take over
+                if shareable is None or shareable(result):
+                    self.backend.publish(key, encode_result(result))
+                return result
+            finally:
+                self.backend.release(key)
+
+        # Another worker is running this request; wait for it to hand over
+        raw = self.backend.wait(key, self.wait_timeout)
+        with self._lock:
+            self._counters['remote_followers' if raw is not None else 'takeovers'] += 1
+        if raw is not None:
+            return decode_result(raw)
+        # The remote leader failed or timed out without a result
+        return fn()
+
+
+class InMemoryBackend:
+    def __init__(self, result_ttl=30.0, poll_interval=0.05):
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._leaders = set()
+        self._results = {}
+
+    def try_lead(self, key):
+        with self._lock:
+            if key in self._leaders:
+                return False
+            self._leaders.add(key)
+            self._results.pop(key, None)
+            return True
+
+    def publish(self, key, raw):
+        with self._lock:
+            self._results[key] = (time.time(), raw)
+
+    def release(self, key):
+        with self._lock:
+            self._leaders.discard(key)
+            cutoff = time.time() - self.result_ttl
+            for stale in [k for k, (at, _) in self._results.items() if at < cutoff]:
+                del self._results[stale]
+
+    def wait(self, key, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if key in self._results:
+                    return self._results[key][1]
+                if key not in self._leaders:
+                    return None
+            time.sleep(self.poll_interval)
+        return None
+
+
+class FileBackend:
+    """Leadership via O_EXCL lock files in a directory shared by all workers.
+
+    Lock files older than `lock_ttl` are treated as left behind by a crashed
+    worker and broken. Results stay readable for `result_ttl` seconds so
+    followers that poll slightly late still find them.
+    """
+
+    def __init__(self, directory, lock_ttl=300.0, result_ttl=30.0, poll_interval=0.05):
+        self.directory = directory
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def _lock_path(self, key):
+        return os.path.join(self.directory, f"{key}.lock")
+
+    def _result_path(self, key):
+        return os.path.join(self.directory, f"{key}.result")
+
+    def try_lead(self, key):
+        path = self._lock_path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._break_stale_lock(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(os.getpid()))
+            # Drop any result left from an earlier flight of the same request
+            self._remove(self._result_path(key))
+            return True
+        return False
+
+    def publish(self, key, raw):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp_path, self._result_path(key))
+
+    def release(self, key):
+        self._remove(self._lock_path(key))
+        self._cleanup()
+
+    def wait(self, key, timeout):
+        lock_path = self._lock_path(key)
+        result_path = self._result_path(key)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with open(result_path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+            if not os.path.exists(lock_path):
+                # Leader finished; check once more in case it published just now
+                try:
+                    with open(result_path, 'rb') as f:
+                        return f.read()
+                except FileNotFoundError:
+                    return None
+            time.sleep(self.poll_interval)
+        return None
+
+    def _break_stale_lock(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) < self.lock_ttl:
+                return False
+        except FileNotFoundError:
+            return True
+        log.warning("Breaking stale single-flight lock %s", path)
+        self._remove(path)
+        return True
+
+    def _cleanup(self):
+        cutoff = time.time() - self.result_ttl
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.result', '.tmp')):
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
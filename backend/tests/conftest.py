@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# The app is configured from the environment when it is imported
+os.environ.setdefault('GOOGLE_API_KEY', 'test')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['DEBUG_CAPTURE'] = 'false'
+os.environ['RESPONSE_CACHE_ENABLED'] = 'false'
+os.environ['RATE_LIMIT_ENABLED'] = 'false'
+os.environ['IMAGE_STORE_DIR'] = tempfile.mkdtemp(prefix='nano-banana-test-')
+
+
+@pytest.fixture
+def fake_upstream():
+    import app
+    from fake_gemini import FakeGeminiClient
+
+    fake = FakeGeminiClient(output_size=(64, 64))
+    previous = app.gemini.client
+    app.gemini.client = fake
+    yield fake
+    app.gemini.client = previous
+
+
+@pytest.fixture
+def client(fake_upstream):
+    import app
+
+    return app.app.test_client()
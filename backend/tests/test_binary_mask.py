@@ -0,0 +1,90 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from binary_mask import MaskError, decode_binary_mask, decode_rle, encode_rle, fit_mask, mask_digest, yellow_overlay
+
+
+def png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('mask', [
+    np.zeros((3, 4), dtype=bool),
+    np.ones((3, 4), dtype=bool),
+    np.eye(5, dtype=bool),
+    np.random.default_rng(0).random((31, 17)) < 0.3,
+])
+def test_rle_round_trip(mask):
+    rle = encode_rle(mask)
+    assert rle['size'] == [mask.shape[1], mask.shape[0]]
+    assert sum(rle['counts']) == mask.size
+    assert np.array_equal(decode_rle(rle), mask)
+
+
+def test_rle_starts_with_an_outside_run():
+    mask = np.array([[True, True, False]])
+    assert encode_rle(mask)['counts'] == [0, 2, 1]
+
+
+@pytest.mark.parametrize('rle, message', [
+    ({'counts': [4]}, 'needs "size"'),
+    ({'size': [2, 2], 'counts': 'abc'}, 'needs "size"'),
+    ({'size': [2, 2], 'counts': [1, 2]}, 'cover 3 pixels, expected 4'),
+    ({'size': [2, 2], 'counts': [5, -1]}, 'negative counts'),
+    ({'size': [0, 2], 'counts': []}, 'invalid size'),
+    ({'size': [2, 2], 'counts': [[1, 3]]}, 'invalid size'),
+])
+def test_bad_rle_is_rejected(rle, message):
+    with pytest.raises(MaskError, match=message):
+        decode_rle(rle)
+
+
+def test_rle_size_is_bounded():
+    with pytest.raises(MaskError, match='too large'):
+        decode_rle({'size': [1000, 1000], 'counts': [1000000]}, max_pixels=1000)
+
+
+def test_decode_accepts_rle_as_json_string():
+    mask = np.eye(4, dtype=bool)
+    assert np.array_equal(decode_binary_mask(json.dumps(encode_rle(mask))), mask)
+    with pytest.raises(MaskError, match='not valid JSON'):
+        decode_binary_mask('{"size": ')
+
+
+def test_decode_image_masks():
+    mask = np.zeros((6, 8), dtype=bool)
+    mask[1:3, 2:5] = True
+    bilevel = Image.fromarray(mask)
+    assert np.array_equal(decode_binary_mask(png(bilevel)), mask)
+    # Grey and alpha masks: in the region above half
+    grey = Image.fromarray(np.where(mask, 200, 40).astype(np.uint8), 'L')
+    assert np.array_equal(decode_binary_mask(png(grey)), mask)
+    alpha = Image.new('RGBA', (8, 6), (0, 0, 0, 0))
+    alpha.putalpha(Image.fromarray(np.where(mask, 255, 0).astype(np.uint8), 'L'))
+    assert np.array_equal(decode_binary_mask(png(alpha)), mask)
+
+
+def test_fit_mask_scales_to_the_image():
+    mask = np.zeros((2, 2), dtype=bool)
+    mask[0, 0] = True
+    fitted = fit_mask(mask, (4, 6))
+    assert fitted.shape == (6, 4)
+    assert fitted[:3, :2].all() and fitted.sum() == 6
+    assert fit_mask(mask, (2, 2)) is mask
+
+
+def test_overlay_and_digest():
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[1, 1] = True
+    overlay = yellow_overlay(Image.new('RGB', (4, 4), 'blue'), mask)
+    assert overlay.getpixel((1, 1)) == (255, 255, 0)
+    assert overlay.getpixel((0, 0)) == (0, 0, 255)
+    # Same pixels at another shape are another mask
+    assert mask_digest(mask) != mask_digest(mask.reshape(2, 8))
+    assert mask_digest(mask) == mask_digest(mask.copy())
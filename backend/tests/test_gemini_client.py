@@ -0,0 +1,182 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import deadlines
+from fake_gemini import FakeAPIError, FakeGeminiClient
+from gemini_client import CircuitOpenError, DeadlineExceeded, GeminiClient
+
+CALL = {'model': 'test-model', 'contents': 'a prompt'}
+
+
+class ScriptedClient:
+    """Raises the given errors one call at a time, then answers like the fake client."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.fake = FakeGeminiClient(output_size=(8, 8))
+        self.models = self
+        self.calls = 0
+
+    def generate_content(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.fake.models.generate_content(**kwargs)
+
+
+def make_client(upstream, **options):
+    options = {'max_retries': 3, 'base_delay': 0.001, 'max_delay': 0.01, **options}
+    return GeminiClient(upstream, **options)
+
+
+def test_retries_429_and_503_then_succeeds():
+    upstream = ScriptedClient(FakeAPIError(429), FakeAPIError(503))
+    client = make_client(upstream)
+    assert client.generate_content(**CALL).parts
+    assert upstream.calls == 3
+    assert client.stats()['retries'] == 2
+    assert client.stats()['successes'] == 1
+
+
+def test_gives_up_after_max_retries():
+    upstream = FakeGeminiClient(error_rate=1.0, error_codes=(503,))
+    client = make_client(upstream, max_retries=2)
+    with pytest.raises(FakeAPIError):
+        client.generate_content(**CALL)
+    assert upstream.stats()['calls'] == 3
+
+
+def test_non_retryable_error_is_not_retried():
+    upstream = ScriptedClient(FakeAPIError(400))
+    client = make_client(upstream)
+    with pytest.raises(FakeAPIError):
+        client.generate_content(**CALL)
+    assert upstream.calls == 1
+    # A bad request says nothing about upstream health
+    assert client.stats()['consecutive_failures'] == 0
+
+
+def with_timeout(kwargs, seconds):
+    # The fake reads the per-call timeout the way the SDK's HttpOptions carries it, in ms
+    return {**kwargs, 'config': SimpleNamespace(http_options=SimpleNamespace(timeout=seconds * 1000))}
+
+
+def test_timeout_at_the_deadline_is_not_retried():
+    upstream = FakeGeminiClient(latency=0.5)
+    client = make_client(upstream, with_timeout=with_timeout)
+    token = deadlines.set_deadline(deadlines.after(0.05))
+    try:
+        with pytest.raises(DeadlineExceeded):
+            client.generate_content(**CALL)
+    finally:
+        deadlines.reset_deadline(token)
+    assert upstream.stats()['calls'] == 1
+    assert upstream.stats()['timeouts'] == 1
+    assert client.stats()['retries'] == 0
+    assert client.stats()['consecutive_failures'] == 0
+
+
+def test_backoff_is_full_jitter_within_the_cap():
+    client = GeminiClient(None, base_delay=0.5, max_delay=8.0)
+    for attempt in range(6):
+        cap = min(8.0, 0.5 * 2 ** attempt)
+        delays = [client._backoff(attempt) for _ in range(500)]
+        assert all(0 <= delay <= cap for delay in delays)
+        # Spread over the whole range, not clustered at the cap
+        assert min(delays) < cap * 0.1 and max(delays) > cap * 0.9
+
+
+def test_breaker_opens_after_consecutive_failures():
+    upstream = FakeGeminiClient(error_rate=1.0, error_codes=(503,))
+    client = make_client(upstream, max_retries=0, breaker_threshold=3, breaker_cooldown=60)
+    for _ in range(3):
+        with pytest.raises(FakeAPIError):
+            client.generate_content(**CALL)
+    assert client.stats()['state'] == 'open'
+    with pytest.raises(CircuitOpenError):
+        client.generate_content(**CALL)
+    assert upstream.stats()['calls'] == 3  # failed fast, upstream not called
+
+
+def test_breaker_half_opens_for_one_trial_then_closes():
+    upstream = ScriptedClient(FakeAPIError(503), FakeAPIError(503))
+    client = make_client(upstream, max_retries=0, breaker_threshold=2, breaker_cooldown=0.05)
+    for _ in range(2):
+        with pytest.raises(FakeAPIError):
+            client.generate_content(**CALL)
+    assert client.stats()['state'] == 'open'
+
+    time.sleep(0.06)
+    assert client.stats()['state'] == 'half_open'
+    client._before_call()  # a trial call is now in flight
+    with pytest.raises(CircuitOpenError):
+        client.generate_content(**CALL)  # so everyone else still fails fast
+    client._release_trial()
+
+    assert client.generate_content(**CALL).parts
+    assert client.stats()['state'] == 'closed'
+
+
+def test_failed_trial_reopens_the_breaker():
+    upstream = ScriptedClient(FakeAPIError(503), FakeAPIError(503), FakeAPIError(503))
+    client = make_client(upstream, max_retries=0, breaker_threshold=2, breaker_cooldown=0.05)
+    for _ in range(2):
+        with pytest.raises(FakeAPIError):
+            client.generate_content(**CALL)
+    time.sleep(0.06)
+    with pytest.raises(FakeAPIError):
+        client.generate_content(**CALL)
+    assert client.stats()['state'] == 'open'
+    assert upstream.calls == 3
+
+
+class DelayedClient:
+    """Answers like the fake client after the next of the given delays (0 once they run out)."""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.fake = FakeGeminiClient(output_size=(8, 8))
+        self.models = self
+        self._lock = threading.Lock()
+
+    def generate_content(self, **kwargs):
+        with self._lock:
+            delay = self.delays.pop(0) if self.delays else 0.0
+        time.sleep(delay)
+        return self.fake.models.generate_content(**kwargs)
+
+
+def primed(upstream, **options):
+    # hedge_min_samples fast calls, so the hedge threshold is known
+    client = make_client(upstream, hedge_percentile=95, hedge_min_samples=20, **options)
+    for _ in range(20):
+        client.generate_content(**CALL)
+    assert client.stats()['hedges'] == 0
+    return client
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    client = primed(DelayedClient([0.0] * 20 + [1.0]), hedge_budget=1.0)
+    started = time.perf_counter()
+    assert client.generate_content(**CALL).parts
+    assert time.perf_counter() - started < 0.5
+    assert client.stats()['hedges'] == 1
+    assert client.stats()['hedge_wins'] == 1
+
+
+def test_hedges_are_capped_by_the_budget():
+    client = primed(DelayedClient([0.0] * 20 + [0.2]), hedge_budget=0.05)
+    started = time.perf_counter()
+    client.generate_content(**CALL)
+    # Not enough calls yet to earn a whole hedge, so the slow call runs its course
+    assert time.perf_counter() - started >= 0.2
+    assert client.stats()['hedges'] == 0
+
+
+def test_no_hedge_without_enough_samples():
+    client = make_client(DelayedClient([0.2]), hedge_percentile=95, hedge_budget=1.0)
+    client.generate_content(**CALL)
+    assert client.stats()['hedges'] == 0
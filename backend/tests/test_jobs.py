@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+from jobs import JobManager, JobQueueFull
+
+
+def echo(data):
+    return {'echo': data['value']}, 200
+
+
+def test_run_does_not_keep_finished_jobs():
+    manager = JobManager({'echo': echo})
+    for value in range(20):
+        assert manager.run('echo', {'value': value}) == ({'echo': value}, 200)
+    assert manager.stats()['jobs'] == {}
+    assert manager.depth() == (0, 0)
+
+
+def test_submitted_jobs_are_kept_for_polling():
+    manager = JobManager({'echo': echo})
+    job = manager.submit('echo', {'value': 1})
+    assert job.wait(5)
+    assert manager.get(job.id) is job
+    assert manager.get(job.id).result == {'echo': 1}
+
+
+def test_run_times_out_with_504():
+    release = threading.Event()
+    manager = JobManager({'block': lambda data: (release.wait(5), 200)})
+    payload, status_code = manager.run('block', {}, timeout=0.05)
+    release.set()
+    assert status_code == 504
+
+
+def test_submit_rejects_when_saturated():
+    release = threading.Event()
+    manager = JobManager({'block': lambda data: (release.wait(5), 200)}, max_workers=1, max_pending=1)
+    manager.submit('block', {})
+    manager.submit('block', {})
+    with pytest.raises(JobQueueFull):
+        manager.submit('block', {})
+    release.set()
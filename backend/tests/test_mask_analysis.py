@@ -0,0 +1,123 @@
+import itertools
+from collections import deque
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from mask_analysis import analyze_mask, find_regions, summarize_mask, yellow_mask
+
+# Values on both sides of every threshold the heuristics use
+EDGES = [0, 100, 119, 120, 121, 159, 160, 161, 179, 180, 181, 199, 200, 201, 219, 220, 221, 254, 255]
+
+
+def scalar_is_yellow(r, g, b):
+    """The per-pixel check /edit-image used before the mask was vectorized."""
+    is_yellow_traditional = (r > 180 and g > 180 and b < 120)
+    is_yellow_ish = (r > 200 and g > 200 and b < 160 and (r + g) > (b * 2.5))
+    is_bright_warm = (r > 220 and g > 200 and r > b and g > b)
+    return is_yellow_traditional or is_yellow_ish or is_bright_warm
+
+
+def image_of(pixels):
+    return Image.fromarray(np.asarray(pixels, dtype=np.uint8).reshape(1, -1, 3), 'RGB')
+
+
+def test_classifier_matches_scalar_heuristic_at_thresholds():
+    pixels = list(itertools.product(EDGES, repeat=3))
+    expected = [scalar_is_yellow(*pixel) for pixel in pixels]
+    assert yellow_mask(image_of(pixels))[0].tolist() == expected
+
+
+def test_classifier_matches_scalar_heuristic_on_random_pixels():
+    rng = np.random.default_rng(1)
+    # Mostly bright, warm pixels, where the heuristics disagree with each other
+    pixels = rng.integers(150, 256, size=(5000, 3))
+    pixels[:, 2] = rng.integers(0, 256, size=5000)
+    expected = [scalar_is_yellow(*map(int, pixel)) for pixel in pixels]
+    assert yellow_mask(image_of(pixels))[0].tolist() == expected
+
+
+def test_classifier_converts_other_modes():
+    image = Image.new('RGBA', (4, 4), (255, 255, 0, 255))
+    assert yellow_mask(image).all()
+
+
+def flood_fill_regions(mask):
+    """8-connected components by breadth-first search: (bbox, pixel count) pairs."""
+    height, width = mask.shape
+    seen = np.zeros_like(mask)
+    regions = []
+    for y, x in zip(*np.nonzero(mask)):
+        if seen[y, x]:
+            continue
+        seen[y, x] = True
+        queue = deque([(y, x)])
+        ys, xs = [], []
+        while queue:
+            cy, cx = queue.popleft()
+            ys.append(cy)
+            xs.append(cx)
+            for ny in range(max(0, cy - 1), min(height, cy + 2)):
+                for nx in range(max(0, cx - 1), min(width, cx + 2)):
+                    if mask[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        queue.append((ny, nx))
+        regions.append(((min(xs), min(ys), max(xs) + 1, max(ys) + 1), len(ys)))
+    return regions
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_regions_match_flood_fill(seed):
+    mask = np.random.default_rng(seed).random((40, 60)) < 0.15
+    found = find_regions(mask, min_region_pixels=1, max_regions=10000)
+    assert sorted((r.bbox, r.pixel_count) for r in found) == sorted(flood_fill_regions(mask))
+    counts = [r.pixel_count for r in found]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_diagonal_pixels_are_one_region():
+    mask = np.eye(6, dtype=bool)
+    regions = find_regions(mask, min_region_pixels=1)
+    assert [(r.bbox, r.pixel_count) for r in regions] == [((0, 0, 6, 6), 6)]
+
+
+def test_large_masks_keep_exact_counts_and_boxes():
+    # Over LABEL_GRID_SIZE, so labelling runs on a coarser grid
+    mask = np.zeros((900, 2000), dtype=bool)
+    mask[100:150, 100:300] = True
+    mask[600:800, 1500:1510] = True
+    regions = find_regions(mask)
+    assert [(r.bbox, r.pixel_count) for r in regions] == [
+        ((100, 100, 300, 150), 10000),
+        ((1500, 600, 1510, 800), 2000),
+    ]
+
+
+def test_small_regions_are_dropped_and_capped():
+    mask = np.zeros((20, 20), dtype=bool)
+    mask[0, 0] = True
+    mask[10:15, 10:15] = True
+    assert [r.pixel_count for r in find_regions(mask, min_region_pixels=2)] == [25]
+    assert len(find_regions(np.eye(20, dtype=bool) | np.eye(20, k=5, dtype=bool), 1, max_regions=1)) == 1
+
+
+def test_summary_of_painted_canvas():
+    image = Image.new('RGB', (100, 50), (30, 60, 90))
+    image.paste((255, 255, 0), (10, 20, 30, 25))
+    analysis = analyze_mask(image)
+    assert analysis.yellow_count == 100
+    assert analysis.bbox == (10, 20, 30, 25)
+    assert analysis.has_yellow
+    assert analysis.to_dict()['regions'] == [{'bbox': [10, 20, 30, 25], 'pixel_count': 100}]
+
+
+def test_has_yellow_thresholds():
+    # 25 pixels of 40,000 is neither more than 25 pixels nor more than 0.1%
+    mask = np.zeros((200, 200), dtype=bool)
+    mask.flat[:25] = True
+    assert not summarize_mask(mask).has_yellow
+    mask.flat[25] = True
+    assert summarize_mask(mask).has_yellow
+    empty = summarize_mask(np.zeros((10, 10), dtype=bool))
+    assert empty.bbox is None and empty.regions == [] and not empty.has_yellow
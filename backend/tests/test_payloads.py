@@ -0,0 +1,92 @@
+import base64
+import io
+
+import pytest
+from flask import Flask, request
+from PIL import Image
+
+from payloads import (OutputOptions, image_bytes, json_payload, output_options, requested_format,
+                      requested_image_format, sniff_image_type)
+
+flask_app = Flask(__name__)
+
+
+def encoded(fmt, size=(40, 20)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'green').save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def decode_data_url(url):
+    header, body = url.split(',', 1)
+    return header, base64.b64decode(body)
+
+
+@pytest.mark.parametrize('query, data, expected', [
+    ('', {}, None),
+    ('?format=jpg', {}, 'jpeg'),
+    ('?format=WEBP', {}, 'webp'),
+    ('?format=gif', {}, None),
+    ('?format=png', {'format': 'jpeg'}, 'jpeg'),  # the body wins over the query string
+])
+def test_requested_format(query, data, expected):
+    with flask_app.test_request_context('/generate' + query):
+        assert requested_format(request, data) == expected
+
+
+@pytest.mark.parametrize('query, accept, expected', [
+    ('', None, None),
+    ('', '*/*', None),
+    ('', 'application/json, image/png;q=0.5', None),
+    ('', 'image/webp', 'webp'),
+    ('', 'image/jpeg, application/json;q=0.1', 'jpeg'),
+    ('?response=image', None, 'png'),
+    ('?response=image&format=jpg', None, 'jpeg'),
+])
+def test_requested_image_format(query, accept, expected):
+    headers = {'Accept': accept} if accept else {}
+    with flask_app.test_request_context('/generate' + query, headers=headers):
+        assert requested_image_format(request, {}) == expected
+
+
+@pytest.mark.parametrize('data, quality, preview_side', [
+    ({}, 90, 0),
+    ({'quality': 500, 'preview': True}, 100, 384),
+    ({'quality': 'bad', 'preview': '200'}, 90, 200),
+    ({'quality': '0', 'preview': 'yes'}, 1, 384),
+    ({'quality': -5, 'preview': False}, 1, 0),
+])
+def test_output_options(data, quality, preview_side):
+    with flask_app.test_request_context('/generate'):
+        options = output_options(request, data)
+    assert (options.quality, options.preview_side) == (quality, preview_side)
+
+
+def test_json_payload_labels_bytes_by_their_content():
+    jpeg = encoded('JPEG')
+    payload = json_payload({'generated_image': jpeg, 'texts': ['hi']})
+    header, body = decode_data_url(payload['generated_image'])
+    assert header == 'data:image/jpeg;base64'
+    assert body == jpeg  # passed through untouched
+    assert payload['texts'] == ['hi']
+
+
+def test_json_payload_transcodes_and_adds_preview():
+    payload = json_payload({'edited_image': encoded('PNG', (800, 400))},
+                           OutputOptions(format='webp', quality=80, preview_side=100))
+    header, body = decode_data_url(payload['edited_image'])
+    assert header == 'data:image/webp;base64'
+    assert Image.open(io.BytesIO(body)).size == (800, 400)
+    header, body = decode_data_url(payload['edited_image_preview'])
+    assert header == 'data:image/webp;base64'
+    assert Image.open(io.BytesIO(body)).size == (100, 50)
+
+
+def test_sniff_and_image_bytes():
+    for fmt, mime_type in (('PNG', 'image/png'), ('JPEG', 'image/jpeg'), ('WEBP', 'image/webp')):
+        data = encoded(fmt)
+        assert sniff_image_type(data) == mime_type
+        assert image_bytes('data:x;base64,' + base64.b64encode(data).decode()) == data
+        assert image_bytes(base64.b64encode(data).decode()) == data
+    assert sniff_image_type(b'GIF89a') == 'application/octet-stream'
+    assert image_bytes(None) == b''
@@ -0,0 +1,46 @@
+import math
+
+import pytest
+
+from rate_limit import TokenBucketLimiter
+
+
+def test_acquire_until_empty_then_retry_after():
+    limiter = TokenBucketLimiter(rate=1.0, burst=3.0)
+    assert limiter.acquire('a', 2) == 0
+    retry_after = limiter.acquire('a', 2)
+    assert 0.9 < retry_after <= 1.0
+    assert limiter.acquire('b', 3) == 0  # buckets are per client
+
+
+def test_cost_over_burst_never_fits():
+    limiter = TokenBucketLimiter(rate=1.0, burst=3.0)
+    assert math.isinf(limiter.acquire('a', 4))
+    assert limiter.remaining('a') == 3.0  # nothing was taken
+    assert limiter.stats()['too_large'] == 1
+
+
+def test_reserve_borrows_at_most_one_burst_ahead():
+    limiter = TokenBucketLimiter(rate=2.0, burst=2.0)
+    assert limiter.reserve('a', 2) == 0
+    assert limiter.reserve('a', 2) == 0  # now 2 tokens in debt
+    wait = limiter.reserve('a', 2)
+    assert 0.9 < wait <= 1.0
+    assert limiter.stats()['reserved'] == 2  # the refused reservation took nothing
+    # Interactive requests are only locked out until one burst is repaid
+    assert 1.9 < limiter.acquire('a', 2) <= 2.0
+
+
+def test_full_bucket_lends_more_than_the_burst():
+    limiter = TokenBucketLimiter(rate=1.0, burst=1.0)
+    assert limiter.reserve('a', 5) == 0
+    assert limiter.reserve('a', 1) > 0
+
+
+def test_refund_returns_tokens_up_to_the_burst():
+    limiter = TokenBucketLimiter(rate=0.001, burst=3.0)
+    assert limiter.acquire('a', 2) == 0
+    limiter.refund('a', 2)
+    assert limiter.remaining('a') == pytest.approx(3.0)
+    limiter.refund('a', 2)
+    assert limiter.remaining('a') == pytest.approx(3.0)
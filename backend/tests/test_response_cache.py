@@ -0,0 +1,103 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from response_cache import ResponseCache, make_cache_key
+
+
+def test_key_covers_every_input():
+    base = make_cache_key('edit-whole', 'x', [b'image'], 0.4, 'model', {'settings': {'input': [1536, 'jpeg', 90]}})
+    assert base == make_cache_key('edit-whole', 'x', [b'image'], 0.4, 'model', {'settings': {'input': [1536, 'jpeg', 90]}})
+    assert base != make_cache_key('edit-whole', 'x', [b'image'], 0.4, 'model', {'settings': {'input': [1536, 'jpeg', 80]}})
+    assert base != make_cache_key('edit-whole', 'x', [b'other'], 0.4, 'model', {'settings': {'input': [1536, 'jpeg', 90]}})
+    assert base != make_cache_key('edit-whole', 'y', [b'image'], 0.4, 'model', {'settings': {'input': [1536, 'jpeg', 90]}})
+
+
+def test_overwriting_a_disk_entry_counts_its_size_once(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    for _ in range(3):
+        cache.put('k', b'x' * 1000)
+    assert cache.stats()['disk_bytes'] == cache._scan_disk()
+    assert cache.stats()['disk_evictions'] == 0
+
+
+def test_app_keys_change_with_input_settings(monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, 'RESPONSE_CACHE_ENABLED', True)
+    key = app.response_cache_key({}, 'generate', 'x', [], 0.7)
+    monkeypatch.setitem(app.CACHE_KEY_SETTINGS, 'input', [1024, 'webp', 80])
+    assert app.response_cache_key({}, 'generate', 'x', [], 0.7) != key
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = ResponseCache(max_memory_bytes=3000)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, b'x' * 900)
+    assert cache.get('a') is not None  # now most recently used
+    cache.put('d', b'x' * 900)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats()['memory_evictions'] == 1
+    assert cache.stats()['memory_bytes'] <= 3000
+
+
+def test_entries_larger_than_memory_tier_are_not_kept():
+    cache = ResponseCache(max_memory_bytes=100)
+    cache.put('big', b'x' * 200)
+    assert cache.get('big') is None
+
+
+def test_disk_tier_survives_a_new_instance_and_keeps_meta(tmp_path):
+    ResponseCache(disk_dir=str(tmp_path)).put('k', b'image', {'texts': ['hi']})
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    assert cache.get('k') == (b'image', {'texts': ['hi']})
+    assert cache.stats()['disk_hits'] == 1
+
+
+def test_disk_entries_expire(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_ttl=60)
+    cache.put('k', b'image')
+    cache.clear()
+    path = cache._path('k')
+    stale = time.time() - 120
+    os.utime(path, (stale, stale))
+    assert cache.get('k') is None
+    assert not os.path.exists(path)
+    assert cache.stats()['disk_bytes'] == 0
+
+
+def test_disk_tier_evicts_oldest_over_budget(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), max_disk_bytes=2500)
+    for index, key in enumerate(('a', 'b', 'c')):
+        cache.put(key, b'x' * 1000)
+        written = time.time() - 100 + index
+        os.utime(cache._path(key), (written, written))
+    assert not os.path.exists(cache._path('a'))
+    assert os.path.exists(cache._path('b')) and os.path.exists(cache._path('c'))
+    assert cache.stats()['disk_bytes'] == cache._scan_disk() <= 2500
+
+
+def test_touch_refreshes_disk_ttl(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_ttl=60)
+    cache.put('k', b'image')
+    stale = time.time() - 120
+    os.utime(cache._path('k'), (stale, stale))
+    assert cache.touch('k')
+    cache.clear()
+    assert cache.get('k') == (b'image', {})
+    assert not cache.touch('missing')
+
+
+def test_concurrent_writers_keep_disk_size_exact(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path))
+
+    def write(worker):
+        for index in range(50):
+            cache.put(f'key-{index % 10}', bytes([worker]) * (100 + index))
+            cache.get(f'key-{(index + worker) % 10}')
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(write, range(8)))
+    assert len(os.listdir(tmp_path)) == 10
+    assert cache.stats()['disk_bytes'] == cache._scan_disk()
@@ -0,0 +1,178 @@
+import base64
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+def png_bytes(size=(64, 64), color='red', mark=None):
+    image = Image.new('RGB', size, color)
+    if mark:
+        image.paste((255, 255, 0), mark)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def data_url(data):
+    return 'data:image/png;base64,' + base64.b64encode(data).decode()
+
+
+def rotated_jpeg(size, color='blue', orientation=6):
+    """JPEG stored at `size` that a browser shows rotated by its EXIF orientation."""
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+def record_model_images(fake_upstream, monkeypatch):
+    """Collect every image sent to the fake upstream, decoded."""
+    from fake_gemini import content_items
+
+    sent = []
+    generate_content = fake_upstream.models.generate_content
+
+    def recording(model, contents, config=None):
+        sent.extend(Image.open(io.BytesIO(value)).convert('RGB') for kind, value in content_items(contents) if kind == 'image')
+        return generate_content(model, contents, config)
+
+    monkeypatch.setattr(fake_upstream.models, 'generate_content', recording)
+    return sent
+
+
+def yellow_box(image):
+    pixels = np.asarray(image).astype(int)
+    yellow = (pixels[..., 0] > 200) & (pixels[..., 1] > 200) & (pixels[..., 2] < 80)
+    ys, xs = np.nonzero(yellow)
+    return xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+
+
+def test_edit_image_accepts_raw_painted_mask(client):
+    body = png_bytes(mark=(10, 10, 30, 30))
+    response = client.post('/edit-image?prompt=make+it+blue', data=body, headers={'Content-Type': 'image/png'})
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()['edited_image'].startswith('data:image/')
+
+
+def test_edit_image_binary_mask_needs_image(client):
+    mask = Image.new('1', (64, 64))
+    buffer = io.BytesIO()
+    mask.save(buffer, 'PNG')
+    response = client.post('/edit-image', json={'prompt': 'x', 'binary_mask': data_url(buffer.getvalue())})
+    assert response.status_code == 400
+    assert 'image' in response.get_json()['error']
+
+
+def test_binary_mask_applies_to_upright_photo(client, fake_upstream, monkeypatch):
+    from binary_mask import encode_rle
+
+    sent = record_model_images(fake_upstream, monkeypatch)
+    # Stored 400x200, shown 200x400; the mask covers the top quarter of what the browser showed
+    mask = np.zeros((400, 200), dtype=bool)
+    mask[:100] = True
+    body = {'prompt': 'x', 'image': data_url(rotated_jpeg((400, 200))), 'binary_mask': encode_rle(mask),
+            'crop_to_mask': False, 'include_overview': False}
+    response = client.post('/edit-image', json=body)
+    assert response.status_code == 200, response.get_json()
+    assert sent[0].size == (200, 400)
+    left, top, right, bottom = yellow_box(sent[0])
+    assert (left, top) == (0, 0)
+    assert right == 200 and abs(bottom - 100) <= 2
+
+
+
+def test_crop_to_mask_composites_onto_upright_photo(client):
+    # Stored 800x400, shown 400x800; the doodle is near the top left of the upright canvas
+    canvas = Image.new('RGB', (400, 800), 'blue')
+    canvas.paste((255, 255, 0), (100, 100, 200, 200))
+    buffer = io.BytesIO()
+    canvas.save(buffer, 'PNG')
+    body = {'prompt': 'x', 'image': data_url(rotated_jpeg((800, 400))), 'mask': data_url(buffer.getvalue()),
+            'crop_to_mask': True}
+    response = client.post('/edit-image', json=body)
+    assert response.status_code == 200, response.get_json()
+    result = Image.open(io.BytesIO(base64.b64decode(response.get_json()['edited_image'].split(',', 1)[1])))
+    assert result.size == (400, 800)
+    # Only the patch around the doodle differs from the blue original
+    pixels = np.asarray(result.convert('RGB')).astype(int)
+    changed = np.abs(pixels - [0, 0, 255]).sum(axis=-1) > 96
+    ys, xs = np.nonzero(changed)
+    assert xs.min() <= 100 and ys.min() <= 100 and xs.max() >= 199 and ys.max() >= 199
+    assert xs.max() < 400 and ys.max() < 400
+
+
+@pytest.mark.parametrize('value', [{'data': 'abc'}, ['abc'], 42])
+def test_non_string_image_is_rejected(client, value):
+    response = client.post('/edit-whole', json={'prompt': 'x', 'image': value})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'image must be a base64 string or image_id'
+
+
+def test_tiled_edit_charges_every_tile(client, fake_upstream, monkeypatch):
+    import app
+    from rate_limit import TokenBucketLimiter
+
+    monkeypatch.setattr(app, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(app, 'rate_limiter', TokenBucketLimiter(rate=0.001, burst=20))
+    image = data_url(png_bytes(size=(2100, 1000)))
+    response = client.post('/edit-whole', json={'prompt': 'x', 'image': image, 'tiled': True})
+    assert response.status_code == 200, response.get_json()
+    payload = response.get_json()
+    assert payload['tiles'] == 3
+    assert fake_upstream.stats()['calls'] == 4
+    # One edit-whole (2 units) on admission, then 2 units for each tile
+    assert app.rate_limiter.remaining('ip:127.0.0.1') == pytest.approx(20 - 2 - 3 * 2, abs=0.1)
+
+
+def test_tiled_edit_over_the_rate_makes_no_model_calls(client, fake_upstream, monkeypatch):
+    import app
+    from rate_limit import TokenBucketLimiter
+
+    monkeypatch.setattr(app, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(app, 'rate_limiter', TokenBucketLimiter(rate=0.001, burst=6))
+    image = data_url(png_bytes(size=(2100, 1000)))
+    response = client.post('/edit-whole', json={'prompt': 'x', 'image': image, 'tiled': True})
+    assert response.status_code == 429
+    assert fake_upstream.stats()['calls'] == 0
+
+
+def test_busy_server_refunds_the_rate_limit(client, monkeypatch):
+    import app
+    from jobs import JobQueueFull
+    from rate_limit import TokenBucketLimiter
+
+    def full(*args, **kwargs):
+        raise JobQueueFull('full')
+
+    monkeypatch.setattr(app, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(app, 'rate_limiter', TokenBucketLimiter(rate=0.001, burst=4))
+    monkeypatch.setattr(app.job_manager, 'submit', full)
+    for path in ('/generate', '/jobs/generate'):
+        response = client.post(path, json={'prompt': 'x'})
+        assert response.status_code == 503
+    assert app.rate_limiter.remaining('ip:127.0.0.1') == pytest.approx(4, abs=0.1)
+
+
+@pytest.mark.parametrize('temperature', ['hot', None, [1], float('nan')])
+def test_generate_rejects_a_bad_temperature(client, temperature):
+    response = client.post('/generate', json={'prompt': 'x', 'temperature': temperature})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '"temperature" must be a number'
+
+
+@pytest.mark.parametrize('temperature, sent', [(5, 2.0), (-1, 0.0), ('0.9', 0.9)])
+def test_generate_clamps_the_temperature(client, fake_upstream, monkeypatch, temperature, sent):
+    configs = []
+    generate_content = fake_upstream.models.generate_content
+
+    def recording(model, contents, config=None):
+        configs.append(config)
+        return generate_content(model, contents, config)
+
+    monkeypatch.setattr(fake_upstream.models, 'generate_content', recording)
+    response = client.post('/generate', json={'prompt': 'x', 'temperature': temperature})
+    assert response.status_code == 200, response.get_json()
+    assert configs[0].temperature == pytest.approx(sent)
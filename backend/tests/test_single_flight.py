@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+from single_flight import FileBackend, InMemoryBackend, SingleFlight, decode_result, encode_result
+
+
+def shareable(result):
+    return result[1] < 400
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def run_in_threads(targets):
+    results = [None] * len(targets)
+
+    def run(index, target):
+        results[index] = target()
+
+    threads = [threading.Thread(target=run, args=(index, target)) for index, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_followers_share_the_leaders_result():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return {'image': b'x'}, 200
+
+    threads, results = run_in_threads([lambda: flight.do('k', call, shareable)] * 3)
+    wait_for(lambda: flight.stats()['followers'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [({'image': b'x'}, 200)] * 3
+    assert len(calls) == 1
+
+
+def test_followers_retry_after_a_caller_specific_result():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def leader_call():
+        release.wait(5)
+        return {'error': 'Request deadline passed'}, 504
+
+    def follower_call():
+        return {'image': b'x'}, 200
+
+    threads, results = run_in_threads([lambda: flight.do('k', leader_call, shareable)])
+    wait_for(lambda: flight.stats()['leaders'] == 1)
+    more, follower_results = run_in_threads([lambda: flight.do('k', follower_call, shareable)] * 2)
+    wait_for(lambda: flight.stats()['followers'] == 2)
+    release.set()
+    for thread in threads + more:
+        thread.join()
+    assert results == [({'error': 'Request deadline passed'}, 504)]
+    assert follower_results == [({'image': b'x'}, 200)] * 2
+    assert flight.stats()['retried'] == 2
+
+
+def test_remote_followers_take_over_after_a_caller_specific_result():
+    backend = InMemoryBackend(poll_interval=0.005)
+    leader, follower = SingleFlight(backend), SingleFlight(backend)
+    release = threading.Event()
+
+    def leader_call():
+        release.wait(5)
+        return {'error': 'Too many requests'}, 429
+
+    threads, results = run_in_threads([lambda: leader.do('k', leader_call, shareable)])
+    wait_for(lambda: 'k' in backend._leaders)
+    more, follower_results = run_in_threads([lambda: follower.do('k', lambda: ({'image': b'x'}, 200), shareable)])
+    wait_for(lambda: follower.stats()['leaders'] == 1)
+    time.sleep(0.02)
+    release.set()
+    for thread in threads + more:
+        thread.join()
+    assert results == [({'error': 'Too many requests'}, 429)]
+    assert follower_results == [({'image': b'x'}, 200)]
+    assert follower.stats()['takeovers'] == 1
+
+
+def test_file_backend_runs_one_call_across_workers(tmp_path):
+    # Each SingleFlight stands for a gunicorn worker sharing the directory
+    workers = [SingleFlight(FileBackend(str(tmp_path), poll_interval=0.005)) for _ in range(3)]
+    calls = []
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            calls.append(1)
+        time.sleep(0.2)
+        return {'image': b'\x89PNG', 'texts': ['done']}, 200
+
+    targets = [lambda flight=flight: flight.do('k', call, shareable) for flight in workers for _ in range(4)]
+    threads, results = run_in_threads(targets)
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [({'image': b'\x89PNG', 'texts': ['done']}, 200)] * 12
+    assert sum(flight.stats()['remote_followers'] for flight in workers) == 2
+    assert not any(name.endswith('.lock') for name in os.listdir(tmp_path))
+
+
+def test_file_backend_breaks_stale_locks(tmp_path):
+    backend = FileBackend(str(tmp_path), lock_ttl=60)
+    lock_path = tmp_path / 'k.lock'
+    lock_path.write_text('12345')
+    assert not backend.try_lead('k')
+    stale = time.time() - 120
+    os.utime(lock_path, (stale, stale))
+    assert backend.try_lead('k')
+    backend.release('k')
+    assert not lock_path.exists()
+
+
+def test_file_backend_follower_takes_over_when_leader_fails(tmp_path):
+    leader = SingleFlight(FileBackend(str(tmp_path), poll_interval=0.005))
+    follower = SingleFlight(FileBackend(str(tmp_path), poll_interval=0.005))
+    release = threading.Event()
+
+    def failing_call():
+        release.wait(5)
+        raise RuntimeError('upstream broke')
+
+    errors = []
+
+    def lead():
+        try:
+            leader.do('k', failing_call)
+        except RuntimeError as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    wait_for(lambda: (tmp_path / 'k.lock').exists())
+    threads, results = run_in_threads([lambda: follower.do('k', lambda: ({'image': b'x'}, 200))])
+    time.sleep(0.02)
+    release.set()
+    for t in threads + [thread]:
+        t.join()
+    assert len(errors) == 1
+    assert results == [({'image': b'x'}, 200)]
+    assert follower.stats()['takeovers'] == 1
+
+
+def test_results_round_trip_through_the_backend():
+    result = ({'image': b'\x00\xffbytes', 'texts': ['a'], 'cached': False}, 201)
+    assert decode_result(encode_result(result)) == result
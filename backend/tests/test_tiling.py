@@ -0,0 +1,48 @@
+import numpy as np
+from PIL import Image
+
+from tiling import blend_tiles, plan_tiles
+
+
+def gradient(size):
+    width, height = size
+    ys, xs = np.mgrid[0:height, 0:width]
+    return np.stack([xs * 255 // width, ys * 255 // height, (xs + ys) % 256], -1).astype(np.uint8)
+
+
+def test_tiles_cover_the_image_with_overlap():
+    boxes = plan_tiles((3000, 2000), tile_side=1024, overlap=128)
+    assert len(boxes) == 4 * 3
+    assert boxes[0][:2] == (0, 0) and boxes[-1][2:] == (3000, 2000)
+    xs = sorted({box[0] for box in boxes})
+    assert all(b - a <= 1024 - 128 for a, b in zip(xs, xs[1:]))
+
+
+def test_tiles_grow_instead_of_passing_the_limit():
+    boxes = plan_tiles((12000, 8000), tile_side=1024, overlap=128, max_tiles=24)
+    assert len(boxes) <= 24
+    assert boxes[-1][2:] == (12000, 8000)
+
+
+def test_small_image_is_one_tile():
+    assert plan_tiles((800, 600)) == [(0, 0, 800, 600)]
+
+
+def test_unchanged_tiles_reassemble_exactly():
+    pixels = gradient((2500, 1800))
+    source = Image.fromarray(pixels)
+    boxes = plan_tiles(source.size, tile_side=1024, overlap=128)
+    result = blend_tiles(source.size, ((box, source.crop(box)) for box in boxes))
+    assert np.array_equal(np.asarray(result), pixels)
+
+
+def test_seams_are_blended():
+    pixels = gradient((2500, 1000))
+    source = Image.fromarray(pixels)
+    boxes = plan_tiles(source.size, tile_side=1024, overlap=128)
+    # Every other tile comes back 40 levels brighter
+    tiles = [(box, Image.fromarray(np.clip(pixels[box[1]:box[3], box[0]:box[2]].astype(int) + 40 * (i % 2), 0, 255).astype(np.uint8)))
+             for i, box in enumerate(boxes)]
+    result = np.asarray(blend_tiles(source.size, tiles)).astype(int)
+    offset = result[500, :, 1] - pixels[500, :, 1]
+    assert np.abs(np.diff(offset)).max() <= 2
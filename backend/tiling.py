@@ -0,0 +1,85 @@
+"""Tiled processing of large images for whole-image edits.
+
+The model answers with an image of about a megapixel whatever it is sent,
+so a 24 MP photo edited in one piece comes back heavily downscaled. In
+tiled mode /edit-whole cuts the photo into overlapping tiles of about the
+model's native size, edits each one on its own (next to the matching
+region of an edited low-resolution copy of the whole frame, so colours and
+style agree between tiles) and puts the results back together at full
+resolution, cross-fading the overlaps so no seams show.
+"""
+import math
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_TILE_SIDE = 1024
+DEFAULT_OVERLAP = 128
+DEFAULT_MAX_TILES = 24
+
+
+def plan_tiles(image_size, tile_side=DEFAULT_TILE_SIDE, overlap=DEFAULT_OVERLAP, max_tiles=DEFAULT_MAX_TILES):
+    """Return the boxes of overlapping tiles covering the image, row by row.
+
+    Tiles are spread evenly so neighbours overlap by at least `overlap`
+    pixels. If that takes more than `max_tiles` tiles, the tiles grow
+    instead of multiplying.
+    """
+    width, height = image_size
+    while True:
+        xs = _starts(width, tile_side, overlap)
+        ys = _starts(height, tile_side, overlap)
+        if len(xs) * len(ys) <= max_tiles:
+            break
+        tile_side = int(tile_side * 1.25)
+    tile_width = min(tile_side, width)
+    tile_height = min(tile_side, height)
+    return [(x, y, x + tile_width, y + tile_height) for y in ys for x in xs]
+
+
+def _starts(length, tile_side, overlap):
+    if length <= tile_side:
+        return [0]
+    count = math.ceil((length - overlap) / (tile_side - overlap))
+    step = (length - tile_side) / (count - 1)
+    return [round(i * step) for i in range(count)]
+
+
+def blend_tiles(size, tiles):
+    """Assemble (box, image) tiles, in plan_tiles() order, into one image of `size`.
+
+    Each tile is resized to its box, since the model is free to return
+    another resolution, and pasted over the tiles before it with its left
+    and top edges fading in across the overlap with them.
+    """
+    canvas = Image.new('RGB', size)
+    placed = []
+    for box, tile in tiles:
+        left, top, right, bottom = box
+        tile_size = (right - left, bottom - top)
+        if tile.mode != 'RGB':
+            tile = tile.convert('RGB')
+        if tile.size != tile_size:
+            tile = tile.resize(tile_size, Image.LANCZOS)
+        fade_left = max((r - left for l, t, r, b in placed if t == top and l < left < r), default=0)
+        fade_top = max((b - top for l, t, r, b in placed if l == left and t < top < b), default=0)
+        canvas.paste(tile, (left, top), seam_alpha(tile_size, fade_left, fade_top))
+        placed.append(box)
+    return canvas
+
+
+def seam_alpha(size, fade_left, fade_top):
+    """Alpha mask of a tile: ramps up over `fade_left` / `fade_top` pixels, opaque elsewhere."""
+    width, height = size
+    alpha = np.outer(_ramp(height, fade_top), _ramp(width, fade_left))
+    return Image.fromarray((alpha * 255).round().astype(np.uint8), 'L')
+
+
+def _ramp(length, fade):
+    ramp = np.ones(length, dtype=np.float32)
+    fade = min(fade, length)
+    if fade > 0:
+        # Smoothstep looks less banded than a linear ramp
+        t = (np.arange(fade, dtype=np.float32) + 0.5) / fade
+        ramp[:fade] = t * t * (3 - 2 * t)
+    return ramp
@@ -0,0 +1,134 @@
+"""Request tracing, level-gated logging and opt-in profiling.
+
+Each HTTP request gets a Trace held in a context variable. Pipeline stages
+recorded while it is current (see StageTimer's on_mark) end up in the
+response's Server-Timing header, and log records carry its request id.
+The job pool copies the submitter's context, so stages recorded on a
+worker thread still land in the right trace.
+
+Logging goes through the standard `logging` module with %-style arguments,
+so disabled levels cost a level check and no string formatting. Dumps
+that are expensive to even build should be guarded with
+`log.isEnabledFor(logging.DEBUG)`.
+
+A trace can also ask for its operation to run under cProfile; the stats
+are dumped to `<directory>/<request_id>.prof` for later analysis with
+pstats or snakeviz.
+"""
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+_current = contextvars.ContextVar('trace', default=None)
+
+# Libraries whose DEBUG output would drown ours (PIL logs every PNG chunk)
+NOISY_LOGGERS = ('PIL', 'urllib3', 'httpx', 'httpcore', 'google_genai')
+
+
+class Trace:
+    def __init__(self, request_id=None, profile=False):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.profile = profile
+        self.profile_path = None
+        self.started = time.perf_counter()
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages.append((stage, seconds))
+
+    def server_timing(self):
+        """Server-Timing header value: one metric per stage plus the total, in ms."""
+        with self._lock:
+            stages = list(self.stages)
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(entries)
+
+
+def start(request_id=None, profile=False):
+    """Make a new trace current; returns (trace, token) for `finish`."""
+    trace = Trace(request_id, profile)
+    return trace, _current.set(trace)
+
+
+def finish(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def record_stage(stage, seconds):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+def profiling():
+    trace = _current.get()
+    return trace is not None and trace.profile
+
+
+def profiled(fn, directory):
+    """Wrap `fn` so it runs under cProfile when the current trace asks for it."""
+
+    def run(*args, **kwargs):
+        trace = _current.get()
+        if trace is None or not trace.profile:
+            return fn(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{trace.request_id}.prof")
+            profiler.dump_stats(path)
+            trace.profile_path = path
+            logging.getLogger(__name__).info("Wrote profile %s", path)
+
+    return run
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        trace = _current.get()
+        record.request_id = trace.request_id if trace else '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(level='INFO', json_format=False):
+    """Send log records to stdout, as plain text or one JSON object per line."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(_RequestIdFilter())
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(root.level, logging.INFO))
@@ -45,6 +45,64 @@ function App() {
   // Ref to access CanvasEditor methods
   const canvasEditorRef = React.useRef(null);
 
+  // Compact 1-bit version of the current mask composite, sent instead of it
+  const binaryMaskRef = React.useRef(null);
+
+  // Server-side ids of images the backend already has, keyed by data URL,
+  // so repeated edits of the same picture don't upload it again
+  const imageIds = React.useRef(new Map());
+
+  // POST `fields` plus `images` ({ field: dataUrl }), sending known images as "<field>_id"
+  const postWithImages = async (path, images, fields) => {
+    const send = (useIds) => {
+      const body = { ...fields };
+      Object.entries(images).forEach(([name, dataUrl]) => {
+        const id = useIds && imageIds.current.get(dataUrl);
+        if (id) {
+          body[`${name}_id`] = id;
+        } else {
+          body[name] = dataUrl;
+        }
+      });
+      return fetch(`${API_BASE_URL}${path}`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(body),
+      });
+    };
+
+    const response = await send(true);
+    if (response.status === 404) {
+      // The server no longer has an image (expired or restarted): send everything inline
+      const data = await response.clone().json().catch(() => ({}));
+      if (data.missing_image_id) {
+        imageIds.current.clear();
+        return send(false);
+      }
+    }
+    return response;
+  };
+
+  // Remember the ids the server returned for the images we sent and received
+  const rememberImageIds = (images, data) => {
+    const remember = (dataUrl, id) => {
+      imageIds.current.delete(dataUrl);
+      imageIds.current.set(dataUrl, id);
+      // Keep only the most recent images so old canvases and masks can be freed
+      while (imageIds.current.size > 16) {
+        imageIds.current.delete(imageIds.current.keys().next().value);
+      }
+    };
+    Object.entries(data.input_ids || {}).forEach(([name, id]) => {
+      if (images[name]) remember(images[name], id);
+    });
+    ['edited_image', 'blended_image', 'generated_image'].forEach((key) => {
+      if (data[key] && data[`${key}_id`]) remember(data[key], data[`${key}_id`]);
+    });
+  };
+
   // Magic loading messages
   const magicMessages = [
     "✨ Weaving digital magic...",
@@ -113,19 +171,11 @@ function App() {
 
     startMagicLoading();
     try {
-      const response = await fetch(`${API_BASE_URL}/blend-images`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          baseImage: uploadedImage,
-          blendImage: blendImage,
-          prompt: prompt,
-        }),
-      });
+      const images = { baseImage: uploadedImage, blendImage: blendImage };
+      const response = await postWithImages('/blend-images', images, { prompt: prompt });
 
       const data = await response.json();
+      rememberImageIds(images, data);
       if (data.blended_image) {
         setEditedImage(data.blended_image);
         setHistory([...history, { 
@@ -158,8 +208,9 @@ function App() {
     }
   };
 
-  const handleMaskChange = (maskData) => {
+  const handleMaskChange = (maskData, binaryMask) => {
     console.log('App: Mask data received:', maskData ? 'Yes' : 'No');
+    binaryMaskRef.current = maskData && binaryMask ? { composite: maskData, rle: binaryMask } : null;
     
     if (maskData) {
       // Store last valid mask in a global variable to prevent it from disappearing
@@ -307,20 +358,18 @@ function App() {
     
     try {
       console.log('Sending edit request to API...');
-      const requestData = {
-        image: uploadedImage,
-        mask: maskData,  // Use the passed maskData instead of the state variable
-        prompt: prompt,
-      };
+      const images = { image: uploadedImage };
+      const fields = { prompt: prompt };
+      const binaryMask = binaryMaskRef.current;
+      if (binaryMask && binaryMask.composite === maskData) {
+        // The server draws the yellow overlay itself from the exact stroke mask
+        fields.binary_mask = binaryMask.rle;
+      } else {
+        images.mask = maskData;  // Use the passed maskData instead of the state variable
+      }
       console.log('Request data prepared, sending to API...');
       
-      const response = await fetch(`${API_BASE_URL}/edit-image`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(requestData),
-      });
+      const response = await postWithImages('/edit-image', images, fields);
 
       if (!response.ok) {
         const errorText = await response.text();
@@ -329,6 +378,7 @@ function App() {
 
       const data = await response.json();
       console.log('API response:', data);
+      rememberImageIds(images, data);
       
       // Save all response data for debugging
       window.lastApiResponse = data;
@@ -377,15 +427,10 @@ function App() {
   const handleGenerate = async (prompt) => {
     startMagicLoading();
     try {
-      const response = await fetch(`${API_BASE_URL}/generate`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ prompt }),
-      });
+      const response = await postWithImages('/generate', {}, { prompt });
 
       const data = await response.json();
+      rememberImageIds({}, data);
       if (data.generated_image) {
         setGeneratedImage(data.generated_image);
         setHistory([...history, { type: 'generate', image: data.generated_image }]);
@@ -407,18 +452,11 @@ function App() {
 
     startMagicLoading();
     try {
-      const response = await fetch(`${API_BASE_URL}/edit-whole`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          image: uploadedImage,
-          prompt: prompt,
-        }),
-      });
+      const images = { image: uploadedImage };
+      const response = await postWithImages('/edit-whole', images, { prompt: prompt });
 
       const data = await response.json();
+      rememberImageIds(images, data);
       if (data.edited_image) {
         setEditedImage(data.edited_image);
         setHistory([...history, { type: 'edit-whole', image: data.edited_image }]);
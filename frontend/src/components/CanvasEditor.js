@@ -141,6 +141,27 @@ const CanvasEditor = forwardRef(({
     ctx.restore();
   };
 
+  // Run-length encode the mask strokes as {size: [w, h], counts: [...]}: alternating
+  // runs of unmasked/masked pixels in row-major order, a few hundred bytes instead
+  // of a second full-color image
+  const encodeMaskRle = (maskCtx, width, height) => {
+    const pixels = maskCtx.getImageData(0, 0, width, height).data;
+    const counts = [];
+    let masked = false;
+    let run = 0;
+    for (let i = 3; i < pixels.length; i += 4) {
+      const isMasked = pixels[i] > 127;
+      if (isMasked !== masked) {
+        counts.push(run);
+        run = 0;
+        masked = isMasked;
+      }
+      run++;
+    }
+    counts.push(run);
+    return { size: [width, height], counts };
+  };
+
   // Optimized mask generation with debouncing
   const generateMask = () => {
     if (!image || !maskEnabled) return;
@@ -214,7 +235,7 @@ const CanvasEditor = forwardRef(({
     baseCtx.drawImage(maskCanvas, 0, 0);
     
     const dataURL = baseCanvas.toDataURL('image/png', 1.0);
-    onMaskChange && onMaskChange(dataURL);
+    onMaskChange && onMaskChange(dataURL, encodeMaskRle(maskCtx, canvasSize.width, canvasSize.height));
   };
   useEffect(() => {
     if (!imageSrc) return;